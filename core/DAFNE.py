@@ -1,22 +1,205 @@
 import os
 import sys
+import json
+import shutil
 from . import io_tools
+from . import fragment_io
 import argparse
+from . import lazy
+concurrent_futures = lazy.lazy_import("concurrent.futures")
 from . import riconstruct_image
 from . import remove_fragments
 from . import fragmentation_erosion
+from . import tiled_fragmentation
+from . import geometry_cache
+from . import spurius_pool
+
+
+DEFAULT_PARAMETERS = {
+    "seed": 1000,
+    "num_fragments": 500,
+    "min_distance": 6,
+    "erosion_probability": 0.6,
+    "erosion_percentage": 20,
+    "removal_percentage": 0,
+    "removal_mode": "copy",
+    "num_spurius": 0,
+    "spurius_match": "none",
+    "sampler": "rejection",
+    "merge_chain": None,
+    "fragment_workers": None,
+    "fragment_executor": "thread",
+    "erosion_mode": "fragment",
+    "rotation": "expand",
+    "fragment_format": "png",
+    "compress_level": None,
+    "writer_workers": 4,
+    "storage": "folder",
+    "shard_size": fragment_io.DEFAULT_SHARD_SIZE,
+    "tile_size": None,
+    "scratch_directory": None,
+    "cache_directory": None,
+    "cache_size": geometry_cache.DEFAULT_CACHE_SIZE,
+    "resume": False,
+}
+
+# parameters that change how an image is processed, not what comes out of it
+RUNTIME_PARAMETERS = ("fragment_workers", "fragment_executor", "writer_workers", "tile_size", "scratch_directory", "cache_directory",
+                      "cache_size", "resume")
+COMPLETION_MARKER = ".complete.json"
+RUN_MANIFEST = "run_manifest.json"
+
+
+def run_key(file_path, parameters, spurius_directory=None):
+    # what names the outputs of an image in resumable runs: the image name, the parameters that change the outputs and
+    # the spurious source. fragment_workers and tile_size give every fragment its own random stream, for any value
+    key_parameters = {key: value for key, value in parameters.items() if key not in RUNTIME_PARAMETERS}
+    key_parameters["fragment_streams"] = parameters["fragment_workers"] is not None or parameters["tile_size"] is not None
+    key_parameters["image"] = os.path.basename(file_path)
+    key_parameters["spurius_directory"] = os.path.abspath(spurius_directory) if spurius_directory is not None else None
+    return io_tools.parameters_key(key_parameters)
+
+
+def process_image(file_path, output_directory, parameters, spurius_directory=None):
+    if parameters["resume"]:
+        return resumable_image(file_path, output_directory, parameters, spurius_directory)
+    return generate_image(file_path, output_directory, parameters, spurius_directory)[0]
+
+
+def resumable_image(file_path, output_directory, parameters, spurius_directory=None):
+    # process_image with the outputs named <image>-<run key>. They are generated in a staging folder, moved in place once
+    # complete and then marked complete; an image with a marker is skipped, whatever an interrupted run left is redone
+    key = run_key(file_path, parameters, spurius_directory)
+    name = io_tools.image_name(file_path)
+    marker_path = os.path.join(output_directory, f"{name}-{key}{COMPLETION_MARKER}")
+    if os.path.exists(marker_path):
+        with open(marker_path, "r") as marker_file:
+            marker = json.load(marker_file)
+        sys.stderr.write(f'\r\nskip {file_path}, already complete in {marker["path"]}\n')
+        return os.path.join(output_directory, marker["path"])
+
+    staging_path = os.path.join(output_directory, f".staging-{name}-{key}")
+    shutil.rmtree(staging_path, ignore_errors=True)
+    os.makedirs(staging_path)
+    staged = [path for path in generate_image(file_path, staging_path, parameters, spurius_directory, key) if path is not None]
+    outputs = []
+    moved = {}
+    for path in staged:
+        target_path = os.path.join(output_directory, os.path.basename(path))
+        shutil.rmtree(target_path, ignore_errors=True)
+        os.rename(path, target_path)
+        moved[os.path.abspath(path)] = os.path.abspath(target_path)
+        outputs.append(os.path.basename(path))
+    # removal views point to their dataset and to the spurious fragments through relative paths: the dataset moved
+    # with them, the spurious source didn't
+    for path, target_path in moved.items():
+        if os.path.exists(os.path.join(target_path, fragment_io.MANIFEST)):
+            fragment_io.relocate_manifest(target_path, path, moved)
+    shutil.rmtree(staging_path)
+
+    marker = {"image": file_path, "key": key, "path": outputs[0], "removal_path": outputs[1] if len(outputs) > 1 else None,
+              "parameters": {parameter: value for parameter, value in parameters.items() if parameter not in RUNTIME_PARAMETERS}}
+    with open(marker_path + ".tmp", "w") as marker_file:
+        json.dump(marker, marker_file, indent=1)
+    os.replace(marker_path + ".tmp", marker_path)
+    return os.path.join(output_directory, outputs[0])
+
+
+def write_run_manifest(output_directory):
+    # every image marked complete in output_directory, by this run or an earlier one
+    runs = []
+    for file_name in sorted(os.listdir(output_directory)):
+        if file_name.endswith(COMPLETION_MARKER):
+            with open(os.path.join(output_directory, file_name), "r") as marker_file:
+                runs.append(json.load(marker_file))
+    manifest_path = os.path.join(output_directory, RUN_MANIFEST)
+    with open(manifest_path + ".tmp", "w") as manifest_file:
+        json.dump({"manifest_version": 1, "runs": runs}, manifest_file, indent=1)
+    os.replace(manifest_path + ".tmp", manifest_path)
+    return manifest_path
+
+
+def generate_image(file_path, output_directory, parameters, spurius_directory=None, folder_suffix=None):
+    # the datasets of one image, (path, removal_path), removal_path is None without removal
+    seed = parameters["seed"]
+
+    if parameters["tile_size"] is not None:
+        if parameters["erosion_mode"] != "fragment":
+            raise ValueError("tile_size cuts the image strip by strip, it can only be used with erosion_mode 'fragment'")
+        # large images: fragments go straight to disk, reconstruction and removal read them back from there
+        path = tiled_fragmentation.generate_fragments_tiled(file_path, output_directory, parameters["num_fragments"], parameters["min_distance"], seed,
+                                                            parameters["erosion_probability"], parameters["erosion_percentage"], parameters["sampler"],
+                                                            tile_size=parameters["tile_size"], scratch_directory=parameters["scratch_directory"],
+                                                            fragment_format=parameters["fragment_format"], compress_level=parameters["compress_level"],
+                                                            writer_workers=parameters["writer_workers"], storage=parameters["storage"],
+                                                            shard_size=parameters["shard_size"], merge_chain=parameters["merge_chain"],
+                                                            rotation=parameters["rotation"], folder_suffix=folder_suffix)
+        fragments = None
+    else:
+        cache = None
+        if parameters["cache_directory"] is not None:
+            cache = geometry_cache.GeometryCache(parameters["cache_directory"], parameters["cache_size"])
+        path, fragments = fragmentation_erosion.generate_fragments(file_path, output_directory, parameters["num_fragments"], parameters["min_distance"], seed,
+                                                                   parameters["erosion_probability"], parameters["erosion_percentage"], parameters["sampler"],
+                                                                   return_fragments=True, fragment_workers=parameters["fragment_workers"],
+                                                                   fragment_executor=parameters["fragment_executor"], fragment_format=parameters["fragment_format"],
+                                                                   compress_level=parameters["compress_level"], writer_workers=parameters["writer_workers"],
+                                                                   storage=parameters["storage"], shard_size=parameters["shard_size"], cache=cache,
+                                                                   erosion_mode=parameters["erosion_mode"], merge_chain=parameters["merge_chain"],
+                                                                   rotation=parameters["rotation"], folder_suffix=folder_suffix)
+    riconstruct_image.image_ricostruction(file_path, path, fragments)
+
+    removal_path = None
+    if parameters["removal_percentage"] != 0:
+        removal_path, n_fragments = remove_fragments.random_fragments_removal(seed, path, output_directory, parameters["removal_percentage"], file_path, fragments,
+                                                                              parameters["removal_mode"], folder_suffix)
+    else:
+        sys.stderr.write('\r\nskip fragments removal\n')
+        sys.stderr.write('\rparameter missing: need "removal_percentage", float > 0, in the text file\n')
+
+    if parameters["num_spurius"] != 0 and spurius_directory is not None and removal_path is not None:
+        remove_fragments.add_spurius_fragments(removal_path, spurius_directory, parameters["num_spurius"], n_fragments, parameters["spurius_match"])
+    else:
+        sys.stderr.write('\r\nskip spurious operation\n')
+        sys.stderr.write('\rparameter missing: "need num_spurius", int > 0, in the text file and folder to select the spurious\n')
+
+    return path, removal_path
+
+
+def process_batch(file_paths, output_directory, parameters, spurius_directory, workers):
+    # every image gets its own seed, derived from the base seed and the image name,
+    # so the output doesn't depend on the number of workers or on the scheduling order
+    results = {}
+    with concurrent_futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for file_path in file_paths:
+            image_parameters = dict(parameters)
+            image_parameters["seed"] = io_tools.derive_seed(parameters["seed"], os.path.basename(file_path))
+            futures[file_path] = executor.submit(process_image, file_path, output_directory, image_parameters, spurius_directory)
+
+        for file_path, future in futures.items():
+            try:
+                results[file_path] = (True, future.result())
+            except Exception as e:
+                results[file_path] = (False, f"{type(e).__name__}: {e}")
+
+    return results
+
+
+def write_summary(results):
+    failed = [file_path for file_path, (done, _) in results.items() if not done]
+    sys.stderr.write(f'\r\nsummary: {len(results)} images, {len(results) - len(failed)} done, {len(failed)} failed\n')
+    for file_path, (done, message) in results.items():
+        status = "done" if done else "failed"
+        sys.stderr.write(f'\r  {status:<6} {os.path.basename(file_path)}: {message}\n')
+    sys.stderr.flush()
+    return failed
 
 
 def main():
 
-    # default values 
-    seed = 1000
-    num_fragments = 500
-    min_distance = 6
-    erosion_probability = 0.6
-    erosion_percentage = 20  
-    removal_percentage = 0
-    num_spurius = 0
+    # default values
+    parameters = dict(DEFAULT_PARAMETERS)
     output_directory = os.path.dirname(os.path.abspath(__file__))
     #
 
@@ -24,53 +207,111 @@ def main():
     parser.add_argument('input_directory', type=str, help='path to the input folder that contains the images')
     parser.add_argument('--output_directory', type=str, help='Output folder path', required= False)
     parser.add_argument('--file_path', type=str, help='Path to input text file, if not specified there are default values', required= False)
-    parser.add_argument('--spurius_directory', type=str, help='Path to the folder generated by DAFNE, the outermost one, in order to derive the spurious fragments', required= False)
+    parser.add_argument('--spurius_directory', type=str, help='Path to the folder generated by DAFNE, the outermost one, or to a spurious pool index built by spurius_pool, in order to derive the spurious fragments', required= False)
+    parser.add_argument('--spurius_match', type=str, choices=spurius_pool.MATCH_MODES, default='none', help='With a spurious pool, draw fragments close in size (size), colour (colour) or both to the fragments of the dataset', required= False)
+    parser.add_argument('--workers', type=int, help='Batch mode: number of processes the images are spread across, each image gets a seed derived from the base seed and its name', required= False)
+    parser.add_argument('--fragment_workers', type=int, help='Erode, degrade and rotate the fragments of each image in parallel, every fragment gets its own random stream', required= False)
+    parser.add_argument('--fragment_executor', type=str, choices=['thread', 'process'], default='thread', help='Pool used by --fragment_workers', required= False)
+    parser.add_argument('--erosion_mode', type=str, choices=fragmentation_erosion.EROSION_MODES, help='Erode and degrade the fragments one by one (fragment, default) or all at once on the whole image (batch)', required= False)
+    parser.add_argument('--rotation', type=str, choices=fragmentation_erosion.ROTATION_MODES, help='Store the rotated fragments whole (expand, default) or cropped to their visible pixels, with the affine that puts them back (tight)', required= False)
+    parser.add_argument('--writer_workers', type=int, default=4, help='Number of threads encoding and writing the fragments', required= False)
+    parser.add_argument('--tile_size', type=int, help='Fragment large images strip by strip, with strips of this many rows, without loading the whole image in memory', required= False)
+    parser.add_argument('--scratch_directory', type=str, help='Folder for the temporary copy of the image used by --tile_size, defaults to the system temporary folder', required= False)
+    parser.add_argument('--removal_mode', type=str, choices=remove_fragments.REMOVAL_MODES, default='copy', help='copy the fragments that survive the removal, hard link them, or only write a manifest that points to them', required= False)
+    parser.add_argument('--cache_directory', type=str, help='Cache the decoded images, seed points and label maps in this folder, reused when an image is fragmented again with the same seed, num_fragments, min_distance and sampler', required= False)
+    parser.add_argument('--cache_size', type=int, default=geometry_cache.DEFAULT_CACHE_SIZE, help='Size limit of --cache_directory in bytes, least recently used entries are removed first', required= False)
+    parser.add_argument('--resume', action='store_true', help='Name the outputs of every image after its parameters, write them atomically and skip the images a previous run with the same parameters completed; use it from the first run', required= False)
+    parser.add_argument('--pack_directory', type=str, help='Pack the fragments of every generated dataset into one set of shards in this folder', required= False)
 
     args = parser.parse_args()
+    if args.writer_workers < 1:
+        parser.error(f"--writer_workers must be at least 1, got {args.writer_workers}")
 
     input_directory = args.input_directory
-    
+
     if args.output_directory is not None:
         output_directory = args.output_directory
 
+    parameters["fragment_workers"] = args.fragment_workers
+    parameters["fragment_executor"] = args.fragment_executor
+    parameters["writer_workers"] = args.writer_workers
+    parameters["tile_size"] = args.tile_size
+    parameters["scratch_directory"] = args.scratch_directory
+    parameters["removal_mode"] = args.removal_mode
+    parameters["spurius_match"] = args.spurius_match
+    parameters["cache_directory"] = args.cache_directory
+    parameters["cache_size"] = args.cache_size
+    parameters["resume"] = args.resume
+    if args.erosion_mode is not None:
+        parameters["erosion_mode"] = args.erosion_mode
+    if args.rotation is not None:
+        parameters["rotation"] = args.rotation
+
 
     if args.file_path is not None and os.path.exists(args.file_path):
         input_data = io_tools.read_input_from_file(args.file_path)
-        seed = int(input_data.get("seed"))
-        num_fragments = int(input_data.get("num_fragments"))
-        min_distance = int(input_data.get("min_distance"))
-        erosion_probability = float(input_data.get("erosion_probability"))
-        erosion_percentage = float(input_data.get("erosion_percentage"))
+        parameters["seed"] = int(input_data.get("seed"))
+        parameters["num_fragments"] = int(input_data.get("num_fragments"))
+        parameters["min_distance"] = int(input_data.get("min_distance"))
+        parameters["erosion_probability"] = float(input_data.get("erosion_probability"))
+        parameters["erosion_percentage"] = float(input_data.get("erosion_percentage"))
         if "removal_percentage" in input_data:
-            removal_percentage = float(input_data.get("removal_percentage"))
+            parameters["removal_percentage"] = float(input_data.get("removal_percentage"))
         if "num_spurius" in input_data:
-            num_spurius = float(input_data.get("num_spurius"))
-            
+            parameters["num_spurius"] = int(float(input_data.get("num_spurius")))
+        if "sampler" in input_data:
+            parameters["sampler"] = input_data.get("sampler")
+        if "merge_chain" in input_data:
+            parameters["merge_chain"] = int(input_data.get("merge_chain"))
+        if "fragment_format" in input_data:
+            parameters["fragment_format"] = input_data.get("fragment_format")
+        if "compress_level" in input_data:
+            parameters["compress_level"] = int(input_data.get("compress_level"))
+        if "storage" in input_data:
+            parameters["storage"] = input_data.get("storage")
+        if "shard_size" in input_data:
+            parameters["shard_size"] = int(input_data.get("shard_size"))
+        if "erosion_mode" in input_data and args.erosion_mode is None:
+            parameters["erosion_mode"] = input_data.get("erosion_mode")
+        if "rotation" in input_data and args.rotation is None:
+            parameters["rotation"] = input_data.get("rotation")
+        if "tile_size" in input_data and args.tile_size is None:
+            parameters["tile_size"] = int(input_data.get("tile_size"))
+
 
     img_extension = ['.jpg', '.jpeg', '.png']
+    if parameters["tile_size"] is not None:
+        # .npy images are memory mapped by the tiled mode, never decoded whole
+        img_extension.append('.npy')
 
-    for filename in os.listdir(input_directory):
+    file_paths = []
+    for filename in sorted(os.listdir(input_directory)):
         file_path = os.path.join(input_directory, filename)
-        if os.path.isfile(file_path) is not None and filename.endswith(tuple(img_extension)):
-            path = fragmentation_erosion.generate_fragments(file_path, output_directory, num_fragments, min_distance, seed, erosion_probability, erosion_percentage)
-            riconstruct_image.image_ricostruction(file_path, path)
-
-            if removal_percentage != 0:
-                removal_path, n_fragments = remove_fragments.random_fragments_removal(seed, path, output_directory, erosion_percentage, file_path)
-            else:
-                sys.stderr.write('\r\nskip fragments removal\n')
-                sys.stderr.write('\rparameter missing: need "removal_percentage", float > 0, in the text file\n')
-                
-            if num_spurius !=0 and args.spurius_directory is not None:
-                spurius_directory = args.spurius_directory
-                remove_fragments.add_spurius_fragments(removal_path, spurius_directory, num_spurius, n_fragments)
-            else:
-                sys.stderr.write('\r\nskip spurious operation\n')
-                sys.stderr.write('\rparameter missing: "need num_spurius", int > 0, in the text file and folder to select the spurious\n')
-
-            
+        if os.path.isfile(file_path) and filename.endswith(tuple(img_extension)):
+            file_paths.append(file_path)
+
+    if args.workers is not None:
+        results = process_batch(file_paths, output_directory, parameters, args.spurius_directory, args.workers)
+    else:
+        results = {}
+        for file_path in file_paths:
+            try:
+                results[file_path] = (True, process_image(file_path, output_directory, parameters, args.spurius_directory))
+            except Exception as e:
+                results[file_path] = (False, f"{type(e).__name__}: {e}")
+
+    failed = write_summary(results)
+    if parameters["resume"]:
+        sys.stderr.write(f'\rcompleted images listed in {write_run_manifest(output_directory)}\n')
+
+    if args.pack_directory is not None:
+        paths = [message for done, message in results.values() if done]
+        fragment_io.pack_datasets(paths, args.pack_directory, parameters["shard_size"])
+        sys.stderr.write(f'\r{len(paths)} datasets packed in {args.pack_directory}\n')
 
     sys.stderr.write('\rdatset ready.\n')
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -7,8 +7,20 @@ name.
 
 __all__ = [
     "DAFNE",
+    "benchmark",
     "io_tools",
+    "instrumentation",
+    "fragment_io",
+    "geometry_cache",
+    "shared_source",
     "riconstruct_image",
     "fragmentation_erosion",
+    "fragmenter",
+    "fragment_stream",
+    "tiled_fragmentation",
     "remove_fragments",
+    "spurius_pool",
+    "sweep",
+    "lazy",
+    "worker",
 ]
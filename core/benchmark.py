@@ -0,0 +1,218 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import subprocess
+from . import lazy
+np = lazy.lazy_import("numpy")
+Image = lazy.lazy_import("PIL.Image")
+from . import io_tools
+from . import riconstruct_image
+from . import remove_fragments
+from . import fragmentation_erosion
+
+
+BENCHMARK_VERSION = 1
+STAGES = ("generate_random_points", "create_voronoi", "create_fragment_image", "combine_fragment", "fragment_erosion",
+          "rotate_fragment", "batch_erosion", "save", "image_ricostruction", "random_fragments_removal")
+
+
+def synthetic_image(width, height, seed=0):
+    # smooth colour gradients plus noise, so that erosion, blur and PNG compression have real work to do
+    rng = np.random.default_rng(seed)
+    ys, xs = np.mgrid[0:height, 0:width]
+    red = 128 + 100 * np.sin(xs / 37.0)
+    green = 128 + 100 * np.cos(ys / 53.0)
+    blue = 128 + 100 * np.sin((xs + ys) / 71.0)
+    pixels = np.dstack([red, green, blue]) + rng.normal(0, 12, (height, width, 3))
+    return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8), "RGB")
+
+
+def measure(function, repeat):
+    # best wall time over repeat runs, then one more run under tracemalloc for the peak memory;
+    # tracemalloc sees Python and NumPy allocations, not the buffers allocated inside OpenCV or Pillow
+    seconds = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        seconds = min(seconds, time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        result = function()
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, {"seconds": seconds, "peak_bytes": peak_bytes}
+
+
+def benchmark_case(width, height, num_fragments, parameters, work_directory, repeat=3):
+    # runs the stages of generate_fragments one by one on a synthetic image, every run of a stage
+    # starts from the same random state so the repeats do the same work
+    seed = parameters["seed"]
+    min_distance = parameters["min_distance"]
+    erosion_probability = parameters["erosion_probability"]
+    erosion_percentage = parameters["erosion_percentage"]
+
+    case_directory = tempfile.mkdtemp(prefix=f"{width}x{height}-{num_fragments}-", dir=work_directory)
+    image_path = os.path.join(case_directory, "synthetic.png")
+    synthetic_image(width, height).save(image_path)
+    pixels = fragmentation_erosion.image_to_array(Image.open(image_path))
+    stages = {}
+
+    def seeded(function, *args):
+        def run():
+            random.seed(seed)
+            return function(*args)
+        return run
+
+    points, stages["generate_random_points"] = measure(
+        lambda: fragmentation_erosion.generate_random_points(min_distance, seed, num_fragments, width, height, parameters["sampler"]), repeat)
+    label_map, stages["create_voronoi"] = measure(lambda: fragmentation_erosion.create_voronoi(width, height, points), repeat)
+    fragments, stages["create_fragment_image"] = measure(lambda: fragmentation_erosion.create_fragment_image(label_map, points, pixels), repeat)
+
+    num_combined_fragment = random.Random(seed).randint(1, int(np.sqrt(len(points))))
+    combined_fragments, stages["combine_fragment"] = measure(
+        seeded(fragmentation_erosion.combine_fragment, fragments, label_map, points, pixels, num_combined_fragment), repeat)
+    eroded_fragments, stages["fragment_erosion"] = measure(
+        seeded(fragmentation_erosion.fragment_erosion, combined_fragments, min_distance, erosion_probability, erosion_percentage), repeat)
+    rotated_fragments, stages["rotate_fragment"] = measure(seeded(fragmentation_erosion.rotate_fragment, eroded_fragments), repeat)
+
+    # the same cells eroded in one pass over the whole image, for comparison with combine_fragment + fragment_erosion
+    random.seed(seed)
+    bounding_boxes = fragmentation_erosion.cell_bounding_boxes(label_map, len(points))
+    cells = fragmentation_erosion.combine_cells(fragmentation_erosion.cell_descriptors(points, bounding_boxes), num_combined_fragment)
+    _, stages["batch_erosion"] = measure(
+        seeded(fragmentation_erosion.batch_erosion, cells, pixels, label_map, bounding_boxes, min_distance, erosion_probability, erosion_percentage), repeat)
+
+    def save():
+        path, resources_path, fragment_path = io_tools.create_folder("synthetic", case_directory)
+        fragmentation_erosion.save_fragments_to_folder(rotated_fragments, fragment_path, parameters["fragment_format"])
+        fragmentation_erosion.save_info(rotated_fragments, resources_path)
+        return path
+
+    path, stages["save"] = measure(save, repeat)
+    _, stages["image_ricostruction"] = measure(lambda: riconstruct_image.image_ricostruction(image_path, path, rotated_fragments), repeat)
+    _, stages["random_fragments_removal"] = measure(
+        lambda: remove_fragments.random_fragments_removal(seed, path, case_directory, parameters["removal_percentage"], image_path, rotated_fragments),
+        repeat)
+
+    shutil.rmtree(case_directory, ignore_errors=True)
+    return {"width": width, "height": height, "num_fragments": num_fragments, "stages": stages}
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(sizes, fragment_counts, parameters, repeat=3, work_directory=None):
+    results = {
+        "benchmark_version": BENCHMARK_VERSION,
+        "date": io_tools.time_value(),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "repeat": repeat,
+        "parameters": parameters,
+        "cases": [],
+    }
+    for size in sizes:
+        for num_fragments in fragment_counts:
+            sys.stderr.write(f'\r\nbenchmark {size}x{size}, {num_fragments} fragments\n')
+            results["cases"].append(benchmark_case(size, size, num_fragments, parameters, work_directory, repeat))
+    return results
+
+
+def case_key(case):
+    return (case["width"], case["height"], case["num_fragments"])
+
+
+def compare_results(results, baseline, threshold=0.1, min_seconds=0.01):
+    # a stage regresses when its time or peak memory grows by more than threshold over the baseline;
+    # stages faster than min_seconds in both runs are left out, their timings are mostly noise
+    baseline_cases = {case_key(case): case for case in baseline["cases"]}
+    regressions = []
+    for case in results["cases"]:
+        baseline_case = baseline_cases.get(case_key(case))
+        if baseline_case is None:
+            continue
+        for stage, measures in case["stages"].items():
+            old = baseline_case["stages"].get(stage)
+            if old is None:
+                continue
+            label = f"{case['width']}x{case['height']}, {case['num_fragments']} fragments, {stage}"
+            if max(measures["seconds"], old["seconds"]) >= min_seconds and measures["seconds"] > old["seconds"] * (1 + threshold):
+                regressions.append(f"{label}: {old['seconds']:.4f}s -> {measures['seconds']:.4f}s")
+            if old["peak_bytes"] > 0 and measures["peak_bytes"] > old["peak_bytes"] * (1 + threshold):
+                regressions.append(f"{label}: {old['peak_bytes']} -> {measures['peak_bytes']} bytes")
+    return regressions
+
+
+def write_report(results):
+    for case in results["cases"]:
+        sys.stderr.write(f"\r\n{case['width']}x{case['height']}, {case['num_fragments']} fragments\n")
+        for stage in STAGES:
+            measures = case["stages"][stage]
+            sys.stderr.write(f"\r  {stage:<26} {measures['seconds']:>9.4f}s {measures['peak_bytes'] / 2**20:>9.1f} MiB\n")
+    sys.stderr.flush()
+
+
+def main():
+
+    # default values
+    parameters = {
+        "seed": 3500,
+        "min_distance": 6,
+        "erosion_probability": 0.65,
+        "erosion_percentage": 25,
+        "removal_percentage": 10,
+        "sampler": "rejection",
+        "fragment_format": "png",
+    }
+    #
+
+    parser = argparse.ArgumentParser(description='times and measures the peak memory of every stage of the fragmentation pipeline on synthetic images')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[512, 2048], help='Side of the square synthetic images, e.g. 512 2048 8192', required= False)
+    parser.add_argument('--num_fragments', type=int, nargs='+', default=[100, 500], help='Fragment counts benchmarked on every size', required= False)
+    parser.add_argument('--repeat', type=int, default=3, help='Runs of every stage, the best time is kept', required= False)
+    parser.add_argument('--output', type=str, help='Write the results to this JSON file', required= False)
+    parser.add_argument('--baseline', type=str, help='JSON results of a previous run to compare with, exits with status 1 on a regression', required= False)
+    parser.add_argument('--threshold', type=float, default=0.1, help='Allowed slowdown or memory growth over the baseline, 0.1 is 10%%', required= False)
+    parser.add_argument('--min_seconds', type=float, default=0.01, help='Stages faster than this are not checked for time regressions', required= False)
+    parser.add_argument('--work_directory', type=str, help='Folder for the temporary datasets, defaults to the system temporary folder', required= False)
+
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.sizes, args.num_fragments, parameters, args.repeat, args.work_directory)
+    write_report(results)
+
+    if args.output is not None:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+        sys.stderr.write(f'\rresults written to {args.output}\n')
+
+    if args.baseline is not None:
+        with open(args.baseline, "r") as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare_results(results, baseline, args.threshold, args.min_seconds)
+        if regressions:
+            sys.stderr.write(f'\r\n{len(regressions)} regressions over {args.baseline}\n')
+            for regression in regressions:
+                sys.stderr.write(f'\r  {regression}\n')
+            sys.exit(1)
+        sys.stderr.write(f'\r\nno regressions over {args.baseline}\n')
+
+
+if __name__ == "__main__":
+    main()
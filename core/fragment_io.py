@@ -0,0 +1,438 @@
+import io
+import os
+import json
+import mmap
+import queue
+import shutil
+import tarfile
+import threading
+from . import lazy
+np = lazy.lazy_import("numpy")
+Image = lazy.lazy_import("PIL.Image")
+
+
+FRAGMENT_FORMATS = {"png": ".png", "webp": ".webp", "npy": ".npy"}
+FRAGMENT_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.npy')
+SHARD_INDEX = "index.json"
+SHARD_FORMAT_VERSION = 1
+MANIFEST = "manifest.json"
+MANIFEST_VERSION = 1
+DEFAULT_SHARD_SIZE = 1 << 30
+
+
+def encode_fragment(image, fragment_format="png", compress_level=None):
+    buffer = io.BytesIO()
+    if fragment_format == "png":
+        if compress_level is None:
+            image.save(buffer, 'PNG')
+        else:
+            image.save(buffer, 'PNG', compress_level=compress_level)
+    elif fragment_format == "webp":
+        # exact keeps the colour of transparent pixels, the same as PNG does
+        method = 4 if compress_level is None else round(compress_level * 6 / 9)
+        image.save(buffer, 'WEBP', lossless=True, exact=True, method=method)
+    elif fragment_format == "npy":
+        np.save(buffer, np.asarray(image), allow_pickle=False)
+    else:
+        raise ValueError(f"unknown fragment format '{fragment_format}', expected one of {', '.join(FRAGMENT_FORMATS)}")
+    return buffer.getvalue()
+
+
+def decode_fragment(data, extension):
+    if extension == ".npy":
+        return Image.fromarray(np.load(io.BytesIO(data), allow_pickle=False))
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    return image
+
+
+def load_fragment(file_path):
+    if file_path.endswith(".npy"):
+        return Image.fromarray(np.load(file_path, allow_pickle=False))
+    return Image.open(file_path)
+
+
+class FolderSink:
+    storage = "folder"
+
+    def __init__(self, folder_path):
+        self.folder_path = folder_path
+        os.makedirs(folder_path, exist_ok=True)
+
+    def write(self, sequence, name, extension, data):
+        if data is None:
+            return
+        with open(os.path.join(self.folder_path, name + extension), "wb") as fragment_file:
+            fragment_file.write(data)
+
+    def close(self):
+        pass
+
+
+class ShardSink:
+    # appends the fragments to tar shards and records where each one starts in index.json,
+    # writes happen in submission order so the same dataset always gives the same shards
+
+    storage = "shards"
+
+    def __init__(self, shard_path, shard_size=DEFAULT_SHARD_SIZE, append=False):
+        self.shard_path = shard_path
+        self.shard_size = shard_size
+        os.makedirs(shard_path, exist_ok=True)
+        index_path = os.path.join(shard_path, SHARD_INDEX)
+        if append and os.path.exists(index_path):
+            self.index = read_shard_index(shard_path)
+        else:
+            self.index = {"format_version": SHARD_FORMAT_VERSION, "shards": [], "fragments": {}}
+        self.tar = None
+        self.next_sequence = 0
+        self.condition = threading.Condition()
+
+    def _open_shard(self):
+        if self.tar is not None:
+            self.tar.close()
+        shard_name = f"fragments-{len(self.index['shards']):05d}.tar"
+        self.index["shards"].append(shard_name)
+        self.tar = tarfile.open(os.path.join(self.shard_path, shard_name), "w", format=tarfile.USTAR_FORMAT)
+
+    def write(self, sequence, name, extension, data):
+        with self.condition:
+            self.condition.wait_for(lambda: sequence == self.next_sequence)
+            try:
+                if data is None:
+                    return
+                if self.tar is None or self.tar.offset >= self.shard_size:
+                    self._open_shard()
+                member = tarfile.TarInfo(name + extension)
+                member.size = len(data)
+                header = member.tobuf(self.tar.format, self.tar.encoding, self.tar.errors)
+                offset = self.tar.offset + len(header)
+                self.tar.addfile(member, io.BytesIO(data))
+                self.index["fragments"][name] = {"shard": len(self.index["shards"]) - 1, "offset": offset,
+                                                 "size": len(data), "extension": extension}
+            finally:
+                self.next_sequence += 1
+                self.condition.notify_all()
+
+    def close(self):
+        if self.tar is not None:
+            self.tar.close()
+            self.tar = None
+        # the index is replaced in one step, a crash never leaves a half written one
+        index_path = os.path.join(self.shard_path, SHARD_INDEX)
+        with open(index_path + ".tmp", "w") as index_file:
+            json.dump(self.index, index_file)
+        os.replace(index_path + ".tmp", index_path)
+
+
+def fragment_sink(path, storage="folder", shard_size=DEFAULT_SHARD_SIZE, append=False):
+    if storage == "folder":
+        return FolderSink(os.path.join(path, "fragments"))
+    elif storage == "shards":
+        return ShardSink(os.path.join(path, "shards"), shard_size, append)
+    raise ValueError(f"unknown storage '{storage}', expected 'folder' or 'shards'")
+
+
+def read_shard_index(shard_path):
+    with open(os.path.join(shard_path, SHARD_INDEX), "r") as index_file:
+        index = json.load(index_file)
+    if index.get("format_version") != SHARD_FORMAT_VERSION:
+        raise ValueError(f"unsupported shard format version {index.get('format_version')} in {shard_path}")
+    return index
+
+
+class FolderStore:
+    storage = "folder"
+
+    def __init__(self, folder_path):
+        self.folder_path = folder_path
+        self.dataset_path = os.path.dirname(os.path.abspath(folder_path))
+        self.files = {}
+        for filename in os.listdir(folder_path):
+            name, extension = os.path.splitext(filename)
+            if extension in FRAGMENT_EXTENSIONS and os.path.isfile(os.path.join(folder_path, filename)):
+                self.files[name] = filename
+
+    def names(self):
+        return sorted(self.files)
+
+    def read(self, name):
+        filename = self.files[name]
+        with open(os.path.join(self.folder_path, filename), "rb") as fragment_file:
+            return os.path.splitext(filename)[1], fragment_file.read()
+
+    def load(self, name):
+        return load_fragment(os.path.join(self.folder_path, self.files[name]))
+
+    def file_path(self, name):
+        return os.path.join(self.folder_path, self.files[name])
+
+    def source(self, name):
+        # the dataset the fragment is stored in, and its name there
+        return self.dataset_path, name
+
+    def close(self):
+        pass
+
+
+class ShardStore:
+    # shards are memory mapped on first use, reading a fragment is a slice of the map
+
+    storage = "shards"
+
+    def __init__(self, shard_path):
+        self.shard_path = shard_path
+        self.dataset_path = os.path.dirname(os.path.abspath(shard_path))
+        self.index = read_shard_index(shard_path)
+        self.maps = {}
+
+    def _map(self, shard):
+        if shard not in self.maps:
+            with open(os.path.join(self.shard_path, self.index["shards"][shard]), "rb") as shard_file:
+                self.maps[shard] = mmap.mmap(shard_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.maps[shard]
+
+    def names(self):
+        return sorted(self.index["fragments"])
+
+    def read(self, name):
+        entry = self.index["fragments"][name]
+        data = self._map(entry["shard"])[entry["offset"]:entry["offset"] + entry["size"]]
+        return entry["extension"], data
+
+    def load(self, name):
+        extension, data = self.read(name)
+        return decode_fragment(data, extension)
+
+    def source(self, name):
+        return self.dataset_path, name
+
+    def close(self):
+        for shard_map in self.maps.values():
+            shard_map.close()
+        self.maps = {}
+
+
+def read_manifest(path):
+    with open(os.path.join(path, MANIFEST), "r") as manifest_file:
+        manifest = json.load(manifest_file)
+    if manifest.get("manifest_version") != MANIFEST_VERSION:
+        raise ValueError(f"unsupported manifest version {manifest.get('manifest_version')} in {path}")
+    return manifest
+
+
+def write_manifest(path, manifest):
+    manifest_path = os.path.join(path, MANIFEST)
+    with open(manifest_path + ".tmp", "w") as manifest_file:
+        json.dump(dict(manifest, manifest_version=MANIFEST_VERSION), manifest_file, indent=1)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+def manifest_entry(path, source):
+    # source datasets are recorded relative to the view, so the two can be moved together; a view moved without its
+    # sources needs relocate_manifest
+    dataset_path, name = source
+    return {"dataset": os.path.relpath(dataset_path, os.path.abspath(path)), "name": name}
+
+
+def relocate_manifest(path, old_path, moved=None):
+    # rewrites the entries of the view now at path, written when it was at old_path, so they point to the same
+    # datasets from the new place; moved maps the old absolute path of the datasets moved with the view to the new one
+    moved = moved or {}
+    manifest = read_manifest(path)
+    for entry in manifest["fragments"].values():
+        dataset_path = os.path.normpath(os.path.join(os.path.abspath(old_path), entry["dataset"]))
+        dataset_path = moved.get(dataset_path, dataset_path)
+        entry["dataset"] = os.path.relpath(dataset_path, os.path.abspath(path))
+    write_manifest(path, manifest)
+
+
+class ManifestStore:
+    # a view over other datasets: manifest.json lists the kept, removed and spurious fragments,
+    # each kept or spurious one with the dataset it is read from
+
+    storage = "manifest"
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.manifest = read_manifest(path)
+        self.stores = {}
+
+    def _store(self, name):
+        entry = self.manifest["fragments"][name]
+        dataset_path = os.path.normpath(os.path.join(self.path, entry["dataset"]))
+        if dataset_path not in self.stores:
+            self.stores[dataset_path] = open_fragment_store(dataset_path)
+        return self.stores[dataset_path], entry["name"]
+
+    def names(self):
+        return sorted(self.manifest["fragments"])
+
+    def read(self, name):
+        store, source_name = self._store(name)
+        return store.read(source_name)
+
+    def load(self, name):
+        store, source_name = self._store(name)
+        return store.load(source_name)
+
+    def source(self, name):
+        store, source_name = self._store(name)
+        return store.source(source_name)
+
+    def close(self):
+        for store in self.stores.values():
+            store.close()
+        self.stores = {}
+
+
+def open_fragment_store(path):
+    # path is a dataset folder generated by DAFNE, with a manifest.json, a shards/ or a fragments/ folder
+    if os.path.exists(os.path.join(path, MANIFEST)):
+        return ManifestStore(path)
+    shard_path = os.path.join(path, "shards")
+    if os.path.exists(os.path.join(shard_path, SHARD_INDEX)):
+        return ShardStore(shard_path)
+    return FolderStore(os.path.join(path, "fragments"))
+
+
+def link_fragments(store, names, path):
+    # hard links the fragments of names from store into the dataset at path, copying the files the file system
+    # can't link; shards are linked whole and only the index lists the kept fragments
+    if store.storage == "folder":
+        folder_path = os.path.join(path, "fragments")
+        os.makedirs(folder_path, exist_ok=True)
+        for name in names:
+            source_path = store.file_path(name)
+            target_path = os.path.join(folder_path, os.path.basename(source_path))
+            try:
+                os.link(source_path, target_path)
+            except OSError:
+                shutil.copyfile(source_path, target_path)
+    elif store.storage == "shards":
+        shard_path = os.path.join(path, "shards")
+        os.makedirs(shard_path, exist_ok=True)
+        for shard_name in store.index["shards"]:
+            try:
+                os.link(os.path.join(store.shard_path, shard_name), os.path.join(shard_path, shard_name))
+            except OSError:
+                shutil.copyfile(os.path.join(store.shard_path, shard_name), os.path.join(shard_path, shard_name))
+        index = dict(store.index, fragments={name: store.index["fragments"][name] for name in names})
+        index_path = os.path.join(shard_path, SHARD_INDEX)
+        with open(index_path + ".tmp", "w") as index_file:
+            json.dump(index, index_file)
+        os.replace(index_path + ".tmp", index_path)
+    else:
+        raise ValueError(f"fragments of a {store.storage} dataset can't be linked")
+
+
+def clone_dataset(path, target_path):
+    # a copy of the dataset at path in target_path, an empty folder: resources/ is copied, every other file is hard
+    # linked. Fragments added to the clone only create files (shards are never appended to in place, indices and
+    # manifests are replaced), so the two datasets never write to a shared file
+    for folder, _, files in os.walk(path):
+        relative = os.path.relpath(folder, path)
+        target_folder = os.path.normpath(os.path.join(target_path, relative))
+        os.makedirs(target_folder, exist_ok=True)
+        for file_name in files:
+            source_path = os.path.join(folder, file_name)
+            file_path = os.path.join(target_folder, file_name)
+            if relative.split(os.sep)[0] == "resources":
+                shutil.copy2(source_path, file_path)
+                continue
+            try:
+                os.link(source_path, file_path)
+            except OSError:
+                shutil.copyfile(source_path, file_path)
+
+
+def pack_datasets(paths, output_path, shard_size=DEFAULT_SHARD_SIZE):
+    # packs the fragments of several datasets into one set of shards, named <dataset>/<fragment>
+    sink = ShardSink(output_path, shard_size)
+    sequence = 0
+    try:
+        for path in paths:
+            dataset = os.path.basename(os.path.normpath(path))
+            store = open_fragment_store(path)
+            try:
+                for name in store.names():
+                    extension, data = store.read(name)
+                    sink.write(sequence, f"{dataset}/{name}", extension, data)
+                    sequence += 1
+            finally:
+                store.close()
+    finally:
+        sink.close()
+    return output_path
+
+
+class FragmentWriter:
+    # encodes and writes fragments in a pool of threads fed through a bounded queue, so the
+    # producer is blocked instead of piling up fragments when the disk is slower than it
+
+    def __init__(self, sink, fragment_format="png", compress_level=None, workers=4, queue_size=None):
+        if fragment_format not in FRAGMENT_FORMATS:
+            raise ValueError(f"unknown fragment format '{fragment_format}', expected one of {', '.join(FRAGMENT_FORMATS)}")
+        if workers < 1:
+            raise ValueError(f"a fragment writer needs at least 1 worker, got {workers}")
+        if isinstance(sink, str):
+            sink = FolderSink(sink)
+        self.sink = sink
+        self.fragment_format = fragment_format
+        self.compress_level = compress_level
+        self.queue = queue.Queue(maxsize=queue_size or 2 * workers)
+        self.sequence = 0
+        self.errors = []
+        self.threads = [threading.Thread(target=self._run, daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            sequence, name, image, extension, data = item
+            try:
+                if data is None:
+                    data = encode_fragment(image, self.fragment_format, self.compress_level)
+                    extension = FRAGMENT_FORMATS[self.fragment_format]
+            except Exception as e:
+                self.errors.append((name, e))
+                data = None
+            try:
+                self.sink.write(sequence, name, extension, data)
+            except Exception as e:
+                self.errors.append((name, e))
+
+    def write(self, name, image):
+        self.queue.put((self.sequence, name, image, None, None))
+        self.sequence += 1
+
+    def write_encoded(self, name, extension, data):
+        # already encoded fragments, e.g. copied from another dataset, are stored as they are
+        self.queue.put((self.sequence, name, None, extension, data))
+        self.sequence += 1
+
+    def _shutdown(self):
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.sink.close()
+
+    def close(self):
+        self._shutdown()
+        if self.errors:
+            name, error = self.errors[0]
+            raise OSError(f"could not write {name}: {error}") from error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # an exception of the with body wins over the write errors it may have caused
+        if exc_type is None:
+            self.close()
+        else:
+            self._shutdown()
@@ -0,0 +1,147 @@
+import os
+import random
+import itertools
+import threading
+from collections import OrderedDict, deque
+from . import lazy
+concurrent_futures = lazy.lazy_import("concurrent.futures")
+Image = lazy.lazy_import("PIL.Image")
+from . import io_tools
+from . import fragmenter
+from . import fragmentation_erosion
+
+
+# Endless stream of fragmentations for training loops: every epoch each image is fragmented again with a new seed.
+# With reuse_layout the seed points, Voronoi cells and combined fragments of an image are computed once and cached,
+# only erosion, colour degradation and rotation are drawn again; otherwise the whole fragmentation changes every epoch.
+
+
+class LRUCache:
+    # least recently used entries are dropped once the entries add up to more than max_bytes
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+    def put(self, key, value, size):
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)[1]
+            if size > self.max_bytes:
+                return
+            self.entries[key] = (value, size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                _, (_, dropped_size) = self.entries.popitem(last=False)
+                self.total_bytes -= dropped_size
+
+
+def image_bytes(image):
+    return image.width * image.height * len(image.getbands())
+
+
+class FragmentStream:
+    # iterates over (fragments, metadata) forever, or for epochs epochs. fragments maps each name to
+    # (point, diff, image, angle, params) as in a FragmentSet. Items are computed by workers threads, at most
+    # prefetch of them ahead of the consumer; decoded images and layouts share a cache of cache_bytes.
+    # Seeds only depend on seed, the image and the epoch, so the stream is the same for any number of workers
+
+    def __init__(self, images, fragmenter_config=None, seed=0, reuse_layout=True, shuffle=True, epochs=None,
+                 workers=2, prefetch=4, cache_bytes=1 << 30):
+        # images are paths or in memory PIL images / NumPy arrays, fragmenter_config a fragmenter.Fragmenter
+        self.images = list(images)
+        self.config = fragmenter_config or fragmenter.Fragmenter()
+        self.seed = seed
+        self.reuse_layout = reuse_layout
+        self.shuffle = shuffle
+        self.epochs = epochs
+        self.workers = workers
+        self.prefetch = prefetch
+        self.cache = LRUCache(cache_bytes)
+
+    def image_key(self, index):
+        image = self.images[index]
+        return os.path.basename(image) if isinstance(image, str) else index
+
+    def load_image(self, index):
+        image = self.images[index]
+        if not isinstance(image, str):
+            return fragmenter.as_image(image)
+        cached = self.cache.get(("image", index))
+        if cached is None:
+            cached = Image.open(image)
+            cached.load()
+            self.cache.put(("image", index), cached, image_bytes(cached))
+        return cached
+
+    def layout(self, index, image, layout_seed):
+        # the fragments before erosion, drawn from a random.Random of their own: the global random module of the
+        # training process is left alone
+        key = ("layout", index, layout_seed)
+        cached = self.cache.get(key)
+        if cached is None:
+            config = self.config
+            cached = fragmentation_erosion.cut_fragments(image, config.num_fragments, config.min_distance, layout_seed, config.sampler,
+                                                         merge_chain=config.merge_chain, rng=random.Random())
+            if self.reuse_layout:
+                self.cache.put(key, cached, sum(image_bytes(fragment[2]) for fragment in cached))
+        return cached
+
+    def order(self, epoch):
+        indices = list(range(len(self.images)))
+        if self.shuffle:
+            random.Random(io_tools.derive_seed(self.seed, "order", epoch)).shuffle(indices)
+        return indices
+
+    def item(self, epoch, index):
+        config = self.config
+        key = self.image_key(index)
+        seed = io_tools.derive_seed(self.seed, key, epoch)
+        layout_seed = io_tools.derive_seed(self.seed, key) if self.reuse_layout else seed
+
+        image = self.load_image(index)
+        cut = self.layout(index, image, layout_seed)
+        min_size = fragmentation_erosion.find_the_smallest_fragment(cut).size
+        seeds = fragmentation_erosion.fragment_seeds(seed, len(cut))
+        fragments = [fragmentation_erosion.erode_and_rotate(fragment, config.min_distance, config.erosion_probability,
+                                                            config.erosion_percentage, min_size, fragment_seed, config.rotation)
+                     for fragment, fragment_seed in zip(cut, seeds)]
+
+        names = io_tools.fragment_names(len(fragments))
+        result = fragmenter.FragmentSet(image, dict(zip(names, fragments)), dict(config.parameters(seed), layout_seed=layout_seed))
+        if config.removal_percentage != 0:
+            result = result.remove(config.removal_percentage, random.Random(seed))
+        metadata = {"image": key, "epoch": epoch, "seed": seed, "layout_seed": layout_seed, "width": image.width,
+                    "height": image.height, "removed": result.removed}
+        return result.fragments, metadata
+
+    def __iter__(self):
+        epochs = itertools.count() if self.epochs is None else range(self.epochs)
+        tasks = ((epoch, index) for epoch in epochs for index in self.order(epoch))
+        pending = deque()
+        executor = concurrent_futures.ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            for epoch, index in itertools.islice(tasks, self.prefetch):
+                pending.append(executor.submit(self.item, epoch, index))
+            while pending:
+                result = pending.popleft().result()
+                for epoch, index in itertools.islice(tasks, 1):
+                    pending.append(executor.submit(self.item, epoch, index))
+                yield result
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
@@ -1,99 +1,281 @@
 import os
 import sys 
-import cv2
+from . import lazy
+cv2 = lazy.lazy_import("cv2")
 import math
 from . import io_tools
+from . import fragment_io
+from . import instrumentation
+from . import geometry_cache
+from . import shared_source
 import random
-import numpy as np
-from PIL import Image, ImageDraw
+np = lazy.lazy_import("numpy")
+Image = lazy.lazy_import("PIL.Image")
+concurrent_futures = lazy.lazy_import("concurrent.futures")
 
 
-def generate_random_points(min_distance, seed, num_fragments, width, height):
-    if num_fragments == None:
-        num_fragments = int(math.sqrt(height * width))
+EROSION_MODES = ("fragment", "batch")
+ROTATION_MODES = ("expand", "tight")
+
+def max_points(distance, width, height):
+    # Oler's bound on how many points with pairwise distance >= distance fit in the image
+    if distance <= 0:
+        return float('inf')
+    return int(2 / math.sqrt(3) * width * height / distance ** 2 + (width + height) / distance + 1)
+
+
+def grid_cell(point, cell_size):
+    return (point[0] // cell_size, point[1] // cell_size)
+
+
+def is_far_enough(point, grid, distance):
+    # with cells as large as the distance only the 3x3 neighbourhood can hold a point too close
+    cell_x, cell_y = grid_cell(point, distance)
+    for i in range(cell_x - 1, cell_x + 2):
+        for j in range(cell_y - 1, cell_y + 2):
+            for other in grid.get((i, j), ()):
+                if euclidean_distance(point, other) < distance:
+                    return False
+    return True
 
+
+def add_to_grid(point, grid, distance):
+    grid.setdefault(grid_cell(point, distance), []).append(point)
+
+
+def rejection_points(distance, num_fragments, width, height, max_attempts, rng=random):
+    # same random.randint stream as the original sampler, so old datasets can be reproduced
     points = []
-    if seed != None:
-        random.seed(seed)
+    grid = {}
+    attempts = 0
 
     while len(points) < num_fragments:
-        x = random.randint(0, width)
-        y = random.randint(0, height)
-        valid = True
-
-        for point in points:
-            if euclidean_distance((x, y), point) < (2 * min_distance):
-                valid = False
-                break
+        x = rng.randint(0, width)
+        y = rng.randint(0, height)
 
-        if valid:
+        if distance <= 0 or is_far_enough((x, y), grid, distance):
             points.append((x, y))
+            if distance > 0:
+                add_to_grid((x, y), grid, distance)
+            attempts = 0
+        else:
+            attempts += 1
+            if attempts >= max_attempts:
+                raise RuntimeError(f"could not place fragment {len(points) + 1} of {num_fragments} after {max_attempts} attempts, "
+                                   f"lower num_fragments or min_distance")
 
     return points
 
 
-def euclidean_distance(p1, p2):
-    return math.sqrt((p1[0] - p2[0]) ** 2 + (p1[1] - p2[1]) ** 2)
+def poisson_disk_fill(distance, width, height, max_attempts, rng=random):
+    # Bridson's algorithm, adds points until no room is left in the image
+    first = (rng.randint(0, width), rng.randint(0, height))
+    points = [first]
+    active = [first]
+    grid = {}
+    add_to_grid(first, grid, distance)
+
+    while active:
+        index = rng.randrange(len(active))
+        base = active[index]
+        for _ in range(max_attempts):
+            radius = rng.uniform(distance, 2 * distance)
+            angle = rng.uniform(0, 2 * math.pi)
+            candidate = (int(round(base[0] + radius * math.cos(angle))), int(round(base[1] + radius * math.sin(angle))))
+            if 0 <= candidate[0] <= width and 0 <= candidate[1] <= height and is_far_enough(candidate, grid, distance):
+                points.append(candidate)
+                active.append(candidate)
+                add_to_grid(candidate, grid, distance)
+                break
+        else:
+            active[index] = active[-1]
+            active.pop()
 
+    return points
 
-def find_closest_cell(point, points):
-    closest_point = None
-    min_distance = float('inf')
 
-    for p in points:
-        distance = euclidean_distance(point, p)
-        if distance < min_distance:
-            min_distance = distance
-            closest_point = p
+def poisson_disk_points(distance, num_fragments, width, height, max_attempts, rng=random):
+    # a fill holds about width * height / (1.5 * spacing^2) points: the spacing is widened so that
+    # it yields roughly twice num_fragments, which are then drawn at random from it
+    spacing = max(distance, int(math.sqrt(width * height / (3 * num_fragments))))
+    points = poisson_disk_fill(spacing, width, height, max_attempts, rng)
+    if len(points) < num_fragments and spacing > distance:
+        points = poisson_disk_fill(distance, width, height, max_attempts, rng)
+
+    if len(points) < num_fragments:
+        raise RuntimeError(f"only {len(points)} of {num_fragments} fragments fit {distance} pixels apart, "
+                           f"lower num_fragments or min_distance")
+
+    return rng.sample(points, num_fragments)
+
+
+def generate_random_points(min_distance, seed, num_fragments, width, height, sampler="rejection", max_attempts=None, rng=random):
+    # rng is the random module by default, or a random.Random that leaves the global stream alone
+    if num_fragments == None:
+        num_fragments = int(math.sqrt(height * width))
 
-    return closest_point
+    distance = 2 * min_distance
+    capacity = max_points(distance, width, height)
+    if num_fragments > capacity:
+        raise ValueError(f"{num_fragments} fragments can't fit in a {width}x{height} image with min_distance {min_distance}, "
+                         f"at most {capacity} points are {distance} pixels apart")
 
+    if seed != None:
+        rng.seed(seed)
 
-def create_voronoi(width, height, points):
-    voronoi_cells = {point: [] for point in points}
+    if sampler == "poisson" and distance > 0:
+        return poisson_disk_points(distance, num_fragments, width, height, max_attempts or 30, rng)
+    elif sampler in ("rejection", "poisson"):
+        return rejection_points(distance, num_fragments, width, height, max_attempts or 10000, rng)
+    else:
+        raise ValueError(f"unknown sampler '{sampler}', expected 'rejection' or 'poisson'")
 
-    for x in range(width):
-        for y in range(height):
-            point = (x, y)
-            closest_point = find_closest_cell(point, points)
-            voronoi_cells[closest_point].append(point)
 
-    return voronoi_cells
+def euclidean_distance(p1, p2):
+    return math.sqrt((p1[0] - p2[0]) ** 2 + (p1[1] - p2[1]) ** 2)
 
 
-def create_fragment_image(voronoi_cells, input_image):
-    fragments = []
+def voronoi_tile(seeds, x0, y0, x1, y1):
+    # squared distance from each seed to the nearest and to the farthest pixel of the tile
+    seeds_x = seeds[:, 0]
+    seeds_y = seeds[:, 1]
+    near_x = np.maximum(np.maximum(x0 - seeds_x, seeds_x - (x1 - 1)), 0)
+    near_y = np.maximum(np.maximum(y0 - seeds_y, seeds_y - (y1 - 1)), 0)
+    far_x = np.maximum(np.abs(seeds_x - x0), np.abs(seeds_x - (x1 - 1)))
+    far_y = np.maximum(np.abs(seeds_y - y0), np.abs(seeds_y - (y1 - 1)))
+    near = near_x ** 2 + near_y ** 2
+    far = far_x ** 2 + far_y ** 2
+
+    # a seed whose nearest pixel is farther than some other seed's farthest pixel
+    # can't own any pixel of the tile
+    candidates = np.flatnonzero(near <= far.min())
+
+    xs = np.arange(x0, x1, dtype=np.int64)
+    ys = np.arange(y0, y1, dtype=np.int64)
+    candidate_x = seeds_x[candidates][:, None, None]
+    candidate_y = seeds_y[candidates][:, None, None]
+    distances = (xs[None, None, :] - candidate_x) ** 2 + (ys[None, :, None] - candidate_y) ** 2
+
+    # argmin keeps the first minimum, so ties go to the lowest seed index
+    return candidates[np.argmin(distances, axis=0)]
+
+
+def voronoi_region(points, x0, y0, x1, y1, tile_size=64, progress=None):
+    # labels of the pixels in [x0, x1) x [y0, y1), every tile is matched against the whole
+    # set of seeds, so a region gives the same labels it has in the full map;
+    # progress(rows_done, rows) is called after every row of tiles
+    seeds = np.asarray(points, dtype=np.int64).reshape(-1, 2)
+    label_map = np.empty((y1 - y0, x1 - x0), dtype=np.int32)
+
+    for tile_y in range(y0, y1, tile_size):
+        tile_y1 = min(tile_y + tile_size, y1)
+        for tile_x in range(x0, x1, tile_size):
+            tile_x1 = min(tile_x + tile_size, x1)
+            label_map[tile_y - y0:tile_y1 - y0, tile_x - x0:tile_x1 - x0] = voronoi_tile(seeds, tile_x, tile_y, tile_x1, tile_y1)
+        if progress is not None:
+            progress(tile_y1 - y0, y1 - y0)
+
+    return label_map
+
+
+def create_voronoi(width, height, points, tile_size=64, progress=None):
+    # label_map[y, x] is the index in points of the seed closest to pixel (x, y)
+    return voronoi_region(points, 0, 0, width, height, tile_size, progress)
+
+
+def cell_bounding_boxes(label_map, num_cells, origin=(0, 0)):
+    # run-length encode every row of the label map, then reduce the runs per label;
+    # origin is the image position of label_map[0, 0] when the map covers only a region
+    height, width = label_map.shape
+    flat = label_map.ravel()
+    starts = np.ones(flat.size, dtype=bool)
+    starts[1:] = flat[1:] != flat[:-1]
+    starts[::width] = True
+    run_starts = np.flatnonzero(starts)
+    run_ends = np.append(run_starts[1:], flat.size) - 1
+    run_labels = flat[run_starts]
+
+    min_x = np.full(num_cells, np.iinfo(np.int64).max, dtype=np.int64)
+    min_y = np.full(num_cells, np.iinfo(np.int64).max, dtype=np.int64)
+    max_x = np.full(num_cells, -1, dtype=np.int64)
+    max_y = np.full(num_cells, -1, dtype=np.int64)
+    np.minimum.at(min_x, run_labels, run_starts % width + origin[0])
+    np.minimum.at(min_y, run_labels, run_starts // width + origin[1])
+    np.maximum.at(max_x, run_labels, run_ends % width + origin[0])
+    np.maximum.at(max_y, run_labels, run_ends // width + origin[1])
+
+    return min_x, min_y, max_x, max_y
+
+
+def merge_bounding_boxes(first, second):
+    return (np.minimum(first[0], second[0]), np.minimum(first[1], second[1]),
+            np.maximum(first[2], second[2]), np.maximum(first[3], second[3]))
+
+
+def paste_cell(canvas, pixels, label_map, label, bounding_boxes, origin, region_origin=(0, 0)):
+    # pixels and label_map may cover only a region of the image, starting at region_origin
+    min_x, min_y, max_x, max_y = (int(value[label]) for value in bounding_boxes)
+    region_x = min_x - region_origin[0]
+    region_y = min_y - region_origin[1]
+    mask = label_map[region_y:region_y + max_y - min_y + 1, region_x:region_x + max_x - min_x + 1] == label
+    region = pixels[region_y:region_y + max_y - min_y + 1, region_x:region_x + max_x - min_x + 1]
+
+    # offset of the cell inside the canvas, pixels falling outside of it are dropped
+    offset_x = min_x - origin[0]
+    offset_y = min_y - origin[1]
+    x0 = max(0, -offset_x)
+    y0 = max(0, -offset_y)
+    x1 = min(mask.shape[1], canvas.shape[1] - offset_x)
+    y1 = min(mask.shape[0], canvas.shape[0] - offset_y)
+    if x1 <= x0 or y1 <= y0:
+        return
+
+    mask = mask[y0:y1, x0:x1]
+    target = canvas[offset_y + y0:offset_y + y1, offset_x + x0:offset_x + x1]
+    np.copyto(target, region[y0:y1, x0:x1], where=mask[:, :, np.newaxis])
+
+
+def image_to_array(image):
+    return np.asarray(image.convert("RGBA"))
+
+
+def cell_descriptors(points, bounding_boxes):
+    # (point, diff, size, labels) of every cell, the geometry of a fragment without its pixels
+    cells = []
+    min_x, min_y, max_x, max_y = bounding_boxes
 
-    for key in voronoi_cells.keys():
-        cell = voronoi_cells[key]
-        min_x = min(point[0] for point in cell)
-        max_x = max(point[0] for point in cell)
-        min_y = min(point[1] for point in cell)
-        max_y = max(point[1] for point in cell)
+    for label, key in enumerate(points):
+        # seeds on the image border may own no pixel at all
+        if max_x[label] < 0:
+            continue
+        diff = (int(min_x[label]), int(min_y[label]))
+        size = (int(max_x[label] - min_x[label] + 1), int(max_y[label] - min_y[label] + 1))
+        cells.append((key, diff, size, (label,)))
 
-        fragment_width = max_x - min_x + 1
-        fragment_height = max_y - min_y + 1
+    return cells
 
-        fragment_image = Image.new("RGBA", (fragment_width, fragment_height))
-        draw = ImageDraw.Draw(fragment_image)
 
-        diff = (min_x, min_y)
-        for point in cell:
-            x, y = point
-            pixel = input_image.getpixel((x, y))
-            draw.point((x - min_x, y - min_y), fill=pixel)
-        fragments.append((key, diff, fragment_image))
+def render_fragment(cell, pixels, label_map, bounding_boxes, region_origin=(0, 0)):
+    _, diff, size, labels = cell
+    fragment_array = np.zeros((size[1], size[0], 4), dtype=np.uint8)
+    for label in labels:
+        paste_cell(fragment_array, pixels, label_map, label, bounding_boxes, diff, region_origin)
+    return Image.fromarray(fragment_array, "RGBA")
+
 
-    return fragments
+def create_fragment_image(label_map, points, pixels):
+    bounding_boxes = cell_bounding_boxes(label_map, len(points))
+    cells = cell_descriptors(points, bounding_boxes)
+    return [(cell[0], cell[1], render_fragment(cell, pixels, label_map, bounding_boxes)) for cell in cells]
 
 
 def find_closest_fragment(selected_fragment, fragments):
     min_distance = float('inf')
     closest_fragment = None
-    sel_point, _, _= selected_fragment
+    sel_point = selected_fragment[0]
 
     for fragment in fragments:
-        point,_,_ = fragment
+        point = fragment[0]
         distance = euclidean_distance(sel_point, point)
         if distance < min_distance:
             min_distance = distance
@@ -102,58 +284,157 @@ def find_closest_fragment(selected_fragment, fragments):
     return closest_fragment
 
 
-def combine_fragment(fragments, voronoi_cells, image, num_combined_fragments):
-    selected_fragments = random.sample(fragments, num_combined_fragments)
-    combined_fragments = []
-    fragments_list = fragments
-
-    for removed_fragment in selected_fragments:
-        if removed_fragment in fragments:
-            fragments_list.remove(removed_fragment)
-
-    for selected_fragment in selected_fragments:
-        closest_fragment = find_closest_fragment(selected_fragment, fragments)
-        selected_cell = voronoi_cells[selected_fragment[0]]
-        closest_cell = voronoi_cells[closest_fragment[0]]
-
-        width = selected_fragment[2].width + closest_fragment[2].width
-        height = selected_fragment[2].height + closest_fragment[2].height
-
-        combined_fragment = Image.new("RGBA", (width, height))
-        draw = ImageDraw.Draw(combined_fragment)
-
-        x = int((selected_fragment[0][0] + closest_fragment[0][0])/2)
-        y = int((selected_fragment[0][1] + closest_fragment[0][1])/2)
-
-        combined_point = (x, y)
-
-        if selected_fragment[0][0] < closest_fragment[0][0]:
-            min_x = selected_fragment[1][0]
-        else:
-            min_x = closest_fragment[1][0]
-
-        if selected_fragment[0][1] < closest_fragment[0][1]:
-            min_y = selected_fragment[1][1]
-        else:
-            min_y = closest_fragment[1][1]
-
-        diff = (min_x, min_y)
-
-        for point in selected_cell:
-            x, y = point
-            pixel = image.getpixel((x, y))
-            draw.point((x - min_x, y - min_y), fill=pixel)
-        for point in closest_cell:
-            x, y = point
-            pixel = image.getpixel((x, y))
-            draw.point((x - min_x, y - min_y), fill=pixel)
+def seed_grid(cells):
+    # grid of the cell seeds with cells about as large as the mean spacing of the seeds,
+    # (grid, cell_size, bounds) where bounds are the first and last grid cells holding a seed
+    xs = [cell[0][0] for cell in cells]
+    ys = [cell[0][1] for cell in cells]
+    area = (max(xs) - min(xs) + 1) * (max(ys) - min(ys) + 1)
+    cell_size = max(1, int(math.sqrt(area / len(cells))))
+    grid = {}
+    for index, cell in enumerate(cells):
+        grid.setdefault(grid_cell(cell[0], cell_size), []).append(index)
+    bounds = (grid_cell((min(xs), min(ys)), cell_size), grid_cell((max(xs), max(ys)), cell_size))
+    return grid, cell_size, bounds
+
+
+def closest_in_grid(point, cells, grid, cell_size, bounds):
+    # index of the cell whose seed is closest to point, the first one in cells on ties, as find_closest_fragment;
+    # rings of grid cells are visited outwards until no closer seed can be left
+    cell_x, cell_y = grid_cell(point, cell_size)
+    (first_x, first_y), (last_x, last_y) = bounds
+    max_ring = max(cell_x - first_x, last_x - cell_x, cell_y - first_y, last_y - cell_y)
+    best = None
+    best_distance = float('inf')
+
+    for ring in range(max_ring + 1):
+        for i in range(cell_x - ring, cell_x + ring + 1):
+            for j in range(cell_y - ring, cell_y + ring + 1):
+                if max(abs(i - cell_x), abs(j - cell_y)) != ring:
+                    continue
+                for index in grid.get((i, j), ()):
+                    distance = euclidean_distance(point, cells[index][0])
+                    if distance < best_distance or (distance == best_distance and index < best):
+                        best = index
+                        best_distance = distance
+        # seeds beyond this ring are at least ring * cell_size away
+        if best_distance < ring * cell_size:
+            break
+
+    return best
+
+
+def cell_neighbours(label_map, neighbours=None):
+    # Voronoi adjacency, label -> set of the labels sharing an edge with it; pass the neighbours of the
+    # regions already seen to add those of another region
+    if neighbours is None:
+        neighbours = {}
+    # every pair of labels is packed in one integer, the lower label in the high bits
+    pairs = []
+    for first, second in ((label_map[:, :-1], label_map[:, 1:]), (label_map[:-1, :], label_map[1:, :])):
+        different = first != second
+        first = first[different].astype(np.int64)
+        second = second[different].astype(np.int64)
+        pairs.append((np.minimum(first, second) << 32) | np.maximum(first, second))
+    for pair in np.unique(np.concatenate(pairs)).tolist():
+        first, second = pair >> 32, pair & 0xFFFFFFFF
+        neighbours.setdefault(first, set()).add(second)
+        neighbours.setdefault(second, set()).add(first)
+    return neighbours
+
+
+def merge_chain_cells(chain):
+    # one cell covering all the cells of chain: the mean of the seeds, the union of the bounding boxes
+    x0 = min(cell[1][0] for cell in chain)
+    y0 = min(cell[1][1] for cell in chain)
+    x1 = max(cell[1][0] + cell[2][0] for cell in chain)
+    y1 = max(cell[1][1] + cell[2][1] for cell in chain)
+    point = (sum(cell[0][0] for cell in chain) // len(chain), sum(cell[0][1] for cell in chain) // len(chain))
+    return (point, (x0, y0), (x1 - x0, y1 - y0), tuple(label for cell in chain for label in cell[3]))
+
+
+def combine_cells(cells, num_combined_fragments, merge_chain=None, neighbours=None, rng=random):
+    # merges num_combined_fragments random cells with their closest one, then shuffles the list;
+    # only the geometry is touched, pixels are cut later by render_fragment.
+    # With merge_chain, every selected cell instead grows into a chain of 2 to merge_chain adjacent cells,
+    # neighbours is the Voronoi adjacency of cell_neighbours
+    if merge_chain is not None and merge_chain < 2:
+        raise ValueError(f"merge_chain must be at least 2, got {merge_chain}")
+    selected = rng.sample(range(len(cells)), num_combined_fragments)
+    taken = set(selected)
+    combined_cells = []
+
+    if merge_chain is not None:
+        owner = {cell[3][0]: index for index, cell in enumerate(cells)}
+        for index in selected:
+            length = rng.randint(2, merge_chain)
+            chain = [index]
+            while len(chain) < length:
+                candidates = sorted({owner[label] for member in chain for label in neighbours.get(cells[member][3][0], ())
+                                     if label in owner} - taken)
+                if not candidates:
+                    break
+                chain.append(rng.choice(candidates))
+                taken.add(chain[-1])
+            combined_cells.append(merge_chain_cells([cells[member] for member in chain]))
+    else:
+        grid, cell_size, bounds = seed_grid(cells)
+        for index in selected:
+            grid[grid_cell(cells[index][0], cell_size)].remove(index)
+
+        for index in selected:
+            selected_cell = cells[index]
+            closest = closest_in_grid(selected_cell[0], cells, grid, cell_size, bounds)
+            grid[grid_cell(cells[closest][0], cell_size)].remove(closest)
+            taken.add(closest)
+            closest_cell = cells[closest]
+            width = selected_cell[2][0] + closest_cell[2][0]
+            height = selected_cell[2][1] + closest_cell[2][1]
+
+            x = int((selected_cell[0][0] + closest_cell[0][0])/2)
+            y = int((selected_cell[0][1] + closest_cell[0][1])/2)
+
+            combined_point = (x, y)
+
+            if selected_cell[0][0] < closest_cell[0][0]:
+                min_x = selected_cell[1][0]
+            else:
+                min_x = closest_cell[1][0]
+
+            if selected_cell[0][1] < closest_cell[0][1]:
+                min_y = selected_cell[1][1]
+            else:
+                min_y = closest_cell[1][1]
+
+            diff = (min_x, min_y)
+            combined_cells.append((combined_point, diff, (width, height), selected_cell[3] + closest_cell[3]))
+
+    cells_list = [cell for index, cell in enumerate(cells) if index not in taken]
+    cells_list.extend(combined_cells)
+    rng.shuffle(cells_list)
+    return cells_list
+
+
+def combine_fragment(fragments, label_map, points, pixels, num_combined_fragments):
+    labels = {point: label for label, point in enumerate(points)}
+    bounding_boxes = cell_bounding_boxes(label_map, len(points))
+    cells = [(point, diff, image.size, (labels[point],)) for point, diff, image in fragments]
+    cells = combine_cells(cells, num_combined_fragments)
+    return [(cell[0], cell[1], render_fragment(cell, pixels, label_map, bounding_boxes)) for cell in cells]
+
+
+def smallest_cell_size(cells):
+    # size of the cell with the smallest bounding box, as find_the_smallest_fragment does for images
+    min_dimension = float('inf')
+    smallest_size = None
 
-        fragments_list.remove(closest_fragment)
-        combined_fragments.append((combined_point, diff, combined_fragment))
+    for _, _, size, _ in cells:
+        dimension = size[0] * size[1]
+        if dimension < min_dimension:
+            min_dimension = dimension
+            smallest_size = size
 
-    fragments_list.extend(combined_fragments)
-    random.shuffle(fragments_list)
-    return fragments_list
+    return smallest_size
 
 
 def find_the_smallest_fragment(fragments):
@@ -170,16 +451,13 @@ def find_the_smallest_fragment(fragments):
     return smallest_fragment
 
 
-def apply_random_color_degradation(fragment):
+def degrade_colors(fragment, s_degradation_factor, v_degradation_factor):
 
     # implementare hsv (lavorando su s e v, non h)
     r,g,b,a = fragment.split()
     cl_image = Image.merge('RGB', (r,g,b))
     fragment_array = cv2.cvtColor(np.array(cl_image), cv2.COLOR_RGB2HSV)
 
-    s_degradation_factor = random.uniform(0.5, 1)
-    v_degradation_factor = random.uniform(0.8, 1)
-
     fragment_array[:, :, 1] = fragment_array[:, :, 1] * s_degradation_factor
     fragment_array[:, :, 2] = fragment_array[:, :, 2] * v_degradation_factor
 
@@ -191,120 +469,719 @@ def apply_random_color_degradation(fragment):
     return degraded_image
 
 
-def fragment_erosion(fragments, min_distance, erosion_probability, erosion_percentage):
-    eroded_fragments = []
+def apply_random_color_degradation(fragment, rng=random):
+    s_degradation_factor = rng.uniform(0.5, 1)
+    v_degradation_factor = rng.uniform(0.8, 1)
+    return degrade_colors(fragment, s_degradation_factor, v_degradation_factor)
+
+
+def erosion_mask(fragment_array, min_distance, erosion_probability, erosion_percentage, min_size, rng=random):
+    # the mask of the pixels of an RGBA fragment array that erosion keeps (non zero ones) and the parameters
+    # drawn for it, the colour degradation factors included
     probability = 1 - erosion_probability
+    gray_array = cv2.cvtColor(fragment_array, cv2.COLOR_RGBA2GRAY)
+    params = {"eroded": False, "erosion_kernel": 0, "erosion_angle": 0.0}
+
+    this_erosion_probability = rng.random()
+
+    # first erosion
+    if this_erosion_probability >= probability:
+        total_fragment_pixel = cv2.countNonZero(gray_array)
+        ksize = int(math.sqrt(total_fragment_pixel) * erosion_percentage * 0.01)
+        angle = rng.uniform(0, 360)
+        kernel_size = (ksize, ksize)
+        rotation = cv2.getRotationMatrix2D((kernel_size[0] // 2, kernel_size[1] // 2), angle, 1)
+        kernel = cv2.getStructuringElement(cv2.MORPH_RECT, kernel_size)
+        kernel_rotated = cv2.warpAffine(kernel, rotation, kernel_size, borderMode=cv2.BORDER_CONSTANT)
+        gray_array = cv2.erode(gray_array, kernel_rotated, iterations=1)
+        params.update(eroded=True, erosion_kernel=ksize, erosion_angle=angle)
+
+    # second erosion
+    radius = rng.randint(min_distance//2, max(min_size[0], min_size[1])//2)
+    # radius = random.randint(1, min_distance//2)
+    kernel = np.ones((radius, radius), np.float32) / (radius ** 2)
+    gray_array = cv2.filter2D(gray_array, -1, kernel)
+
+    s_degradation_factor = rng.uniform(0.5, 1)
+    v_degradation_factor = rng.uniform(0.8, 1)
+    params.update(blur_radius=radius, saturation_factor=s_degradation_factor, value_factor=v_degradation_factor)
+    return gray_array, params
+
+
+def erode_fragment(fragment, min_distance, erosion_probability, erosion_percentage, min_size, rng=random):
+    # returns the eroded fragment and the parameters drawn for it
+    fragment_array = np.array(fragment)
+    mask, params = erosion_mask(fragment_array, min_distance, erosion_probability, erosion_percentage, min_size, rng)
+    fragment_array = cv2.bitwise_and(fragment_array, fragment_array, mask=mask)
+    eroded_fragment = Image.fromarray(fragment_array)
+    return degrade_colors(eroded_fragment, params["saturation_factor"], params["value_factor"]), params
+
+
+def fragment_erosion(fragments, min_distance, erosion_probability, erosion_percentage, progress=None):
+    eroded_fragments = []
     smallest_fragment = find_the_smallest_fragment(fragments)
     min_size = smallest_fragment.size
 
-    for point, diff,fragment in fragments:
+    for point, diff, fragment in fragments:
+        eroded_fragment, params = erode_fragment(fragment, min_distance, erosion_probability, erosion_percentage, min_size)
+        eroded_fragments.append((point, diff, eroded_fragment, params))
+        if progress is not None:
+            progress(len(eroded_fragments), len(fragments))
 
-        size = fragment.size
-        fragment_array = np.array(fragment)
-        gray_array = cv2.cvtColor(fragment_array, cv2.COLOR_RGBA2GRAY)
-
-
-        this_erosion_probability = random.random()
-
-        # first erosion
-        if this_erosion_probability >= probability:
-            total_fragment_pixel = cv2.countNonZero(gray_array)
-            ksize = int(math.sqrt(total_fragment_pixel) * erosion_percentage * 0.01)
-            angle = random.uniform(0, 360)
-            kernel_size = (ksize, ksize)
-            rotation = cv2.getRotationMatrix2D((kernel_size[0] // 2, kernel_size[1] // 2), angle, 1)
-            kernel = cv2.getStructuringElement(cv2.MORPH_RECT, kernel_size)
-            kernel_rotated = cv2.warpAffine(kernel, rotation, kernel_size, borderMode=cv2.BORDER_CONSTANT)
-            gray_array = cv2.erode(gray_array, kernel_rotated, iterations=1)
+    return eroded_fragments
 
-        # second erosion
-        radius = random.randint(min_distance//2, max(min_size[0], min_size[1])//2)
-        # radius = random.randint(1, min_distance//2)
-        kernel = np.ones((radius, radius), np.float32) / (radius ** 2)
-        gray_array = cv2.filter2D(gray_array, -1, kernel)
-        fragment_array = cv2.bitwise_and(fragment_array, fragment_array, mask=gray_array)
-        eroded_fragment = Image.fromarray(fragment_array)
-        eroded_fragment = apply_random_color_degradation(eroded_fragment)
-        eroded_fragments.append((point, diff, eroded_fragment))
 
+def fragment_owners(cells, label_map, bounding_boxes):
+    # index in cells of the fragment every pixel ends up in, -1 where the pixel falls outside the canvas of its
+    # fragment: a single cell always fits its canvas, a combined one is cut on a canvas that may miss part of it
+    relabel = np.zeros(len(bounding_boxes[0]), dtype=np.int32)
+    for index, (_, _, _, labels) in enumerate(cells):
+        relabel[list(labels)] = index
+    owners = relabel[label_map]
+
+    for index, (_, diff, size, labels) in enumerate(cells):
+        if len(labels) == 1:
+            continue
+        for label in labels:
+            min_x, min_y, max_x, max_y = (int(value[label]) for value in bounding_boxes)
+            region = owners[min_y:max_y + 1, min_x:max_x + 1]
+            xs = np.arange(min_x, max_x + 1)[np.newaxis, :]
+            ys = np.arange(min_y, max_y + 1)[:, np.newaxis]
+            outside = (xs < diff[0]) | (xs >= diff[0] + size[0]) | (ys < diff[1]) | (ys >= diff[1] + size[1])
+            region[outside & (label_map[min_y:max_y + 1, min_x:max_x + 1] == label)] = -1
+    return owners
+
+
+def signed_distances(owners, gray):
+    # for the pixels with colour, the distance to the nearest pixel without colour or of another fragment;
+    # for the pixels without, minus the distance to the nearest one with colour
+    solid = (owners >= 0) & (gray != 0)
+    edges = ~solid
+    horizontal = owners[:, 1:] != owners[:, :-1]
+    vertical = owners[1:, :] != owners[:-1, :]
+    edges[:, 1:] |= horizontal
+    edges[:, :-1] |= horizontal
+    edges[1:, :] |= vertical
+    edges[:-1, :] |= vertical
+
+    distances = cv2.distanceTransform((~edges).view(np.uint8), cv2.DIST_L2, 5)
+    holes = ~solid & (owners >= 0)
+    if holes.any():
+        distances[holes] = -cv2.distanceTransform((~solid).view(np.uint8), cv2.DIST_L2, 5)[holes]
+    return distances
+
+
+def batch_degrade(cells, pixels, label_map, bounding_boxes, min_distance, erosion_probability, erosion_percentage, rng=random, strip_rows=256):
+    # erosion and colour degradation of every cell at once, on the whole image instead of fragment by fragment.
+    # The parameters are drawn as erode_fragment draws them, in the same order; the rotated kernel erosion
+    # followed by the box blur is approximated by keeping the pixels at least (kernel - radius) / 2 away from the
+    # border of their fragment (the erosion angle is still drawn and recorded). The colours are degraded with the
+    # same factors as degrade_colors, up to one level where OpenCV's vectorised and scalar HSV to RGB conversions
+    # round differently. Returns the degraded RGBA image, transparent where eroded, and the parameters of every cell
+    probability = 1 - erosion_probability
+    min_size = smallest_cell_size(cells)
+    owners = fragment_owners(cells, label_map, bounding_boxes)
+    gray = cv2.cvtColor(np.ascontiguousarray(pixels), cv2.COLOR_RGBA2GRAY)
+    pixel_counts = np.bincount(owners[(owners >= 0) & (gray != 0)], minlength=len(cells))
+
+    thresholds = np.zeros(len(cells))
+    saturation = np.ones(len(cells))
+    value = np.ones(len(cells))
+    all_params = []
+    for index in range(len(cells)):
+        params = {"eroded": False, "erosion_kernel": 0, "erosion_angle": 0.0}
+        if rng.random() >= probability:
+            ksize = int(math.sqrt(pixel_counts[index]) * erosion_percentage * 0.01)
+            params.update(eroded=True, erosion_kernel=ksize, erosion_angle=rng.uniform(0, 360))
+        radius = rng.randint(min_distance//2, max(min_size[0], min_size[1])//2)
+        params.update(blur_radius=radius, saturation_factor=rng.uniform(0.5, 1), value_factor=rng.uniform(0.8, 1))
+        thresholds[index] = (params["erosion_kernel"] - radius) / 2
+        saturation[index] = params["saturation_factor"]
+        value[index] = params["value_factor"]
+        all_params.append(params)
+
+    distances = signed_distances(owners, gray)
+    degraded = np.empty(pixels.shape, dtype=np.uint8)
+    # strip_rows rows at a time, so the per pixel factors never cover the whole image
+    for y0 in range(0, pixels.shape[0], strip_rows):
+        y1 = min(y0 + strip_rows, pixels.shape[0])
+        strip_owners = owners[y0:y1]
+        hsv = cv2.cvtColor(np.ascontiguousarray(pixels[y0:y1, :, :3]), cv2.COLOR_RGB2HSV)
+        hsv[:, :, 1] = hsv[:, :, 1] * saturation[strip_owners]
+        hsv[:, :, 2] = hsv[:, :, 2] * value[strip_owners]
+        strip = degraded[y0:y1]
+        strip[:, :, :3] = cv2.cvtColor(hsv, cv2.COLOR_HSV2RGB)
+        strip[:, :, 3] = pixels[y0:y1, :, 3]
+        strip[(strip_owners < 0) | (distances[y0:y1] < thresholds[strip_owners])] = 0
+    return degraded, all_params
+
+
+def batch_erosion(cells, pixels, label_map, bounding_boxes, min_distance, erosion_probability, erosion_percentage, rng=random, progress=None):
+    # batch_degrade with the fragments cut out, (point, diff, image, params) like fragment_erosion
+    degraded, all_params = batch_degrade(cells, pixels, label_map, bounding_boxes, min_distance, erosion_probability, erosion_percentage, rng)
+    eroded_fragments = []
+    for cell, params in zip(cells, all_params):
+        eroded_fragments.append((cell[0], cell[1], render_fragment(cell, degraded, label_map, bounding_boxes), params))
+        if progress is not None:
+            progress(len(eroded_fragments), len(cells))
     return eroded_fragments
 
 
-def rotate_fragment(fragments):
+def tight_rotation(alpha, diff, angle):
+    # rotate(angle, expand=True) done with cv2.warpAffine and cropped to the pixels alpha keeps after the rotation.
+    # Returns (forward, size, affine, diff): forward maps the fragment to the stored pixels, size is the stored
+    # size, affine maps the stored pixels to image coordinates and diff puts the stored fragment around the
+    # centre of its footprint, for readers that don't know about the affine
+    height, width = alpha.shape
+    rotation = cv2.getRotationMatrix2D(((width - 1) / 2, (height - 1) / 2), angle, 1.0)
+    corners = np.array([[-0.5, -0.5, 1], [width - 0.5, -0.5, 1], [-0.5, height - 0.5, 1], [width - 0.5, height - 0.5, 1]]) @ rotation.T
+    low = corners.min(axis=0)
+    expanded = np.ceil(corners.max(axis=0) - low - 1e-6).astype(int)
+    rotation[:, 2] -= low + 0.5
+
+    ys, xs = np.nonzero(cv2.warpAffine(alpha, rotation, (int(expanded[0]), int(expanded[1])), flags=cv2.INTER_NEAREST))
+    if len(xs) == 0:
+        x0, y0, x1, y1 = 0, 0, 1, 1
+    else:
+        x0, y0, x1, y1 = int(xs.min()), int(ys.min()), int(xs.max()) + 1, int(ys.max()) + 1
+    forward = rotation.copy()
+    forward[:, 2] -= (x0, y0)
+
+    affine = cv2.invertAffineTransform(forward)
+    affine[:, 2] += diff
+    size = (x1 - x0, y1 - y0)
+    center = affine @ ((size[0] - 1) / 2, (size[1] - 1) / 2, 1)
+    stored_diff = (int(round(center[0] - (size[0] - 1) / 2)), int(round(center[1] - (size[1] - 1) / 2)))
+    return forward, size, affine, stored_diff
+
+
+def warp_fragment(fragment_array, forward, size):
+    return Image.fromarray(cv2.warpAffine(np.ascontiguousarray(fragment_array), forward, size, flags=cv2.INTER_NEAREST))
+
+
+def check_rotation(rotation):
+    if rotation not in ROTATION_MODES:
+        raise ValueError(f"unknown rotation '{rotation}', expected one of {', '.join(ROTATION_MODES)}")
+
+
+def rotate_single_fragment(fragment, rng=random, rotation="expand"):
+    # fragment is (point, diff, image, params) as returned by fragment_erosion. rotation "tight" crops the rotated
+    # fragment to its visible pixels and adds the affine that puts it back to params, see tight_rotation
+    angle = rng.uniform(0, 360)
+    point, diff, fragment_to_rotate, params = fragment
+    if rotation == "tight":
+        fragment_array = np.asarray(fragment_to_rotate.convert("RGBA"))
+        forward, size, affine, stored_diff = tight_rotation(fragment_array[:, :, 3], diff, angle)
+        return (point, stored_diff, warp_fragment(fragment_array, forward, size), angle, dict(params, **io_tools.affine_columns(affine)))
+    size = fragment_to_rotate.size
+    rotated_fragment = fragment_to_rotate.rotate(angle, expand=True)
+    size_rotate = rotated_fragment.size
+    diff_x = diff[0] - ((size_rotate[0] - size[0])//2)
+    diff_y = diff[1] - ((size_rotate[1] - size[1])//2)
+    return (point, (diff_x, diff_y), rotated_fragment, angle, params)
+
+
+def rotate_fragment(fragments, progress=None, rotation="expand"):
     rotate_fragments = []
 
     for fragment in fragments:
-        angle = random.uniform(0, 360)
-        point, diff, fragment_to_rotate = fragment
-        size = fragment_to_rotate.size
-        rotated_fragment = fragment_to_rotate.rotate(angle, expand=True)
-        size_rotate = rotated_fragment.size
-        diff_x = diff[0] - ((size_rotate[0] - size[0])//2)
-        diff_y = diff[1] - ((size_rotate[1] - size[1])//2)
-        rotate_fragments.append((point, (diff_x, diff_y), rotated_fragment, angle))
+        rotate_fragments.append(rotate_single_fragment(fragment, rotation=rotation))
+        if progress is not None:
+            progress(len(rotate_fragments), len(fragments))
     return rotate_fragments
 
 
-def save_fragments_to_folder(fragments, folder_path):
-    n = len(str(len(fragments)-1)) 
-    for i, fragment in enumerate(fragments):
-        # Define the file path for the fragment
-        index = str(i).zfill(n)
-        file_path = os.path.join(folder_path, f'fragment_{index}.png')
-        # Save the fragment as a PNG image
-        fragment[2].save(file_path, 'PNG')
+def rotated_size(size, angle):
+    # size of an image of the given size after rotate(angle, expand=True), from an empty bilevel image
+    return Image.new("1", size).rotate(angle, expand=True).size
+
+
+class FragmentSource:
+    # what the fragments of an image are cut from, shared by all of them
+
+    __slots__ = ("pixels", "label_map", "bounding_boxes")
+
+    def __init__(self, pixels, label_map, bounding_boxes):
+        self.pixels = pixels
+        self.label_map = label_map
+        self.bounding_boxes = bounding_boxes
+
+
+class Fragment:
+    # a fragment kept as a record instead of an image: the cell it is cut from, the packed mask of the pixels
+    # erosion kept, the parameters and the angle drawn for it. image builds the RGBA image on demand, the same one
+    # erode_fragment and rotate_single_fragment produce, and doesn't keep it. A Fragment unpacks like the
+    # (point, diff, image, angle, params) tuples of rotate_fragment; degrade is False when the source is degraded already.
+    # transform is (forward, size) of tight_rotation for fragments rotated with rotation "tight"
+
+    __slots__ = ("point", "diff", "cell", "source", "mask", "params", "angle", "degrade", "transform")
+
+    def __init__(self, cell, source, degrade=True):
+        self.point = cell[0]
+        self.diff = cell[1]
+        self.cell = cell
+        self.source = source
+        self.mask = None
+        self.params = None
+        self.angle = None
+        self.degrade = degrade
+        self.transform = None
+
+    def cut(self):
+        # the RGBA array of the cell, before erosion
+        source = self.source
+        _, diff, size, labels = self.cell
+        fragment_array = np.zeros((size[1], size[0], 4), dtype=np.uint8)
+        for label in labels:
+            paste_cell(fragment_array, source.pixels, source.label_map, label, source.bounding_boxes, diff)
+        return fragment_array
+
+    def set_mask(self, mask):
+        self.mask = np.packbits(mask != 0)
+
+    def masked(self):
+        # the RGBA array of the cell with the pixels erosion removed, before colour degradation
+        fragment_array = self.cut()
+        if self.mask is not None:
+            size = self.cell[2]
+            mask = np.unpackbits(self.mask, count=size[0] * size[1]).reshape(size[1], size[0])
+            fragment_array = cv2.bitwise_and(fragment_array, fragment_array, mask=mask)
+        return fragment_array
+
+    def eroded(self):
+        eroded_fragment = Image.fromarray(self.masked())
+        if self.params is None or not self.degrade:
+            return eroded_fragment
+        return degrade_colors(eroded_fragment, self.params["saturation_factor"], self.params["value_factor"])
+
+    @property
+    def image(self):
+        if self.angle is None:
+            return self.eroded()
+        if self.transform is not None:
+            return warp_fragment(np.asarray(self.eroded()), *self.transform)
+        return self.eroded().rotate(self.angle, expand=True)
+
+    def rotate(self, angle, rotation="expand"):
+        # what rotate_single_fragment does, without touching the pixels; a tight rotation only needs the alpha
+        # channel, which colour degradation doesn't change
+        self.angle = angle
+        if rotation == "tight":
+            forward, size, affine, self.diff = tight_rotation(self.masked()[:, :, 3], self.cell[1], angle)
+            self.transform = (forward, size)
+            self.params = dict(self.params or {}, **io_tools.affine_columns(affine))
+            return
+        size = self.cell[2]
+        size_rotate = rotated_size(size, angle)
+        self.diff = (self.cell[1][0] - ((size_rotate[0] - size[0])//2), self.cell[1][1] - ((size_rotate[1] - size[1])//2))
+
+    def __len__(self):
+        return 5
+
+    def __iter__(self):
+        return iter((self.point, self.diff, self.image, self.angle, self.params))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return tuple(self)[index]
+        if index in (2, -3):
+            return self.image
+        return (self.point, self.diff, None, self.angle, self.params)[index]
+
+
+def fragment_records(cells, source, degrade=True):
+    return [Fragment(cell, source, degrade) for cell in cells]
+
+
+def erode_records(fragments, min_distance, erosion_probability, erosion_percentage, progress=None):
+    # fragment_erosion on Fragment records: only the masks and the parameters are kept, in the same random stream
+    min_size = smallest_cell_size([fragment.cell for fragment in fragments])
+
+    for done, fragment in enumerate(fragments, 1):
+        mask, fragment.params = erosion_mask(fragment.cut(), min_distance, erosion_probability, erosion_percentage, min_size)
+        fragment.set_mask(mask)
+        if progress is not None:
+            progress(done, len(fragments))
+    return fragments
+
+
+def rotate_records(fragments, progress=None, rotation="expand"):
+    # rotate_fragment on Fragment records, the angles are drawn in the same random stream
+    for done, fragment in enumerate(fragments, 1):
+        fragment.rotate(random.uniform(0, 360), rotation)
+        if progress is not None:
+            progress(done, len(fragments))
+    return fragments
+
+
+def fragment_seeds(seed, num_fragments):
+    # one independent stream per fragment, so results don't depend on how the fragments are scheduled
+    if seed is None:
+        return [random.getrandbits(64) for _ in range(num_fragments)]
+    return [io_tools.derive_seed(seed, "fragment", i) for i in range(num_fragments)]
+
+
+def erode_and_rotate(fragment, min_distance, erosion_probability, erosion_percentage, min_size, fragment_seed, rotation="expand"):
+    rng = random.Random(fragment_seed)
+    point, diff, fragment_image = fragment
+    eroded_fragment, params = erode_fragment(fragment_image, min_distance, erosion_probability, erosion_percentage, min_size, rng)
+    return rotate_single_fragment((point, diff, eroded_fragment, params), rng, rotation)
+
+
+def parallel_erosion_rotation(fragments, min_distance, erosion_probability, erosion_percentage, seed, workers, executor="thread",
+                              rotation="expand"):
+    # OpenCV and PIL release the GIL in erode, filter2D, cvtColor and rotate, threads are usually enough.
+    # Fragments are yielded in order as soon as they are ready, so they can be saved while the rest is processed
+    smallest_fragment = find_the_smallest_fragment(fragments)
+    min_size = smallest_fragment.size
+    seeds = fragment_seeds(seed, len(fragments))
+
+    if executor == "process":
+        pool = concurrent_futures.ProcessPoolExecutor(max_workers=workers)
+    elif executor == "thread":
+        pool = concurrent_futures.ThreadPoolExecutor(max_workers=workers)
+    else:
+        raise ValueError(f"unknown executor '{executor}', expected 'thread' or 'process'")
+
+    with pool:
+        tasks = [pool.submit(erode_and_rotate, fragment, min_distance, erosion_probability, erosion_percentage, min_size, fragment_seed, rotation)
+                 for fragment, fragment_seed in zip(fragments, seeds)]
+        for task in tasks:
+            yield task.result()
+
+
+# the FragmentSource of a process pool worker of shared_erosion_rotation
+WORKER_SOURCE = None
+
+
+def attach_worker_source(descriptor):
+    global WORKER_SOURCE
+    WORKER_SOURCE = FragmentSource(*shared_source.attach(descriptor))
+
+
+def cut_erode_and_rotate(cell, min_distance, erosion_probability, erosion_percentage, min_size, fragment_seed, rotation="expand"):
+    source = WORKER_SOURCE
+    fragment = (cell[0], cell[1], render_fragment(cell, source.pixels, source.label_map, source.bounding_boxes))
+    return erode_and_rotate(fragment, min_distance, erosion_probability, erosion_percentage, min_size, fragment_seed, rotation)
 
 
-def save_info(fragments, path):
-    n = len(str(len(fragments)-1))
-    for i, fragment in enumerate(fragments):
-        coordinate, diff, _, angle = fragment
-        index = str(i).zfill(n)
-        with open(f"{path}/fragment_info.txt", "a") as info_file:
-            file_path = f"fragment_{index}"
-            info_file.write(f"{file_path}: {coordinate}; {diff}; {angle}\n")
-            info_file.write("\n")
+def shared_erosion_rotation(cells, shared, min_distance, erosion_probability, erosion_percentage, seed, workers, rotation="expand"):
+    # parallel_erosion_rotation on processes that cut the fragments themselves: the pixels, label map and bounding boxes
+    # are published once in shared, a shared_source.SharedSource closed at the end, and the workers only receive the
+    # cells. The fragments are the same, in the same order
+    min_size = smallest_cell_size(cells)
+    seeds = fragment_seeds(seed, len(cells))
 
+    with shared:
+        with concurrent_futures.ProcessPoolExecutor(max_workers=workers, initializer=attach_worker_source, initargs=(shared.descriptor,)) as pool:
+            tasks = [pool.submit(cut_erode_and_rotate, cell, min_distance, erosion_probability, erosion_percentage, min_size, fragment_seed,
+                                 rotation)
+                     for cell, fragment_seed in zip(cells, seeds)]
+            for task in tasks:
+                yield task.result()
 
-def generate_info(resources_path, seed, num_fragments, min_distance, erosion_probability, erosion_percentage):
+
+def save_fragments_to_folder(fragments, folder_path, fragment_format="png", compress_level=None, workers=4):
+    names = io_tools.fragment_names(len(fragments))
+    with fragment_io.FragmentWriter(folder_path, fragment_format, compress_level, workers) as writer:
+        for name, fragment in zip(names, fragments):
+            writer.write(name, fragment[2])
+
+
+def fragment_stats(image):
+    alpha = np.asarray(image.getchannel("A"))
+    ys, xs = np.nonzero(alpha)
+    if len(xs) == 0:
+        return 0, (0, 0, 0, 0)
+    return len(xs), (int(xs.min()), int(ys.min()), int(xs.max()) + 1, int(ys.max()) + 1)
+
+
+def fragment_record(name, fragment):
+    # one row of fragment_info.json
+    coordinate, diff, image, angle, params = fragment
+    pixel_count, bbox = fragment_stats(image)
+    return dict(params, name=name, x=coordinate[0], y=coordinate[1], diff_x=diff[0], diff_y=diff[1], angle=angle,
+                width=image.width, height=image.height, pixel_count=pixel_count,
+                bbox_x0=bbox[0], bbox_y0=bbox[1], bbox_x1=bbox[2], bbox_y1=bbox[3])
+
+
+def write_info(records, path, parameters=None):
+    lines = []
+    column_names = io_tools.FRAGMENT_COLUMNS
+    if records and io_tools.AFFINE_COLUMNS[0] in records[0]:
+        column_names += io_tools.AFFINE_COLUMNS
+    columns = {column: [] for column in column_names}
+    for record in records:
+        coordinate = (record["x"], record["y"])
+        diff = (record["diff_x"], record["diff_y"])
+        lines.append(f"{record['name']}: {coordinate}; {diff}; {record['angle']}\n\n")
+        for column in columns:
+            columns[column].append(record[column])
+
+    with open(f"{path}/fragment_info.txt", "a") as info_file:
+        info_file.write("".join(lines))
+    io_tools.write_fragment_table(path, columns, parameters)
+
+
+def save_info(fragments, path, parameters=None):
+    names = io_tools.fragment_names(len(fragments))
+    records = [fragment_record(name, fragment) for name, fragment in zip(names, fragments)]
+    write_info(records, path, parameters)
+    return records
+
+
+def count_records(monitor, records):
+    monitor.count("eroded", sum(1 for record in records if record["eroded"]))
+    monitor.count("pixels_written", sum(record["pixel_count"] for record in records))
+
+
+def generate_info(resources_path, seed, num_fragments, min_distance, erosion_probability, erosion_percentage, sampler="rejection", merge_chain=None,
+                  rotation="expand"):
     with open(f"{resources_path}/fragmentation_info.txt", "a") as info_file:
         info_file.write(f"seed: {seed}\n")
         info_file.write(f"num_fragments: {num_fragments}\n")
         info_file.write(f"min_distance: {min_distance}\n")
         info_file.write(f"erosion_probability: {erosion_probability}\n")
         info_file.write(f"erosion_percentage: {erosion_percentage}\n")
+        info_file.write(f"sampler: {sampler}\n")
+        if merge_chain is not None:
+            info_file.write(f"merge_chain: {merge_chain}\n")
+        if rotation != "expand":
+            info_file.write(f"rotation: {rotation}\n")
 
 
-def generate_fragments(url, output_directory, num_fragments, min_distance, seed, erosion_probability, erosion_percentage):
+def sample_geometry(image, num_fragments, min_distance, seed, sampler, monitor, cache, pixels, image_key, rng=random):
+    # seed points and Voronoi map of a PIL image, read from cache when the image was already cut with the same
+    # seed and geometry; leaves rng where combine_cells expects it
+    width, height = image.size
+    geometry = None
+    if cache is not None and seed is not None:
+        if image_key is None:
+            image_key = geometry_cache.array_key(pixels)
+        geometry = cache.load_geometry(image_key, seed, num_fragments, min_distance, sampler)
+        monitor.count("geometry_cache_hits" if geometry is not None else "geometry_cache_misses")
+        sys.stderr.write(f'\rgeometry cache {"hit" if geometry is not None else "miss"}\n')
+
+    with monitor.stage("points"):
+        if geometry is not None:
+            points, label_map, random_state = geometry
+            rng.setstate(random_state)
+        else:
+            points = generate_random_points(min_distance, seed, num_fragments, width, height, sampler, rng=rng)
+            random_state = rng.getstate()
+    monitor.count("points", len(points))
+
+    if geometry is None:
+        with monitor.stage("voronoi"):
+            label_map = create_voronoi(width, height, points, progress=monitor.progress)
+        if cache is not None and seed is not None:
+            cache.store_geometry(image_key, seed, num_fragments, min_distance, sampler, points, label_map, random_state)
+    return points, label_map
+
+
+def combine_geometry(points, label_map, monitor, merge_chain=None, rng=random):
+    # cells of the Voronoi map, num_combined_fragment of them merged with their closest one, or with chains of
+    # adjacent cells when merge_chain is set
+    num_combined_fragment = rng.randint(1,int(math.sqrt(len(points))))
+    bounding_boxes = cell_bounding_boxes(label_map, len(points))
+    cells = cell_descriptors(points, bounding_boxes)
+    monitor.count("fragments", len(cells))
+    neighbours = cell_neighbours(label_map) if merge_chain is not None else None
+    cells = combine_cells(cells, num_combined_fragment, merge_chain, neighbours, rng)
+    monitor.count("combined", num_combined_fragment)
+    return cells, bounding_boxes
+
+
+def cut_cells(image, num_fragments, min_distance, seed, sampler="rejection", monitor=None, cache=None, pixels=None, image_key=None,
+              merge_chain=None):
+    # the combined cells of a PIL image, (cells, label_map, bounding_boxes, pixels), before any pixel is cut.
+    # cache is a geometry_cache.GeometryCache: points and label map are read from it when the image was already
+    # cut with the same seed and geometry; image_key is the cache key of the image, the hash of its pixels by default
+    if monitor is None:
+        monitor = instrumentation.RunMonitor(hooks=[])
+    if pixels is None:
+        pixels = image_to_array(image)
+
+    points, label_map = sample_geometry(image, num_fragments, min_distance, seed, sampler, monitor, cache, pixels, image_key)
+    with monitor.stage("cut"):
+        cells, bounding_boxes = combine_geometry(points, label_map, monitor, merge_chain)
+    return cells, label_map, bounding_boxes, pixels
+
+
+def cut_fragments(image, num_fragments, min_distance, seed, sampler="rejection", monitor=None, cache=None, pixels=None, image_key=None,
+                  merge_chain=None, rng=random):
+    # cut_cells with the pixels of every cell cut out, fragments are (point, diff, image) before erosion; rng is
+    # the random module by default, a random.Random keeps the global stream untouched
+    if monitor is None:
+        monitor = instrumentation.RunMonitor(hooks=[])
+    if pixels is None:
+        pixels = image_to_array(image)
+
+    points, label_map = sample_geometry(image, num_fragments, min_distance, seed, sampler, monitor, cache, pixels, image_key, rng)
+    with monitor.stage("cut"):
+        cells, bounding_boxes = combine_geometry(points, label_map, monitor, merge_chain, rng)
+        combined_fragments = []
+        for cell in cells:
+            combined_fragments.append((cell[0], cell[1], render_fragment(cell, pixels, label_map, bounding_boxes)))
+            monitor.progress(len(combined_fragments), len(cells))
+
+    return combined_fragments
+
+
+def cut_geometry(url, num_fragments, min_distance, seed, sampler="rejection", monitor=None, merge_chain=None):
+    # what generate_fragments computes before erosion, (cells, label_map, bounding_boxes, pixels, random_state). Given
+    # back to generate_fragments as geometry, erosion and rotation continue from random_state as if the image had just
+    # been cut, so one cut can be eroded many times with the same result as separate runs
+    cells, label_map, bounding_boxes, pixels = cut_cells(Image.open(url), num_fragments, min_distance, seed, sampler, monitor,
+                                                         merge_chain=merge_chain)
+    return cells, label_map, bounding_boxes, pixels, random.getstate()
+
+
+def check_erosion_mode(erosion_mode, fragment_workers):
+    if erosion_mode not in EROSION_MODES:
+        raise ValueError(f"unknown erosion mode '{erosion_mode}', expected one of {', '.join(EROSION_MODES)}")
+    if erosion_mode == "batch" and fragment_workers is not None:
+        raise ValueError("erosion mode 'batch' erodes the whole image in one pass, it can't be combined with fragment_workers")
+
+
+def fragment_image(image, num_fragments, min_distance, seed, erosion_probability, erosion_percentage, sampler="rejection",
+                   fragment_workers=None, fragment_executor="thread", monitor=None, cache=None, erosion_mode="fragment", merge_chain=None,
+                   rotation="expand"):
+    # the whole fragmentation of a PIL image in memory, fragments are (point, diff, image, angle, params) in name order
+    if monitor is None:
+        monitor = instrumentation.RunMonitor(hooks=[])
+    check_erosion_mode(erosion_mode, fragment_workers)
+    check_rotation(rotation)
+    if erosion_mode == "batch":
+        cells, label_map, bounding_boxes, pixels = cut_cells(image, num_fragments, min_distance, seed, sampler, monitor, cache,
+                                                             merge_chain=merge_chain)
+        with monitor.stage("erode"):
+            eroded_fragments = batch_erosion(cells, pixels, label_map, bounding_boxes, min_distance, erosion_probability,
+                                             erosion_percentage, progress=monitor.progress)
+        with monitor.stage("rotate"):
+            return rotate_fragment(eroded_fragments, monitor.progress, rotation)
+
+    if fragment_workers is not None and fragment_executor == "process":
+        cells, label_map, bounding_boxes, pixels = cut_cells(image, num_fragments, min_distance, seed, sampler, monitor, cache,
+                                                             merge_chain=merge_chain)
+        shared = shared_source.SharedSource(pixels, label_map, bounding_boxes)
+        del pixels, label_map
+        with monitor.stage("erode"):
+            return list(shared_erosion_rotation(cells, shared, min_distance, erosion_probability, erosion_percentage, seed, fragment_workers,
+                                                rotation))
+
+    combined_fragments = cut_fragments(image, num_fragments, min_distance, seed, sampler, monitor, cache, merge_chain=merge_chain)
+
+    with monitor.stage("erode"):
+        if fragment_workers is not None:
+            return list(parallel_erosion_rotation(combined_fragments, min_distance, erosion_probability, erosion_percentage, seed,
+                                                  fragment_workers, fragment_executor, rotation))
+        eroded_fragments = fragment_erosion(combined_fragments, min_distance, erosion_probability, erosion_percentage, monitor.progress)
+    with monitor.stage("rotate"):
+        return rotate_fragment(eroded_fragments, monitor.progress, rotation)
+
+
+def generate_fragments(url, output_directory, num_fragments, min_distance, seed, erosion_probability, erosion_percentage, sampler="rejection", return_fragments=False,
+                       fragment_workers=None, fragment_executor="thread", fragment_format="png", compress_level=None, writer_workers=4,
+                       storage="folder", shard_size=fragment_io.DEFAULT_SHARD_SIZE, monitor=None, cache=None, erosion_mode="fragment",
+                       merge_chain=None, rotation="expand", geometry=None, folder_suffix=None):
+    # monitor is an instrumentation.RunMonitor, by default one drawing a progress bar on stderr;
+    # its report is written to resources/run_report.json. cache is a geometry_cache.GeometryCache.
+    # erosion_mode "batch" erodes and degrades every fragment in one pass over the whole image, see batch_erosion;
+    # merge_chain merges chains of up to that many adjacent cells instead of pairs, see combine_cells;
+    # rotation "tight" stores the rotated fragments cropped to their visible pixels, see tight_rotation;
+    # geometry, from cut_geometry with the same image and cut parameters, skips the cut;
+    # folder_suffix replaces the timestamp in the name of the dataset folder
+    check_erosion_mode(erosion_mode, fragment_workers)
+    check_rotation(rotation)
+    if geometry is not None and fragment_workers is not None:
+        raise ValueError("a precomputed geometry continues the global random stream, it can't be combined with fragment_workers")
+    if monitor is None:
+        monitor = instrumentation.RunMonitor()
     image = Image.open(url)
 
     name = io_tools.image_name(url)
-    path, resources_path, fragment_path = io_tools.create_folder(name, output_directory)
-
-    generate_info(resources_path, seed, num_fragments, min_distance, erosion_probability, erosion_percentage)
-
-    width, height = image.size
-
-    points = generate_random_points(min_distance, seed, num_fragments, width, height)
-    num_combined_fragment = random.randint(1,int(math.sqrt(len(points))))
-
-    io_tools.update_progress_bar(0, 100, "create voronoi (this op might take long)", 1)
-    sys.stderr.flush()
-
-    voronoi_cells = create_voronoi(width, height, points)
-    io_tools.update_progress_bar(25, 100, "create fragments", 2)
-
-    fragments = create_fragment_image(voronoi_cells, image)
-    combined_fragments = combine_fragment(fragments, voronoi_cells, image, num_combined_fragment)
-    io_tools.update_progress_bar(50, 100, "erode fragments", 3)
-    sys.stderr.flush()
-
-    eroded_fragments = fragment_erosion(combined_fragments, min_distance, erosion_probability, erosion_percentage)
-    eroded_fragments = rotate_fragment(eroded_fragments)
-    io_tools.update_progress_bar(75, 100, "save fragments", 4)
-    save_fragments_to_folder(eroded_fragments, fragment_path)
-    save_info(eroded_fragments, resources_path)
-    io_tools.update_progress_bar(100, 100, "fragments saved", 4)
-    sys.stderr.flush()
+    path, resources_path, fragment_path = io_tools.create_folder(name, output_directory, folder_suffix)
+
+    generate_info(resources_path, seed, num_fragments, min_distance, erosion_probability, erosion_percentage, sampler, merge_chain, rotation)
+
+    parameters = {"seed": seed, "num_fragments": num_fragments, "min_distance": min_distance, "erosion_probability": erosion_probability,
+                  "erosion_percentage": erosion_percentage, "sampler": sampler}
+    if merge_chain is not None:
+        parameters["merge_chain"] = merge_chain
+    if rotation != "expand":
+        parameters["rotation"] = rotation
+    monitor.info.update(image=url, path=path, width=image.width, height=image.height, parameters=parameters)
+
+    image_key = None
+    pixels = None
+    if cache is not None and geometry is None:
+        # the decoded pixels are cached by the hash of the file
+        image_key = geometry_cache.file_key(url)
+        pixels = cache.load_pixels(image_key)
+        monitor.count("image_cache_hits" if pixels is not None else "image_cache_misses")
+        sys.stderr.write(f'\rimage cache {"hit" if pixels is not None else "miss"}\n')
+        if pixels is None:
+            pixels = image_to_array(image)
+            cache.store_pixels(image_key, pixels)
+    if fragment_workers is None:
+        # fragments are kept as Fragment records, their pixels only exist while they are saved
+        if geometry is None:
+            cells, label_map, bounding_boxes, pixels = cut_cells(image, num_fragments, min_distance, seed, sampler, monitor, cache, pixels, image_key,
+                                                                 merge_chain)
+        else:
+            cells, label_map, bounding_boxes, pixels, random_state = geometry
+            random.setstate(random_state)
+        with monitor.stage("erode"):
+            if erosion_mode == "batch":
+                degraded, all_params = batch_degrade(cells, pixels, label_map, bounding_boxes, min_distance, erosion_probability, erosion_percentage)
+                rotated_fragments = fragment_records(cells, FragmentSource(degraded, label_map, bounding_boxes), degrade=False)
+                for fragment, params in zip(rotated_fragments, all_params):
+                    fragment.params = params
+            else:
+                rotated_fragments = fragment_records(cells, FragmentSource(pixels, label_map, bounding_boxes))
+                erode_records(rotated_fragments, min_distance, erosion_probability, erosion_percentage, monitor.progress)
+        with monitor.stage("rotate"):
+            rotate_records(rotated_fragments, monitor.progress, rotation)
+        num_cut_fragments = len(cells)
+        stage = "save"
+    elif fragment_executor == "process":
+        # the workers cut their fragments from the pixels and label map in shared memory
+        cells, label_map, bounding_boxes, pixels = cut_cells(image, num_fragments, min_distance, seed, sampler, monitor, cache, pixels, image_key,
+                                                             merge_chain)
+        num_cut_fragments = len(cells)
+        # from here on the pixels and the label map only live in shared memory
+        shared = shared_source.SharedSource(pixels, label_map, bounding_boxes)
+        del pixels, label_map
+        rotated_fragments = shared_erosion_rotation(cells, shared, min_distance, erosion_probability, erosion_percentage, seed, fragment_workers,
+                                                    rotation)
+        stage = "erode_and_save"
+    else:
+        combined_fragments = cut_fragments(image, num_fragments, min_distance, seed, sampler, monitor, cache, pixels, image_key, merge_chain)
+        num_cut_fragments = len(combined_fragments)
+        # fragments are saved while the pool is still eroding the next ones, the two can't be timed apart
+        rotated_fragments = parallel_erosion_rotation(combined_fragments, min_distance, erosion_probability, erosion_percentage, seed,
+                                                      fragment_workers, fragment_executor, rotation)
+        stage = "erode_and_save"
 
+    eroded_fragments = []
+    records = []
+    names = io_tools.fragment_names(num_cut_fragments)
+    sink = fragment_io.fragment_sink(path, storage, shard_size)
+    with monitor.stage(stage):
+        with fragment_io.FragmentWriter(sink, fragment_format, compress_level, writer_workers) as writer:
+            for name, fragment in zip(names, rotated_fragments):
+                point, diff, fragment_image, angle, params = fragment
+                writer.write(name, fragment_image)
+                records.append(fragment_record(name, (point, diff, fragment_image, angle, params)))
+                eroded_fragments.append(fragment)
+                monitor.progress(len(eroded_fragments), len(names))
+
+    with monitor.stage("info"):
+        write_info(records, resources_path, parameters)
+    count_records(monitor, records)
+    monitor.finish(resources_path)
+
+    if return_fragments:
+        return path, eroded_fragments
     return path
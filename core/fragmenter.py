@@ -0,0 +1,156 @@
+import os
+import random
+from . import lazy
+np = lazy.lazy_import("numpy")
+Image = lazy.lazy_import("PIL.Image")
+from . import io_tools
+from . import fragment_io
+from . import instrumentation
+from . import riconstruct_image
+from . import fragmentation_erosion
+
+
+# Library entry point: a Fragmenter is configured once and applied to any number of images, everything stays in
+# memory and nothing is written unless FragmentSet.save is called. With the same seed the fragments, the removed
+# fragments and the spurious fragments are the ones the DAFNE command line generates from the same image.
+
+
+def as_image(image):
+    # PIL images are used as they are, arrays are HxW, HxWx3 or HxWx4 uint8
+    if isinstance(image, Image.Image):
+        return image
+    return Image.fromarray(np.asarray(image, dtype=np.uint8))
+
+
+class FragmentSet:
+    # the fragments of one image: fragments maps each name to (point, diff, image, angle, params),
+    # spurius maps the names of the spurious fragments to their images
+
+    def __init__(self, image, fragments, parameters, spurius=None, removed=None, report=None):
+        self.image = image
+        self.fragments = fragments
+        self.parameters = parameters
+        self.spurius = spurius or {}
+        self.removed = removed or []
+        self.report = report
+        # fragment names keep counting from the fragments generated before any removal
+        self.num_generated = len(fragments) + len(self.removed)
+
+    def __len__(self):
+        return len(self.fragments) + len(self.spurius)
+
+    def images(self):
+        # name -> PIL image of every fragment, spurious ones included
+        images = {name: fragment[2] for name, fragment in self.fragments.items()}
+        images.update(self.spurius)
+        return images
+
+    def records(self):
+        # the rows of fragment_info.json, spurious fragments have none
+        return [fragmentation_erosion.fragment_record(name, fragment) for name, fragment in self.fragments.items()]
+
+    def remove(self, percentage, rng=random):
+        # drops percentage% of the fragments, drawn like remove_fragments.random_fragments_removal does
+        names = list(self.fragments)
+        removed = rng.sample(names, int(len(names) * (percentage / 100)))
+        fragments = {name: fragment for name, fragment in self.fragments.items() if name not in removed}
+        parameters = dict(self.parameters, removal_percentage=percentage)
+        return FragmentSet(self.image, fragments, parameters, self.spurius, self.removed + removed, self.report)
+
+    def add_spurius(self, donors, num_spurius, rng=random):
+        # adds between 1 and num_spurius fragments taken from donors, another FragmentSet or a list of images,
+        # named as remove_fragments.add_spurius_fragments names them
+        if isinstance(donors, FragmentSet):
+            donors = list(donors.images().values())
+        this_num_spurius = rng.randint(1, num_spurius)
+        spurius = dict(self.spurius)
+        for image in rng.sample(list(donors), this_num_spurius):
+            spurius[f"fragment_{self.num_generated + len(spurius) + 1}"] = image
+        parameters = dict(self.parameters, num_spurius=num_spurius)
+        return FragmentSet(self.image, self.fragments, parameters, spurius, self.removed, self.report)
+
+    def ricostruct(self):
+        # RGBA array with the fragments put back in place over the gray original
+        return riconstruct_image.ricostruct_fragments(self.image, self.fragments.values())
+
+    def save(self, output_directory, name="fragments", fragment_format="png", compress_level=None, writer_workers=4,
+             storage="folder", shard_size=fragment_io.DEFAULT_SHARD_SIZE, ricostruction=True):
+        # writes the set as a DAFNE dataset folder and returns its path
+        path, resources_path, _ = io_tools.create_folder(name, output_directory)
+        parameters = self.parameters
+        fragmentation_erosion.generate_info(resources_path, parameters["seed"], parameters["num_fragments"], parameters["min_distance"],
+                                            parameters["erosion_probability"], parameters["erosion_percentage"], parameters["sampler"],
+                                            parameters.get("merge_chain"), parameters.get("rotation", "expand"))
+
+        sink = fragment_io.fragment_sink(path, storage, shard_size)
+        with fragment_io.FragmentWriter(sink, fragment_format, compress_level, writer_workers) as writer:
+            for fragment_name, image in self.images().items():
+                writer.write(fragment_name, image)
+        fragmentation_erosion.write_info(self.records(), resources_path, parameters)
+
+        if self.spurius:
+            with open(f"{resources_path}/spurius_info.txt", "a") as info_file:
+                info_file.write(f"num_spurius: {len(self.spurius)}\n")
+                for spurius_name in self.spurius:
+                    info_file.write(f"name_spurius: {spurius_name}\n")
+        if ricostruction:
+            Image.fromarray(self.ricostruct(), "RGBA").save(os.path.join(path, "ricostructed_image.png"), 'PNG')
+        return path
+
+
+class Fragmenter:
+    # hooks are instrumentation.RunHook objects, each call gets a new RunMonitor and its report ends up in FragmentSet.report.
+    # The global random module is seeded by every call, as in the command line: don't share a Fragmenter between threads
+
+    def __init__(self, num_fragments=500, min_distance=6, erosion_probability=0.6, erosion_percentage=20, sampler="rejection",
+                 removal_percentage=0, num_spurius=0, fragment_workers=None, fragment_executor="thread", hooks=(), cache=None,
+                 erosion_mode="fragment", merge_chain=None, rotation="expand"):
+        self.num_fragments = num_fragments
+        self.min_distance = min_distance
+        self.erosion_probability = erosion_probability
+        self.erosion_percentage = erosion_percentage
+        self.sampler = sampler
+        self.removal_percentage = removal_percentage
+        self.num_spurius = num_spurius
+        self.fragment_workers = fragment_workers
+        self.fragment_executor = fragment_executor
+        self.hooks = list(hooks)
+        # a geometry_cache.GeometryCache, to reuse points and label maps across calls with the same image and seed
+        self.cache = cache
+        # "batch" erodes and degrades all the fragments in one pass over the image, see fragmentation_erosion.batch_erosion
+        self.erosion_mode = erosion_mode
+        # merge chains of 2 to merge_chain adjacent cells instead of pairs of close cells
+        self.merge_chain = merge_chain
+        # "tight" crops the rotated fragments to their visible pixels, see fragmentation_erosion.tight_rotation
+        self.rotation = rotation
+
+    def parameters(self, seed):
+        parameters = {"seed": seed, "num_fragments": self.num_fragments, "min_distance": self.min_distance,
+                      "erosion_probability": self.erosion_probability, "erosion_percentage": self.erosion_percentage, "sampler": self.sampler}
+        if self.merge_chain is not None:
+            parameters["merge_chain"] = self.merge_chain
+        if self.rotation != "expand":
+            parameters["rotation"] = self.rotation
+        return parameters
+
+    def __call__(self, image, seed=None, spurius=None):
+        # fragments a PIL image or a NumPy array; spurius, a FragmentSet or a list of images, is only used with num_spurius
+        image = as_image(image)
+        monitor = instrumentation.RunMonitor(self.hooks)
+        monitor.info.update(width=image.width, height=image.height, parameters=self.parameters(seed))
+
+        fragments = fragmentation_erosion.fragment_image(image, self.num_fragments, self.min_distance, seed, self.erosion_probability,
+                                                         self.erosion_percentage, self.sampler, self.fragment_workers,
+                                                         self.fragment_executor, monitor, self.cache, self.erosion_mode, self.merge_chain,
+                                                         self.rotation)
+        names = io_tools.fragment_names(len(fragments))
+        monitor.count("eroded", sum(1 for fragment in fragments if fragment[4]["eroded"]))
+        result = FragmentSet(image, dict(zip(names, fragments)), self.parameters(seed), report=monitor.finish())
+
+        # removal and spurious fragments continue the same random stream, as they do on disk
+        rng = random.Random(seed)
+        if self.removal_percentage != 0:
+            result = result.remove(self.removal_percentage, rng)
+        if self.num_spurius != 0 and spurius is not None:
+            result = result.add_spurius(spurius, self.num_spurius, rng)
+        return result
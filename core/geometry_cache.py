@@ -0,0 +1,122 @@
+import os
+import json
+import shutil
+import hashlib
+from . import lazy
+np = lazy.lazy_import("numpy")
+
+
+# Content addressed cache of what a fragmentation computes before erosion: the decoded pixels of an image, and the
+# seed points and label map of every (image, seed, num_fragments, min_distance, sampler) it has been cut with.
+# The random state after sampling is stored too, so a run served from the cache draws the same combinations,
+# erosions and rotations as a run that samples the points again.
+#
+# Every entry is a folder, written under a temporary name and renamed when complete, so processes can share the
+# cache. Reading an entry touches it; once the cache is larger than max_bytes the least recently used entries go.
+
+
+CACHE_VERSION = 1
+DEFAULT_CACHE_SIZE = 8 << 30
+
+
+def file_key(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as image_file:
+        for block in iter(lambda: image_file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def array_key(pixels):
+    digest = hashlib.sha256(str(pixels.shape).encode("utf-8"))
+    digest.update(np.ascontiguousarray(pixels).data)
+    return digest.hexdigest()
+
+
+class GeometryCache:
+
+    def __init__(self, directory, max_bytes=DEFAULT_CACHE_SIZE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.evict()
+
+    def _entry(self, kind, *keys):
+        text = ":".join(str(value) for value in (CACHE_VERSION, kind) + keys)
+        return os.path.join(self.directory, f"{kind}-{hashlib.sha256(text.encode('utf-8')).hexdigest()}")
+
+    def _open(self, entry_path):
+        if not os.path.isdir(entry_path):
+            return None
+        try:
+            os.utime(entry_path)
+        except OSError:
+            return None
+        return entry_path
+
+    def _store(self, entry_path, files):
+        temporary_path = f"{entry_path}.{os.getpid()}.tmp"
+        os.makedirs(temporary_path, exist_ok=True)
+        for name, write in files.items():
+            write(os.path.join(temporary_path, name))
+        try:
+            os.rename(temporary_path, entry_path)
+        except OSError:
+            # another process stored the same entry first
+            shutil.rmtree(temporary_path, ignore_errors=True)
+        self.evict()
+
+    def load_pixels(self, image_key):
+        entry_path = self._open(self._entry("image", image_key))
+        if entry_path is None:
+            return None
+        try:
+            return np.load(os.path.join(entry_path, "pixels.npy"), mmap_mode="r")
+        except (OSError, ValueError):
+            # evicted by another process in the meantime
+            return None
+
+    def store_pixels(self, image_key, pixels):
+        self._store(self._entry("image", image_key), {"pixels.npy": lambda path: np.save(path, pixels)})
+
+    def load_geometry(self, image_key, seed, num_fragments, min_distance, sampler):
+        # (points, label_map, random_state) or None
+        entry_path = self._open(self._entry("geometry", image_key, seed, num_fragments, min_distance, sampler))
+        if entry_path is None:
+            return None
+        try:
+            with open(os.path.join(entry_path, "geometry.json"), "r") as geometry_file:
+                geometry = json.load(geometry_file)
+            label_map = np.load(os.path.join(entry_path, "label_map.npy"), mmap_mode="r")
+        except (OSError, ValueError):
+            return None
+        version, state, gauss_next = geometry["random_state"]
+        points = [tuple(point) for point in geometry["points"]]
+        return points, label_map, (version, tuple(state), gauss_next)
+
+    def store_geometry(self, image_key, seed, num_fragments, min_distance, sampler, points, label_map, random_state):
+        def write_geometry(path):
+            with open(path, "w") as geometry_file:
+                json.dump({"points": points, "random_state": random_state}, geometry_file)
+
+        self._store(self._entry("geometry", image_key, seed, num_fragments, min_distance, sampler),
+                    {"geometry.json": write_geometry, "label_map.npy": lambda path: np.save(path, label_map)})
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            entry_path = os.path.join(self.directory, name)
+            if name.endswith(".tmp") or not os.path.isdir(entry_path):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(entry_path, file_name)) for file_name in os.listdir(entry_path))
+                entries.append((os.path.getmtime(entry_path), size, entry_path))
+            except OSError:
+                continue
+
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, entry_path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            shutil.rmtree(entry_path, ignore_errors=True)
+            total_bytes -= size
@@ -0,0 +1,141 @@
+import sys
+import json
+import time
+from contextlib import contextmanager
+from . import io_tools
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, peak RSS is reported as null there
+    resource = None
+
+
+RUN_REPORT = "run_report.json"
+RUN_REPORT_VERSION = 1
+
+
+def peak_rss():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class RunHook:
+    # base class for the hooks of a RunMonitor, every method is optional and does nothing by default
+
+    def stage_started(self, monitor, stage):
+        pass
+
+    def progress(self, monitor, stage, done, total):
+        pass
+
+    def stage_finished(self, monitor, stage, stats):
+        pass
+
+    def run_finished(self, monitor, report):
+        pass
+
+
+class ProgressBar(RunHook):
+    # one bar per stage on stderr, redrawn only when the percentage changes
+
+    def __init__(self, bar_length=50, stream=None):
+        self.bar_length = bar_length
+        self.stream = stream
+        self.percent = None
+
+    def _write(self, text):
+        stream = self.stream or sys.stderr
+        stream.write(text)
+        stream.flush()
+
+    def _draw(self, stage, progress):
+        arrow = '=' * int(round(self.bar_length * progress))
+        spaces = ' ' * (self.bar_length - len(arrow))
+        self._write(f'\r[{arrow + spaces}] {stage}... {int(progress * 100)}%')
+
+    def stage_started(self, monitor, stage):
+        self.percent = None
+        self._draw(stage, 0)
+
+    def progress(self, monitor, stage, done, total):
+        percent = int(100 * done / total) if total else 100
+        if percent != self.percent:
+            self.percent = percent
+            self._draw(stage, percent / 100)
+
+    def stage_finished(self, monitor, stage, stats):
+        self._draw(stage, 1)
+        self._write(f' {stats["wall_seconds"]:.2f}s\n')
+
+
+class RunMonitor:
+    # times the stages of a run (wall and CPU time, peak RSS at the end of each stage), collects counts,
+    # forwards per item progress to the hooks and writes everything as a JSON run report.
+    # CPU time is the one of the whole process, so it includes worker threads
+
+    def __init__(self, hooks=None):
+        self.hooks = [ProgressBar()] if hooks is None else list(hooks)
+        self.stages = []
+        self.counts = {}
+        self.info = {}
+        self.current_stage = None
+        self.started = io_tools.time_value()
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.process_time()
+
+    def _notify(self, method, *args):
+        for hook in self.hooks:
+            callback = getattr(hook, method, None)
+            if callback is not None:
+                callback(self, *args)
+
+    @contextmanager
+    def stage(self, name):
+        stats = {"name": name, "items": None}
+        previous_stage = self.current_stage
+        self.current_stage = stats
+        self._notify("stage_started", name)
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield stats
+        finally:
+            stats["wall_seconds"] = time.perf_counter() - wall_start
+            stats["cpu_seconds"] = time.process_time() - cpu_start
+            stats["peak_rss_bytes"] = peak_rss()
+            self.stages.append(stats)
+            self.current_stage = previous_stage
+        self._notify("stage_finished", name, stats)
+
+    def progress(self, done, total):
+        if self.current_stage is None:
+            return
+        self.current_stage["items"] = total
+        self._notify("progress", self.current_stage["name"], done, total)
+
+    def count(self, name, value=1):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def report(self):
+        return {
+            "report_version": RUN_REPORT_VERSION,
+            "started": self.started,
+            "wall_seconds": time.perf_counter() - self.wall_start,
+            "cpu_seconds": time.process_time() - self.cpu_start,
+            "peak_rss_bytes": peak_rss(),
+            "info": self.info,
+            "stages": self.stages,
+            "counts": self.counts,
+        }
+
+    def finish(self, resources_path=None):
+        report = self.report()
+        self._notify("run_finished", report)
+        if resources_path is not None:
+            with open(f"{resources_path}/{RUN_REPORT}", "w") as report_file:
+                json.dump(report, report_file, indent=2)
+        return report
@@ -1,7 +1,11 @@
 import os
+import ast
 import sys
-import glob
+import json
+import hashlib
 import datetime
+from . import lazy
+np = lazy.lazy_import("numpy")
 
 
 def image_name(url):
@@ -17,17 +21,47 @@ def time_value():
     return date
 
 
-def create_folder(name, output_directory):
+def derive_seed(seed, *keys):
+    if seed is None:
+        return None
+    text = ":".join(str(value) for value in (seed,) + keys)
+    return int(hashlib.sha256(text.encode("utf-8")).hexdigest()[:16], 16)
+
+
+def parameters_key(parameters):
+    # a short hash of a dict of parameters, the same for equal parameters in any order
+    text = json.dumps(parameters, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
 
-    name = name + "-" + time_value()
+
+def create_folder(name, output_directory, suffix=None):
+    # suffix replaces the timestamp, for runs whose folder names must not depend on when they ran
+    name = name + "-" + (time_value() if suffix is None else suffix)
     path = os.path.join(output_directory,name)
+
+    # timestamps have a one second resolution, a folder that already exists
+    # belongs to another run (or worker) and gets a numeric suffix instead
+    suffix = 0
+    while True:
+        try:
+            os.makedirs(path)
+            break
+        except FileExistsError:
+            suffix += 1
+            path = os.path.join(output_directory, f"{name}_{suffix}")
+
+    # fragments/ is left to the sink that writes the fragments, shards and manifests don't use it
     resources_path = os.path.join(path, "resources")
     fragment_path = os.path.join(path, "fragments")
 
     os.makedirs(resources_path)
-    os.makedirs(fragment_path)
     return (path, resources_path, fragment_path)
 
+def fragment_names(num_fragments):
+    n = len(str(num_fragments-1))
+    return [f"fragment_{str(i).zfill(n)}" for i in range(num_fragments)]
+
+
 def read_input_from_file(file_path):
     input_data = {}
 
@@ -51,18 +85,86 @@ def read_input_from_file(file_path):
         return None
 
 
+FRAGMENT_TABLE = "fragment_info.json"
+FRAGMENT_TABLE_VERSION = 1
+FRAGMENT_COLUMNS = ("name", "x", "y", "diff_x", "diff_y", "angle", "width", "height", "pixel_count",
+                    "bbox_x0", "bbox_y0", "bbox_x1", "bbox_y1", "eroded", "erosion_kernel", "erosion_angle",
+                    "blur_radius", "saturation_factor", "value_factor")
+# tightly rotated fragments only: the 2x3 affine from stored pixels to image coordinates, row by row
+AFFINE_COLUMNS = ("affine_00", "affine_01", "affine_02", "affine_10", "affine_11", "affine_12")
+
+
+def affine_columns(affine):
+    return dict(zip(AFFINE_COLUMNS, (float(value) for value in np.ravel(affine))))
+
+
+def record_affine(record):
+    # the affine of a record or of the params of a fragment, None when the fragment was rotated with expand
+    if record is None or AFFINE_COLUMNS[0] not in record:
+        return None
+    return np.array([record[column] for column in AFFINE_COLUMNS], dtype=np.float64).reshape(2, 3)
+
+
+def write_fragment_table(path, columns, parameters=None):
+    # one list per column, so the whole table is loaded with a single json.load
+    table = {
+        "schema_version": FRAGMENT_TABLE_VERSION,
+        "num_fragments": len(columns["name"]),
+        "parameters": parameters or {},
+        "columns": columns,
+    }
+    with open(os.path.join(path, FRAGMENT_TABLE), "w") as table_file:
+        json.dump(table, table_file)
+
+
+def read_fragment_table(path):
+    with open(os.path.join(path, FRAGMENT_TABLE), "r") as table_file:
+        table = json.load(table_file)
+    if table.get("schema_version", 0) > FRAGMENT_TABLE_VERSION:
+        raise ValueError(f"{FRAGMENT_TABLE} has schema version {table.get('schema_version')}, "
+                         f"this version of DAFNE reads up to {FRAGMENT_TABLE_VERSION}")
+    table["columns"] = {column: np.asarray(values) for column, values in table["columns"].items()}
+    return table
+
+
+def rewrite_fragment_table(name_to_remove, input_path, output_path):
+    if not os.path.exists(os.path.join(input_path, FRAGMENT_TABLE)):
+        return
+    table = read_fragment_table(input_path)
+    keep = ~np.isin(table["columns"]["name"], list(name_to_remove))
+    columns = {column: values[keep].tolist() for column, values in table["columns"].items()}
+    write_fragment_table(output_path, columns, table["parameters"])
+
+
+def read_fragment_affines(path):
+    # name -> affine of the tightly rotated fragments of a dataset, empty for fragments rotated with expand
+    if not os.path.exists(os.path.join(path, FRAGMENT_TABLE)):
+        return {}
+    columns = read_fragment_table(path)["columns"]
+    if AFFINE_COLUMNS[0] not in columns:
+        return {}
+    affines = np.stack([columns[column].astype(np.float64) for column in AFFINE_COLUMNS], axis=1).reshape(-1, 2, 3)
+    return dict(zip(columns["name"].tolist(), affines))
+
+
 def read_info_file(path):
+    # name -> (coordinates, diff, angle), from fragment_info.json or, for older datasets, fragment_info.txt
     info = {}
     try:
-        file_pattern = os.path.join(path, "*.txt")
-        info_path = glob.glob(file_pattern)[0]
+        if os.path.exists(os.path.join(path, FRAGMENT_TABLE)):
+            columns = read_fragment_table(path)["columns"]
+            coordinates = zip(columns["x"].tolist(), columns["y"].tolist())
+            diffs = zip(columns["diff_x"].tolist(), columns["diff_y"].tolist())
+            return dict(zip(columns["name"].tolist(), zip(coordinates, diffs, columns["angle"].tolist())))
+
+        info_path = os.path.join(path, "fragment_info.txt")
         with open(info_path, "r") as file:
             for line in file:
                 if len(line.strip().split(':')) == 2:
                     name, data = line.strip().split(':')
                     values = data.strip().split(';')
-                    coordinates = eval(values[0])
-                    diff = eval(values[1])
+                    coordinates = ast.literal_eval(values[0].strip())
+                    diff = ast.literal_eval(values[1].strip())
                     angle = float(values[2])
                     info[name] = (coordinates, diff, angle)
 
@@ -85,24 +187,15 @@ def rewrite_info(name_to_remove, info, output_directory):
         del info[name]
 
     info_path = os.path.join(output_directory, "fragment_info.txt")
+    lines = []
     for name in info.keys():
         val = info[name]
         coordinate, diff, angle = val
-        with open(f"{info_path}", "a") as info_file:
-            info_file.write(f"{name}: {coordinate}; {diff}; {angle}\n")
-            info_file.write("\n")
-        
-    return num_fragments
+        lines.append(f"{name}: {coordinate}; {diff}; {angle}\n\n")
+    with open(f"{info_path}", "a") as info_file:
+        info_file.write("".join(lines))
 
-
-def update_progress_bar(iteration, total, text, phase, bar_length=50):
-    progress = ((iteration + 1)/ total)
-    arrow = '=' * int(round(bar_length * progress))
-    spaces = ' ' * (bar_length - len(arrow))
-    max_text_length = 50
-    text = f'{text}... {phase}/{4}'
-    sys.stderr.write(f'\r[{arrow + spaces}] {text:<{max_text_length}}')
-    sys.stderr.flush()
+    return num_fragments
 
 
 def generate_directories_path(image_path, output_path): 
@@ -0,0 +1,63 @@
+import importlib
+import threading
+
+
+# Heavy dependencies (NumPy, OpenCV, Pillow) are bound at module level as stand-ins that import the real module on
+# first attribute access, so the command line tools parse their arguments, print help or reject bad input without
+# paying for them. Once loaded, the attributes of the module are copied on the stand-in and later lookups cost the
+# same as on the module itself.
+
+
+class LazyModule:
+
+    # the state lives under names no module defines, the attributes copied on load must not shadow it
+    def __init__(self, name):
+        self.__dict__["_lazy_name"] = name
+        self.__dict__["_lazy_lock"] = threading.Lock()
+        self.__dict__["_lazy_module"] = None
+
+    def __getattr__(self, name):
+        # only called for what isn't on the stand-in yet: everything before the first load, and attributes the
+        # module defines later or resolves through its own __getattr__
+        return getattr(load(self), name)
+
+    def __setattr__(self, name, value):
+        setattr(load(self), name, value)
+        self.__dict__[name] = value
+
+    def __dir__(self):
+        return dir(load(self))
+
+    def __repr__(self):
+        state = "loaded" if self.__dict__["_lazy_module"] is not None else "not loaded"
+        return f"<lazy module '{self.__dict__['_lazy_name']}', {state}>"
+
+
+# one stand-in per module, shared by every module of the package that imports it
+MODULES = {}
+
+
+def lazy_import(name):
+    if name not in MODULES:
+        MODULES[name] = LazyModule(name)
+    return MODULES[name]
+
+
+def load(module):
+    # the real module behind a stand-in, imported now if it wasn't; the lock keeps two threads touching the stand-in
+    # first from copying it twice
+    if not isinstance(module, LazyModule):
+        return module
+    state = module.__dict__
+    with state["_lazy_lock"]:
+        if state["_lazy_module"] is None:
+            real = importlib.import_module(state["_lazy_name"])
+            state.update(real.__dict__)
+            state["_lazy_module"] = real
+    return state["_lazy_module"]
+
+
+def preload(*modules):
+    # imports the stand-ins now, all of them when none is given, e.g. before a long lived process starts taking jobs
+    for module in modules or list(MODULES.values()):
+        load(module)
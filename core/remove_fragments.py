@@ -1,73 +1,151 @@
 import os
 import sys
 import random
-import shutil
 import argparse
+from . import lazy
+np = lazy.lazy_import("numpy")
+Image = lazy.lazy_import("PIL.Image")
 from . import io_tools
-from PIL import Image
+from . import fragment_io
 from . import riconstruct_image
+from . import spurius_pool
 
 
 
+REMOVAL_MODES = ("copy", "link", "manifest")
+
+
+def ricostruction_after_removal(original_image, input_directory, path, fragments_to_remove, fragments=None):
+    # the reconstruction of the input dataset, when there is one, minus the removed fragments;
+    # otherwise the kept fragments are put back together from scratch
+    full_ricostruction = os.path.join(input_directory, "ricostructed_image.png")
+    resources_path = os.path.join(input_directory, "resources")
+    if not os.path.exists(full_ricostruction):
+        kept = None
+        if fragments is not None:
+            names = io_tools.fragment_names(len(fragments))
+            kept = [fragment for name, fragment in zip(names, fragments) if name not in fragments_to_remove]
+        riconstruct_image.image_ricostruction(original_image, path, kept)
+        return
+
+    sys.stderr.write('\r\nimage ricostruction, removed fragments only\n')
+    info = io_tools.read_info_file(resources_path)
+    sizes = None
+    if os.path.exists(os.path.join(resources_path, io_tools.FRAGMENT_TABLE)):
+        columns = io_tools.read_fragment_table(resources_path)["columns"]
+        sizes = {name: (int(width), int(height)) for name, width, height in zip(columns["name"], columns["width"], columns["height"])}
+
+    store = None
+    if fragments is not None:
+        # only the fragments around the removed ones are needed, records build their image on demand
+        by_name = dict(zip(io_tools.fragment_names(len(fragments)), fragments))
+        load = lambda name: by_name[name][2]
+    else:
+        store = fragment_io.open_fragment_store(input_directory)
+        load = store.load
+
+    canvas = np.array(Image.open(full_ricostruction).convert("RGBA"))
+    affines = io_tools.read_fragment_affines(resources_path)
+    riconstruct_image.subtract_fragments(riconstruct_image.open_original(original_image), canvas, info, fragments_to_remove, load, sizes, affines)
+    Image.fromarray(canvas, "RGBA").save(os.path.join(path, "ricostructed_image.png"), 'PNG')
+    if store is not None:
+        store.close()
+    sys.stderr.write(f'\rdone\n')
+
+
 # farlo relativo all'immagine -> farlo in uno script a parte e faccio salvare eliminando i frammenti, (provare ad aggiungere gli spuri, cartella in input, opzionale), pulendo il file in resources
-def random_fragments_removal(seed, input_directory, output_directory, percentage, original_image):
+def random_fragments_removal(seed, input_directory, output_directory, percentage, original_image, fragments=None, mode="copy", folder_suffix=None):
+    # mode "copy" stores the surviving fragments again, "link" hard links them (whole shards for sharded datasets),
+    # "manifest" writes no fragment at all, only manifest.json with where each surviving fragment is read from
+    if mode not in REMOVAL_MODES:
+        raise ValueError(f"unknown removal mode '{mode}', expected one of {', '.join(REMOVAL_MODES)}")
 
     sys.stderr.write(f'\r\nremoving {percentage}% fragments\n')
     # input directories
     random.seed(seed)
     resources_path = os.path.join(input_directory, "resources")
-    fragment_path = os.path.join(input_directory, "fragments")
+    store = fragment_io.open_fragment_store(input_directory)
+
+    # views are resolved against the input before anything is written
+    storage = store.storage
+    if store.storage == "manifest":
+        if mode == "link":
+            # a view of a view, it can only be another view
+            mode = "manifest"
+        # a view has no fragment of its own to copy, the ones it points to are copied into a folder
+        storage = "folder"
 
     # creation output directory
     name = f"remove_{io_tools.image_name(original_image)}"
-    path, output_resources_path, output_fragment_path = io_tools.create_folder(name, output_directory)
+    path, output_resources_path, _ = io_tools.create_folder(name, output_directory, folder_suffix)
 
 
     info = io_tools.read_info_file(resources_path)
 
-    img_extension = ['.jpg', '.jpeg', '.png']
     fragments_to_remove = random.sample(list(info.keys()), int((len(info))*(percentage/100)))
-
-    for filename in os.listdir(fragment_path):
-        file_path = os.path.join(fragment_path, filename)
-        name = io_tools.image_name(file_path)
-        if os.path.isfile(file_path) is not None and filename.endswith(tuple(img_extension)):
-            if not(name in fragments_to_remove):
-                shutil.copy(file_path, output_fragment_path)
+    removed = set(fragments_to_remove)
+    kept_names = [name for name in store.names() if name not in removed]
+
+    if mode == "manifest":
+        fragment_io.write_manifest(path, {"fragments": {name: fragment_io.manifest_entry(path, store.source(name)) for name in kept_names},
+                                          "removed": sorted(fragments_to_remove), "spurius": []})
+    elif mode == "link":
+        fragment_io.link_fragments(store, kept_names, path)
+    else:
+        # surviving fragments are copied as they are, in the same storage as the input dataset
+        sink = fragment_io.fragment_sink(path, storage)
+        with fragment_io.FragmentWriter(sink) as writer:
+            for name in kept_names:
+                extension, data = store.read(name)
+                writer.write_encoded(name, extension, data)
+    store.close()
 
     num_fragments = io_tools.rewrite_info(fragments_to_remove, info, output_resources_path)
+    io_tools.rewrite_fragment_table(fragments_to_remove, resources_path, output_resources_path)
     sys.stderr.write(f'\rdone\n')
-    riconstruct_image.image_ricostruction(original_image, path)
+    ricostruction_after_removal(original_image, input_directory, path, fragments_to_remove, fragments)
 
     return path, num_fragments
 
 
-def add_spurius_fragments(path, spurius_path, num_spurius_fragments, num_fragments):
+def add_spurius_fragments(path, spurius_path, num_spurius_fragments, num_fragments, match="none"):
+    # spurius_path is a dataset generated by DAFNE or the index of a spurious_pool; from a pool, fragments of the
+    # same image are never drawn and match picks them close in size and/or colour to the fragments of path
 
     this_num_spurius = random.randint(1, num_spurius_fragments)
     sys.stderr.write(f'\r\nadd {this_num_spurius} spurius fragments\n')
-    fragments = []
     name_used = []
-    fragments_path = os.path.join(path, "fragments")
     resources_path = os.path.join(path, "resources")
 
-    spurius_path_fragments = os.path.join(spurius_path, "fragments")
-
-    img_extension = ['.jpg', '.jpeg', '.png']
-
-    for filename in os.listdir(spurius_path_fragments):
-        if filename.endswith(tuple(img_extension)):
-            fragments.append(os.path.join(spurius_path_fragments, filename))
-
-
-    spurius_fragments = random.sample(fragments, this_num_spurius)
-    for i, spurius_fragments in enumerate(spurius_fragments):
-        name = f"fragment_{num_fragments+i+1}"
-        name_used.append(name)
-        image = Image.open(spurius_fragments)
-        file_path = os.path.join(fragments_path, f"{name}.png")
-        image.save(file_path, 'PNG')
-
+    if spurius_pool.is_pool(spurius_path):
+        spurius_store = spurius_pool.SpuriusPool(spurius_path)
+        target = spurius_pool.dataset_stats(path) if match != "none" else None
+        spurius_fragments = spurius_store.sample(this_num_spurius, random, target, match, exclude_image=spurius_pool.source_image_name(path))
+    else:
+        spurius_store = fragment_io.open_fragment_store(spurius_path)
+        spurius_fragments = random.sample(spurius_store.names(), this_num_spurius)
+    target_store = fragment_io.open_fragment_store(path)
+
+    if target_store.storage == "manifest":
+        # views only record where the spurious fragments come from
+        manifest = target_store.manifest
+        for i, spurius_fragment in enumerate(spurius_fragments):
+            name = f"fragment_{num_fragments+i+1}"
+            name_used.append(name)
+            manifest["fragments"][name] = fragment_io.manifest_entry(path, spurius_store.source(spurius_fragment))
+        manifest["spurius"] = manifest.get("spurius", []) + name_used
+        fragment_io.write_manifest(path, manifest)
+    else:
+        # the encoded bytes are copied as they are, nothing is decoded
+        sink = fragment_io.fragment_sink(path, target_store.storage, append=True)
+        with fragment_io.FragmentWriter(sink) as writer:
+            for i, spurius_fragment in enumerate(spurius_fragments):
+                name = f"fragment_{num_fragments+i+1}"
+                name_used.append(name)
+                extension, data = spurius_store.read(spurius_fragment)
+                writer.write_encoded(name, extension, data)
+    target_store.close()
+    spurius_store.close()
 
     
     with open(f"{resources_path}/spurius_info.txt", "a") as info_file:
@@ -99,8 +177,9 @@ def main():
     parser.add_argument('original_image', type=str, help='Path of the image from which the fragments were obtained')
     parser.add_argument('--output_directory', type=str, help='Output folder path', required= False)
     parser.add_argument('--file_path', type=str, help='Path to input text file, if not specified there are default values', required= False)
-    parser.add_argument('--spurius_directory', type=str, help='Path to the folder generated by DAFNE, the outermost one, in order to derive the spurious fragments', required= False)
-   
+    parser.add_argument('--spurius_directory', type=str, help='Path to the folder generated by DAFNE, the outermost one, or to a spurious pool index, in order to derive the spurious fragments', required= False)
+    parser.add_argument('--spurius_match', type=str, choices=spurius_pool.MATCH_MODES, default='none', help='With a spurious pool, draw fragments close in size and/or colour to the dataset ones', required= False)
+    parser.add_argument('--mode', type=str, choices=REMOVAL_MODES, default='copy', help='copy the surviving fragments, hard link them, or only write a manifest that points to them', required= False)
 
     args = parser.parse_args()
 
@@ -120,11 +199,11 @@ def main():
             num_spurius = int(input_data.get("num_spurius"))
 
 
-    path, num_fragments = random_fragments_removal(seed, input_directory, output_directory, removal_percentage, original_image)
+    path, num_fragments = random_fragments_removal(seed, input_directory, output_directory, removal_percentage, original_image, mode=args.mode)
 
     if num_spurius !=0 and args.spurius_directory is not None:
         spurius_directory = args.spurius_directory
-        add_spurius_fragments(path, spurius_directory, num_spurius, num_fragments)
+        add_spurius_fragments(path, spurius_directory, num_spurius, num_fragments, args.spurius_match)
     else:
         sys.stderr.write('\r\nskip spurious operation\n')
         sys.stderr.write('\rparameter missing: need "num_spurius", int > 0, in the text file and folder to select the spurious\n')
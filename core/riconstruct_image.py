@@ -1,78 +1,189 @@
 import os
-import cv2
+from . import lazy
+cv2 = lazy.lazy_import("cv2")
+import math
 import sys
-import glob
 from . import io_tools
-import numpy as np
-from PIL import Image, ImageDraw
+from . import fragment_io
+np = lazy.lazy_import("numpy")
+Image = lazy.lazy_import("PIL.Image")
+
+
+def paste_fragment(canvas, fragment_array, position, where=None):
+    # copies the non transparent pixels of the fragment, dropping the ones outside the canvas;
+    # where, a boolean mask as large as the canvas, limits the copy to part of it
+    x, y = position
+    height, width = fragment_array.shape[:2]
+    x0 = max(0, -x)
+    y0 = max(0, -y)
+    x1 = min(width, canvas.shape[1] - x)
+    y1 = min(height, canvas.shape[0] - y)
+    if x1 <= x0 or y1 <= y0:
+        return
+
+    region = fragment_array[y0:y1, x0:x1]
+    mask = region[:, :, 3] != 0
+    if where is not None:
+        mask &= where[y + y0:y + y1, x + x0:x + x1]
+    canvas[y + y0:y + y1, x + x0:x + x1][mask] = region[mask]
+
+
+def derotated_fragment(fragment, diff, angle):
+    # the fragment back in its original orientation, as an RGBA array, and where it goes on the canvas
+    size = fragment.size
+    fragment_rotate = fragment.convert("RGBA").rotate((-angle), expand=True)
+    weight, height = fragment_rotate.size
+
+    diff_x = diff[0] - ((weight - size[0])//2)
+    diff_y = diff[1] - ((height - size[1])//2)
+    return np.asarray(fragment_rotate), (diff_x, diff_y)
+
+
+def affine_footprint(size, affine):
+    # (x0, y0, x1, y1), the pixels of the image a stored fragment of the given size covers through its affine
+    width, height = size
+    corners = np.array([[-0.5, -0.5, 1], [width - 0.5, -0.5, 1], [-0.5, height - 0.5, 1], [width - 0.5, height - 0.5, 1]]) @ np.transpose(affine)
+    x0, y0 = np.floor(corners.min(axis=0)).astype(int)
+    x1, y1 = np.ceil(corners.max(axis=0)).astype(int) + 1
+    return int(x0), int(y0), int(x1), int(y1)
+
+
+def back_projected_fragment(fragment, affine):
+    # derotated_fragment for tightly rotated fragments: one warpAffine through the inverse of the stored affine,
+    # straight onto the footprint of the fragment in the image
+    x0, y0, x1, y1 = affine_footprint(fragment.size, affine)
+    to_stored = cv2.invertAffineTransform(np.asarray(affine, dtype=np.float64))
+    to_stored[:, 2] += to_stored[:, :2] @ (x0, y0)
+    fragment_array = np.ascontiguousarray(np.asarray(fragment.convert("RGBA")))
+    back = cv2.warpAffine(fragment_array, to_stored, (x1 - x0, y1 - y0), flags=cv2.INTER_NEAREST | cv2.WARP_INVERSE_MAP)
+    return back, (x0, y0)
+
+
+def placed_fragment(fragment, diff, angle, affine=None):
+    # affine, the one stored for tightly rotated fragments, wins over diff and angle
+    if affine is not None:
+        return back_projected_fragment(fragment, affine)
+    return derotated_fragment(fragment, diff, angle)
+
+
+def derotate_fragment(canvas, fragment, diff, angle, affine=None):
+    fragment_array, position = placed_fragment(fragment, diff, angle, affine)
+    paste_fragment(canvas, fragment_array, position)
+
+
+def footprint_box(size, diff):
+    # a box that holds the derotated fragment whatever the angle: it keeps the centre of the stored
+    # fragment and is at most as wide as its diagonal
+    half = math.hypot(size[0], size[1]) / 2 + 1
+    center_x = diff[0] + size[0] / 2
+    center_y = diff[1] + size[1] / 2
+    return (center_x - half, center_y - half, center_x + half, center_y + half)
+
+
+def open_original(image_path):
+    # the original image, a PIL image, or a read only memory map for .npy images so that they are never loaded whole
+    if image_path.endswith(".npy"):
+        return np.load(image_path, mmap_mode="r")
+    return Image.open(image_path)
+
+
+def ricostruction_background(image, strip_height=256):
+    # the original image in gray, half transparent, under the fragments; arrays, e.g. the memory map of a .npy
+    # image, are converted strip by strip
+    if isinstance(image, np.ndarray):
+        height, width = image.shape[:2]
+        background = np.empty((height, width, 4), dtype=np.uint8)
+        background[:, :, 3] = 128
+        for y0 in range(0, height, strip_height):
+            strip = np.ascontiguousarray(image[y0:y0 + strip_height], dtype=np.uint8)
+            if strip.ndim == 3:
+                strip = cv2.cvtColor(strip, cv2.COLOR_RGBA2GRAY if strip.shape[2] == 4 else cv2.COLOR_RGB2GRAY)
+            background[y0:y0 + strip_height, :, :3] = strip[:, :, None]
+        return background
 
-
-def image_name(url):
-    split_url = url.split("/")
-    file_name = split_url[-1]
-    name, _ = os.path.splitext(file_name)
-    return name
+    final_image = Image.new('RGBA', image.size, (255, 255, 255, 0))
+    image_gray = Image.fromarray(cv2.cvtColor(cv2.cvtColor(np.array(image), cv2.COLOR_RGBA2GRAY), cv2.COLOR_GRAY2RGBA))
+    alpha_value = 128
+    image_gray.putalpha(alpha_value)
+    final_image.paste(image_gray, (0, 0))
+    return np.array(final_image)
 
 
-def read_info_file(path):
-    info = {}
-    file_pattern = os.path.join(path, "*.txt")
-    info_path = glob.glob(file_pattern)[0]
-    with open(info_path, "r") as file:
-        for line in file:
-            if len(line.strip().split(':')) == 2:
-                name, data = line.strip().split(':')
-                values = data.strip().split(';')
-                coordinates = eval(values[0])
-                diff = eval(values[1])
-                angle = float(values[2])
-                info[name] = (coordinates, diff, angle)
+def ricostruct_fragments(image, fragments):
+    # in memory reconstruction, fragments are (point, diff, image, angle, params) as returned by
+    # fragmentation_erosion.rotate_fragment; returns the RGBA canvas as an array
+    canvas = ricostruction_background(image)
+    for _, diff, fragment, angle, params in fragments:
+        derotate_fragment(canvas, fragment, diff, angle, io_tools.record_affine(params))
+    return canvas
 
-    return info
-                    
 
-def image_ricostruction(image_path, path):
+def image_ricostruction(image_path, path, fragments=None):
 
     sys.stderr.write('\r\nimage ricostruction\n')
 
-    image = Image.open(image_path)
+    image = open_original(image_path)
     info_path = os.path.join(path, "resources")
-    fragment_path = os.path.join(path, "fragments")
 
     image_path = os.path.join(path,"ricostructed_image.png")
-    final_image = Image.new('RGBA', image.size, (255, 255, 255, 0))
-    image_gray = Image.fromarray(cv2.cvtColor(cv2.cvtColor(np.array(image), cv2.COLOR_RGBA2GRAY), cv2.COLOR_GRAY2RGBA))
-    draw = ImageDraw.Draw(final_image)
-    alpha_value = 128
-    image_gray.putalpha(alpha_value)
-    final_image.paste(image_gray, (0, 0))
-
-    ricostruction_info = io_tools.read_info_file(info_path)
 
-    img_extension = ['.jpg', '.jpeg', '.png']
-
-    for filename in os.listdir(fragment_path):
-        file_path = os.path.join(fragment_path, filename)
-        if os.path.isfile(file_path) is not None and filename.endswith(tuple(img_extension)):
-            fragment = Image.open(file_path)
-            name = image_name(file_path)
+    if fragments is not None:
+        # fragments still in memory
+        canvas = ricostruct_fragments(image, fragments)
+    else:
+        canvas = ricostruction_background(image)
+        ricostruction_info = io_tools.read_info_file(info_path)
+        affines = io_tools.read_fragment_affines(info_path)
+        store = fragment_io.open_fragment_store(path)
+
+        # name order, the same order the fragments have in memory
+        for name in store.names():
             if name in ricostruction_info:
                 _, diff, angle = ricostruction_info[name]
-                size = fragment.size
-                fragment_rotate = fragment.rotate((-angle), expand=True)
-                weight, height = fragment_rotate.size
-                _, _, _, a = fragment_rotate.split()
-
-                diff_x = diff[0] - ((weight - size[0])//2)
-                diff_y = diff[1] - ((height - size[1])//2)
-                for x in range(weight):
-                    for y in range(height):
-                        if a.getpixel((x, y)) != 0:
-                            pixel = fragment_rotate.getpixel((x, y))
-                            draw.point((x + diff_x, y + diff_y), fill=pixel)
-
-    final_image.save(image_path, 'PNG')
-    sys.stderr.write(f'\rdone\n')
+                derotate_fragment(canvas, store.load(name), diff, angle, affines.get(name))
+        store.close()
 
+    Image.fromarray(canvas, "RGBA").save(image_path, 'PNG')
+    sys.stderr.write(f'\rdone\n')
 
 
+def subtract_fragments(image, canvas, info, removed, load, sizes=None, affines=None):
+    # turns canvas, the reconstruction of every fragment in info, into the one without the removed fragments.
+    # Pixels no removed fragment covers keep the fragment pasted last; the others go back to the background
+    # and get the kept fragments that overlap them again, pasted in name order as image_ricostruction does.
+    # info maps names to (coordinate, diff, angle), load(name) gives the fragment image, sizes maps names to
+    # the stored (width, height) and lets fragments far from the removed ones be skipped without loading them;
+    # affines maps the names of tightly rotated fragments to their affine
+    removed = set(removed)
+    affines = affines or {}
+    dirty = np.zeros(canvas.shape[:2], dtype=bool)
+    removed_boxes = []
+    for name in sorted(removed):
+        _, diff, angle = info[name]
+        fragment_array, (x, y) = placed_fragment(load(name), diff, angle, affines.get(name))
+        height, width = fragment_array.shape[:2]
+        x0, y0 = max(0, x), max(0, y)
+        x1, y1 = min(canvas.shape[1], x + width), min(canvas.shape[0], y + height)
+        if x1 > x0 and y1 > y0:
+            dirty[y0:y1, x0:x1] |= fragment_array[y0 - y:y1 - y, x0 - x:x1 - x, 3] != 0
+        removed_boxes.append((x, y, x + width, y + height))
+
+    canvas[dirty] = ricostruction_background(image)[dirty]
+    removed_boxes = np.array(removed_boxes, dtype=np.float64).reshape(-1, 4)
+
+    for name in sorted(info):
+        if name in removed:
+            continue
+        _, diff, angle = info[name]
+        if sizes is not None and name in sizes:
+            if name in affines:
+                box = affine_footprint(sizes[name], affines[name])
+            else:
+                box = footprint_box(sizes[name], diff)
+            overlaps = ((removed_boxes[:, 0] < box[2]) & (box[0] < removed_boxes[:, 2]) &
+                        (removed_boxes[:, 1] < box[3]) & (box[1] < removed_boxes[:, 3]))
+            if not overlaps.any():
+                continue
+        fragment_array, position = placed_fragment(load(name), diff, angle, affines.get(name))
+        paste_fragment(canvas, fragment_array, position, dirty)
+    return canvas
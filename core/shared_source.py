@@ -0,0 +1,65 @@
+import atexit
+from . import lazy
+np = lazy.lazy_import("numpy")
+shared_memory = lazy.lazy_import("multiprocessing.shared_memory")
+
+
+# The decoded image, the label map and the cell bounding boxes of a fragmentation, published once in shared memory
+# for process pools: workers attach to the same pages instead of decoding the image again or receiving a pickled
+# copy of every fragment. Segments are unlinked when the SharedSource is closed, at interpreter exit otherwise, and
+# by the resource tracker of multiprocessing when the process that created them dies before either.
+
+
+# segments attached by this process, they must outlive the arrays built on them
+ATTACHED = []
+
+
+class SharedSource:
+
+    def __init__(self, pixels, label_map, bounding_boxes):
+        self.segments = []
+        try:
+            self.descriptor = (self._publish(pixels), self._publish(label_map),
+                               tuple(self._publish(boxes) for boxes in bounding_boxes))
+        except BaseException:
+            self.close()
+            raise
+        atexit.register(self.close)
+
+    def _publish(self, array):
+        array = np.asarray(array)
+        segment = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self.segments.append(segment)
+        np.ndarray(array.shape, dtype=array.dtype, buffer=segment.buf)[...] = array
+        return segment.name, array.shape, array.dtype.str
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+            try:
+                segment.unlink()
+            except FileNotFoundError:
+                pass
+        self.segments = []
+        atexit.unregister(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def attach_array(name, shape, dtype):
+    segment = shared_memory.SharedMemory(name=name)
+    ATTACHED.append(segment)
+    return np.ndarray(shape, dtype=np.dtype(dtype), buffer=segment.buf)
+
+
+def attach(descriptor):
+    # (pixels, label_map, bounding_boxes) of a SharedSource.descriptor, read only views on the shared pages
+    pixels, label_map, bounding_boxes = descriptor
+    arrays = [attach_array(*pixels), attach_array(*label_map)] + [attach_array(*boxes) for boxes in bounding_boxes]
+    for array in arrays:
+        array.flags.writeable = False
+    return arrays[0], arrays[1], tuple(arrays[2:])
@@ -0,0 +1,190 @@
+import os
+import re
+import sys
+import json
+import argparse
+from . import lazy
+np = lazy.lazy_import("numpy")
+from . import io_tools
+from . import fragment_io
+
+
+# An index of the fragments of many DAFNE datasets to draw spurious fragments from. It is built once, with the
+# size and the mean colour of every fragment, so sampling needs no directory listing and no decoding, and the
+# spurious fragments can be matched in size and colour to the dataset they are added to.
+
+
+POOL_VERSION = 1
+POOL_COLUMNS = ("dataset", "name", "file", "width", "height", "pixel_count", "mean_r", "mean_g", "mean_b")
+MATCH_MODES = ("none", "size", "colour", "both")
+
+
+def source_image_name(dataset_path):
+    # datasets are named <image>-<date>_<time>, removal datasets remove_<image>-<date>_<time>,
+    # with a numeric suffix when the folder already existed; resumable runs use the run key instead of the time
+    name = re.sub(r"-(\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2}(_\d+)?|[0-9a-f]{16})$", "", os.path.basename(os.path.normpath(dataset_path)))
+    return name[len("remove_"):] if name.startswith("remove_") else name
+
+
+def colour_stats(image):
+    # (pixel_count, mean red, mean green, mean blue) of the visible pixels of a fragment
+    pixels = np.asarray(image.convert("RGBA"))
+    visible = pixels[:, :, 3] != 0
+    pixel_count = int(visible.sum())
+    if pixel_count == 0:
+        return 0, 0.0, 0.0, 0.0
+    mean = pixels[visible][:, :3].mean(axis=0)
+    return pixel_count, float(mean[0]), float(mean[1]), float(mean[2])
+
+
+def build_pool(dataset_paths, pool_path):
+    # pool_path is the JSON index written, paths inside it are relative to its folder
+    pool_directory = os.path.dirname(os.path.abspath(pool_path))
+    os.makedirs(pool_directory, exist_ok=True)
+    datasets = []
+    columns = {column: [] for column in POOL_COLUMNS}
+
+    for dataset_path in dataset_paths:
+        store = fragment_io.open_fragment_store(dataset_path)
+        sys.stderr.write(f'\r\nindexing {len(store.names())} fragments of {dataset_path}\n')
+        for name in store.names():
+            # views are resolved to the dataset that stores the bytes
+            source_path, source_name = store.source(name)
+            source_path = os.path.relpath(source_path, pool_directory)
+            if source_path not in datasets:
+                datasets.append(source_path)
+            image = store.load(name)
+            pixel_count, mean_r, mean_g, mean_b = colour_stats(image)
+
+            file_name = None
+            if store.storage == "folder":
+                file_name = os.path.basename(store.file_path(name))
+            columns["dataset"].append(datasets.index(source_path))
+            columns["name"].append(source_name)
+            columns["file"].append(file_name)
+            columns["width"].append(image.width)
+            columns["height"].append(image.height)
+            columns["pixel_count"].append(pixel_count)
+            columns["mean_r"].append(mean_r)
+            columns["mean_g"].append(mean_g)
+            columns["mean_b"].append(mean_b)
+        store.close()
+
+    pool = {
+        "pool_version": POOL_VERSION,
+        "datasets": datasets,
+        "source_images": [source_image_name(dataset) for dataset in datasets],
+        "columns": columns,
+    }
+    with open(pool_path + ".tmp", "w") as pool_file:
+        json.dump(pool, pool_file)
+    os.replace(pool_path + ".tmp", pool_path)
+    sys.stderr.write(f'\r{len(columns["name"])} fragments indexed in {pool_path}\n')
+    return pool_path
+
+
+def is_pool(path):
+    return os.path.isfile(path) and path.endswith(".json")
+
+
+class SpuriusPool:
+
+    def __init__(self, pool_path):
+        with open(pool_path, "r") as pool_file:
+            pool = json.load(pool_file)
+        if pool.get("pool_version") != POOL_VERSION:
+            raise ValueError(f"unsupported spurious pool version {pool.get('pool_version')} in {pool_path}")
+        pool_directory = os.path.dirname(os.path.abspath(pool_path))
+        self.datasets = [os.path.normpath(os.path.join(pool_directory, dataset)) for dataset in pool["datasets"]]
+        self.source_images = pool["source_images"]
+        self.names = pool["columns"]["name"]
+        self.files = pool["columns"]["file"]
+        self.dataset = np.asarray(pool["columns"]["dataset"], dtype=np.int64)
+        self.pixel_count = np.asarray(pool["columns"]["pixel_count"], dtype=np.float64)
+        self.colour = np.stack([np.asarray(pool["columns"][column], dtype=np.float64) for column in ("mean_r", "mean_g", "mean_b")], axis=1)
+        self.stores = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def sample(self, num_spurius, rng, target=None, match="none", exclude_image=None):
+        # indices of num_spurius fragments. Without matching it's rng.sample over the index, O(num_spurius);
+        # with matching the draw is among the fragments closest to target, (pixel_counts, mean colour),
+        # in log size and/or colour. Fragments cut from exclude_image are never drawn
+        candidates = np.arange(len(self.names))
+        if exclude_image is not None:
+            excluded = [index for index, image in enumerate(self.source_images) if image == exclude_image]
+            candidates = candidates[~np.isin(self.dataset, excluded)]
+        if match == "none" or target is None:
+            if exclude_image is None:
+                return rng.sample(range(len(self.names)), num_spurius)
+            return [int(candidates[i]) for i in rng.sample(range(len(candidates)), num_spurius)]
+
+        pixel_counts, colour = target
+        distance = np.zeros(len(candidates))
+        if match in ("size", "both"):
+            # how many spreads of the target sizes a fragment is from their median, in log scale
+            sizes = np.log1p(np.asarray(pixel_counts, dtype=np.float64))
+            spread = max(np.percentile(sizes, 90) - np.percentile(sizes, 10), 0.1)
+            distance += np.abs(np.log1p(self.pixel_count[candidates]) - np.median(sizes)) / spread
+        if match in ("colour", "both"):
+            distance += np.linalg.norm(self.colour[candidates] - np.asarray(colour), axis=1) / 64
+        # the nearest ones, a few times more than needed so the choice is still random
+        nearest = min(len(candidates), max(8 * num_spurius, 64))
+        nearest = np.sort(candidates[np.argpartition(distance, nearest - 1)[:nearest]])
+        return [int(nearest[i]) for i in rng.sample(range(len(nearest)), num_spurius)]
+
+    def _store(self, index):
+        dataset_path = self.datasets[self.dataset[index]]
+        if dataset_path not in self.stores:
+            self.stores[dataset_path] = fragment_io.open_fragment_store(dataset_path)
+        return self.stores[dataset_path]
+
+    def read(self, index):
+        # (extension, encoded bytes); fragments stored one per file are read without listing their folder
+        if self.files[index] is not None:
+            file_path = os.path.join(self.datasets[self.dataset[index]], "fragments", self.files[index])
+            with open(file_path, "rb") as fragment_file:
+                return os.path.splitext(file_path)[1], fragment_file.read()
+        return self._store(index).read(self.names[index])
+
+    def source(self, index):
+        return self.datasets[self.dataset[index]], self.names[index]
+
+    def close(self):
+        for store in self.stores.values():
+            store.close()
+        self.stores = {}
+
+
+def dataset_stats(path, max_fragments=32):
+    # (pixel_counts, mean colour) of the dataset spurious fragments are matched to; the colour is the
+    # mean of up to max_fragments evenly spaced fragments
+    resources_path = os.path.join(path, "resources")
+    store = fragment_io.open_fragment_store(path)
+    names = store.names()
+    step = max(1, len(names) // max_fragments)
+    stats = [colour_stats(store.load(name)) for name in names[::step][:max_fragments]]
+    store.close()
+
+    if os.path.exists(os.path.join(resources_path, io_tools.FRAGMENT_TABLE)):
+        pixel_counts = io_tools.read_fragment_table(resources_path)["columns"]["pixel_count"]
+    else:
+        pixel_counts = [pixel_count for pixel_count, _, _, _ in stats]
+    weights = np.asarray([pixel_count for pixel_count, _, _, _ in stats], dtype=np.float64)
+    colours = np.asarray([stat[1:] for stat in stats], dtype=np.float64)
+    colour = (colours * weights[:, np.newaxis]).sum(axis=0) / max(weights.sum(), 1)
+    return pixel_counts, colour
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Builds the index of a pool of spurious fragments from datasets generated by DAFNE')
+    parser.add_argument('pool_path', type=str, help='Path of the JSON index to write')
+    parser.add_argument('dataset_directories', type=str, nargs='+', help='Datasets generated by DAFNE, the outermost folders')
+
+    args = parser.parse_args()
+    build_pool(args.dataset_directories, args.pool_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+import os
+import sys
+import json
+import random
+import argparse
+import itertools
+from . import lazy
+concurrent_futures = lazy.lazy_import("concurrent.futures")
+from . import io_tools
+from . import fragment_io
+from . import riconstruct_image
+from . import remove_fragments
+from . import fragmentation_erosion
+from . import shared_source
+from . import spurius_pool
+from .DAFNE import DEFAULT_PARAMETERS
+
+
+# Parameter sweeps: every combination of a grid is the dataset DAFNE would generate from a parameters file with those
+# values, but the work they share is done once. The combinations form a tree, image and cut (points, Voronoi map,
+# combined cells) -> erosion, degradation and rotation -> removal -> spurious fragments: a cut is computed once for
+# all its erosions, and so on down. The nodes under a cut run on a process pool that reads the pixels and the label
+# map from shared memory. sweep_manifest.json lists every combination with the datasets generated for it.
+
+
+SWEEP_VERSION = 1
+SWEEP_MANIFEST = "sweep_manifest.json"
+
+PARAMETER_TYPES = {"seed": int, "num_fragments": int, "min_distance": int, "sampler": str, "merge_chain": int,
+                   "erosion_probability": float, "erosion_percentage": float, "erosion_mode": str, "rotation": str,
+                   "fragment_format": str, "compress_level": int, "storage": str, "shard_size": int,
+                   "removal_percentage": float, "num_spurius": lambda value: int(float(value))}
+
+# the parameters each level of the tree depends on, on top of the ones of the levels above
+CUT_KEYS = ("seed", "num_fragments", "min_distance", "sampler", "merge_chain")
+EROSION_KEYS = ("erosion_probability", "erosion_percentage", "erosion_mode", "rotation", "fragment_format", "compress_level",
+                "storage", "shard_size")
+REMOVAL_KEYS = ("removal_percentage",)
+
+
+def read_sweep(file_path):
+    # a parameters file like the one of DAFNE where any value can be a comma separated list: the parameter sets are
+    # every combination of the lists, in file order
+    input_data = io_tools.read_input_from_file(file_path)
+    if input_data is None:
+        raise ValueError(f"can't read the sweep file '{file_path}'")
+    grid = {}
+    for key, value in input_data.items():
+        if key not in PARAMETER_TYPES:
+            raise ValueError(f"'{key}' in {file_path} can't be swept, expected one of {', '.join(PARAMETER_TYPES)}")
+        grid[key] = [PARAMETER_TYPES[key](item.strip()) for item in value.split(",")]
+    return [dict(zip(grid, values)) for values in itertools.product(*grid.values())]
+
+
+def node_key(parameters, keys):
+    return tuple((key, parameters[key]) for key in keys)
+
+
+def sweep_plan(parameter_sets):
+    # the tree of the sweep, cut -> erosion -> removal -> set of num_spurius, every key a tuple of (parameter, value)
+    plan = {}
+    for parameter_set in parameter_sets:
+        parameters = dict(DEFAULT_PARAMETERS, **parameter_set)
+        removals = plan.setdefault(node_key(parameters, CUT_KEYS), {}).setdefault(node_key(parameters, EROSION_KEYS), {})
+        removals.setdefault(node_key(parameters, REMOVAL_KEYS), set()).add(parameters["num_spurius"])
+    return plan
+
+
+# the sources process pool workers attached to, by the descriptor they were published with
+ATTACHED_SOURCES = {}
+
+
+def worker_source(source):
+    # source is a FragmentSource, or the descriptor of a shared_source.SharedSource when running in a pool
+    if isinstance(source, fragmentation_erosion.FragmentSource):
+        return source
+    key = source[0][0]
+    if key not in ATTACHED_SOURCES:
+        ATTACHED_SOURCES[key] = fragmentation_erosion.FragmentSource(*shared_source.attach(source))
+    return ATTACHED_SOURCES[key]
+
+
+def erosion_task(url, output_directory, parameters, cells, random_state, source):
+    # the dataset of one erosion of a cut, with its reconstruction; returns its path
+    source = worker_source(source)
+    geometry = (cells, source.label_map, source.bounding_boxes, source.pixels, random_state)
+    path, fragments = fragmentation_erosion.generate_fragments(url, output_directory, parameters["num_fragments"], parameters["min_distance"],
+                                                               parameters["seed"], parameters["erosion_probability"],
+                                                               parameters["erosion_percentage"], parameters["sampler"], return_fragments=True,
+                                                               fragment_format=parameters["fragment_format"],
+                                                               compress_level=parameters["compress_level"], storage=parameters["storage"],
+                                                               shard_size=parameters["shard_size"], erosion_mode=parameters["erosion_mode"],
+                                                               merge_chain=parameters["merge_chain"], rotation=parameters["rotation"],
+                                                               geometry=geometry)
+    riconstruct_image.image_ricostruction(url, path, fragments)
+    return path
+
+
+def removal_task(url, output_directory, path, parameters, spurius_counts, spurius_directory, removal_mode, spurius_match):
+    # the removal dataset of path and, for every num_spurius in spurius_counts, the dataset with the spurious fragments
+    # added, each drawn from the random stream the removal leaves behind as DAFNE does; returns num_spurius -> path
+    removal_path, num_fragments = remove_fragments.random_fragments_removal(parameters["seed"], path, output_directory,
+                                                                            parameters["removal_percentage"], url, mode=removal_mode)
+    random_state = random.getstate()
+    counts = sorted(count for count in spurius_counts if count != 0)
+    paths = {count: removal_path for count in spurius_counts}
+    if counts and spurius_directory is None:
+        sys.stderr.write('\r\nskip spurious operation, no spurius_directory\n')
+        return paths
+
+    for i, count in enumerate(counts):
+        # the last one is added to the removal dataset itself, unless that one is a combination of the sweep too
+        if i == len(counts) - 1 and 0 not in spurius_counts:
+            spurius_path = removal_path
+        else:
+            spurius_path, _, _ = io_tools.create_folder(f"remove_{io_tools.image_name(url)}", output_directory)
+            fragment_io.clone_dataset(removal_path, spurius_path)
+        random.setstate(random_state)
+        remove_fragments.add_spurius_fragments(spurius_path, spurius_directory, count, num_fragments, spurius_match)
+        paths[count] = spurius_path
+    return paths
+
+
+def map_tasks(pool, task, argument_lists):
+    # task on every argument list, in the pool when there is one, results in order
+    if pool is None:
+        return [task(*arguments) for arguments in argument_lists]
+    futures = [pool.submit(task, *arguments) for arguments in argument_lists]
+    return [future.result() for future in futures]
+
+
+def sweep_image(url, output_directory, plan, spurius_directory=None, workers=None, removal_mode="copy", spurius_match="none"):
+    # runs the plan of sweep_plan on one image; returns {(cut, erosion): path} and {(cut, erosion, removal, num_spurius): path}
+    datasets = {}
+    removal_datasets = {}
+    for cut, erosions in plan.items():
+        parameters = dict(DEFAULT_PARAMETERS, **dict(cut))
+        cells, label_map, bounding_boxes, pixels, random_state = fragmentation_erosion.cut_geometry(url, parameters["num_fragments"],
+                                                                                                    parameters["min_distance"], parameters["seed"],
+                                                                                                    parameters["sampler"],
+                                                                                                    merge_chain=parameters["merge_chain"])
+        pool = None
+        shared = None
+        source = fragmentation_erosion.FragmentSource(pixels, label_map, bounding_boxes)
+        if workers is not None:
+            shared = shared_source.SharedSource(pixels, label_map, bounding_boxes)
+            source = shared.descriptor
+            pool = concurrent_futures.ProcessPoolExecutor(max_workers=workers)
+        del pixels, label_map
+        try:
+            erosion_keys = list(erosions)
+            paths = map_tasks(pool, erosion_task, [(url, output_directory, dict(parameters, **dict(erosion)), cells, random_state, source)
+                                                   for erosion in erosion_keys])
+            datasets.update(((cut, erosion), path) for erosion, path in zip(erosion_keys, paths))
+
+            removal_nodes = [(erosion, removal, spurius_counts) for erosion in erosion_keys
+                             for removal, spurius_counts in erosions[erosion].items() if dict(removal)["removal_percentage"] != 0]
+            removal_paths = map_tasks(pool, removal_task, [(url, output_directory, datasets[(cut, erosion)],
+                                                            dict(parameters, **dict(erosion), **dict(removal)), spurius_counts,
+                                                            spurius_directory, removal_mode, spurius_match)
+                                                           for erosion, removal, spurius_counts in removal_nodes])
+            for (erosion, removal, _), spurius_paths in zip(removal_nodes, removal_paths):
+                removal_datasets.update(((cut, erosion, removal, count), path) for count, path in spurius_paths.items())
+        finally:
+            if pool is not None:
+                pool.shutdown()
+            if shared is not None:
+                shared.close()
+    return datasets, removal_datasets
+
+
+def run_sweep(file_paths, output_directory, parameter_sets, spurius_directory=None, workers=None, removal_mode="copy", spurius_match="none"):
+    # every parameter set on every image; writes sweep_manifest.json in output_directory and returns its path
+    plan = sweep_plan(parameter_sets)
+    variants = []
+    for url in file_paths:
+        datasets, removal_datasets = sweep_image(url, output_directory, plan, spurius_directory, workers, removal_mode, spurius_match)
+        for parameter_set in parameter_sets:
+            parameters = dict(DEFAULT_PARAMETERS, **parameter_set)
+            cut, erosion, removal = (node_key(parameters, keys) for keys in (CUT_KEYS, EROSION_KEYS, REMOVAL_KEYS))
+            removal_path = removal_datasets.get((cut, erosion, removal, parameters["num_spurius"]))
+            variants.append({"image": url, "parameters": {key: parameters[key] for key in PARAMETER_TYPES},
+                             "path": os.path.relpath(datasets[(cut, erosion)], output_directory),
+                             "removal_path": os.path.relpath(removal_path, output_directory) if removal_path is not None else None})
+
+    nodes = {"cut": len(plan), "erosion": sum(len(erosions) for erosions in plan.values()),
+             "removal": sum(1 for erosions in plan.values() for removals in erosions.values()
+                            for removal in removals if dict(removal)["removal_percentage"] != 0)}
+    manifest = {"sweep_version": SWEEP_VERSION, "images": list(file_paths), "nodes": nodes, "variants": variants}
+    manifest_path = os.path.join(output_directory, SWEEP_MANIFEST)
+    with open(manifest_path + ".tmp", "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=1)
+    os.replace(manifest_path + ".tmp", manifest_path)
+    sys.stderr.write(f'\r\n{len(variants)} variants from {nodes["cut"]} cuts, {nodes["erosion"]} erosions and {nodes["removal"]} removals '
+                     f'per image, listed in {manifest_path}\n')
+    return manifest_path
+
+
+def main():
+    output_directory = os.path.dirname(os.path.abspath(__file__))
+
+    parser = argparse.ArgumentParser(description='Generates the datasets of every combination of a parameter grid, computing what combinations share once')
+    parser.add_argument('input_directory', type=str, help='path to the input folder that contains the images')
+    parser.add_argument('sweep_files', type=str, nargs='+', help='Parameters files as the one of DAFNE, any value can be a comma separated list of values to sweep')
+    parser.add_argument('--output_directory', type=str, help='Output folder path', required= False)
+    parser.add_argument('--workers', type=int, help='Number of processes the erosions and removals of a cut are spread across', required= False)
+    parser.add_argument('--spurius_directory', type=str, help='Path to the folder generated by DAFNE, the outermost one, or to a spurious pool index, in order to derive the spurious fragments', required= False)
+    parser.add_argument('--spurius_match', type=str, choices=spurius_pool.MATCH_MODES, default='none', help='With a spurious pool, draw fragments close in size and/or colour to the fragments of the dataset', required= False)
+    parser.add_argument('--removal_mode', type=str, choices=remove_fragments.REMOVAL_MODES, default='copy', help='copy the fragments that survive the removal, hard link them, or only write a manifest that points to them', required= False)
+
+    args = parser.parse_args()
+
+    if args.output_directory is not None:
+        output_directory = args.output_directory
+
+    parameter_sets = []
+    for sweep_file in args.sweep_files:
+        parameter_sets.extend(read_sweep(sweep_file))
+
+    img_extension = ['.jpg', '.jpeg', '.png']
+    file_paths = []
+    for filename in sorted(os.listdir(args.input_directory)):
+        file_path = os.path.join(args.input_directory, filename)
+        if os.path.isfile(file_path) and filename.endswith(tuple(img_extension)):
+            file_paths.append(file_path)
+
+    run_sweep(file_paths, output_directory, parameter_sets, args.spurius_directory, args.workers, args.removal_mode, args.spurius_match)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+import os
+import math
+import random
+import shutil
+import tempfile
+from . import lazy
+np = lazy.lazy_import("numpy")
+Image = lazy.lazy_import("PIL.Image")
+from . import io_tools
+from . import fragment_io
+from . import instrumentation
+from . import fragmentation_erosion
+
+
+# Fragmentation of images that don't fit in memory. The source is read through a memory map and
+# the label map is never built as a whole: a first pass labels the image one strip at a time to find
+# the bounding box of every cell, a second pass labels only the bounding box of each fragment, cuts
+# it and hands it over as soon as it is ready. Labels are exact without any overlap between strips,
+# because every tile is matched against the whole set of seeds.
+
+
+def open_source(url, scratch_directory, strip_height=256):
+    # .npy images are memory mapped as they are, any other format is decoded once and copied
+    # strip by strip into an RGBA memory map, so the decoded image can be released right away
+    if url.endswith(".npy"):
+        return np.load(url, mmap_mode="r")
+
+    image = Image.open(url)
+    width, height = image.size
+    source_path = os.path.join(scratch_directory, "source.npy")
+    source = np.lib.format.open_memmap(source_path, mode="w+", dtype=np.uint8, shape=(height, width, 4))
+    for y0 in range(0, height, strip_height):
+        y1 = min(y0 + strip_height, height)
+        source[y0:y1] = np.asarray(image.crop((0, y0, width, y1)).convert("RGBA"))
+    image.close()
+    source.flush()
+    return source
+
+
+def region_rgba(source, x0, y0, x1, y1):
+    region = np.asarray(source[y0:y1, x0:x1])
+    if region.ndim == 2:
+        region = np.dstack([region, region, region])
+    if region.shape[2] == 3:
+        alpha = np.full(region.shape[:2] + (1,), 255, dtype=np.uint8)
+        region = np.concatenate([region, alpha], axis=2)
+    return np.ascontiguousarray(region, dtype=np.uint8)
+
+
+def tiled_bounding_boxes(points, width, height, tile_size, progress=None, neighbours=None):
+    # neighbours, a dict, is filled with the Voronoi adjacency of the cells when given, strips are joined
+    # through their first row and the last row of the strip above
+    bounding_boxes = None
+    last_row = None
+    for y0 in range(0, height, tile_size):
+        y1 = min(y0 + tile_size, height)
+        strip = fragmentation_erosion.voronoi_region(points, 0, y0, width, y1)
+        strip_boxes = fragmentation_erosion.cell_bounding_boxes(strip, len(points), (0, y0))
+        if neighbours is not None:
+            fragmentation_erosion.cell_neighbours(strip, neighbours)
+            if last_row is not None:
+                fragmentation_erosion.cell_neighbours(np.vstack((last_row, strip[:1])), neighbours)
+            last_row = strip[-1:]
+        if bounding_boxes is None:
+            bounding_boxes = strip_boxes
+        else:
+            bounding_boxes = fragmentation_erosion.merge_bounding_boxes(bounding_boxes, strip_boxes)
+        if progress is not None:
+            progress(y1, height)
+    return bounding_boxes
+
+
+def iter_fragments_tiled(url, num_fragments, min_distance, seed, erosion_probability, erosion_percentage, sampler="rejection",
+                         tile_size=1024, scratch_directory=None, monitor=None, merge_chain=None, rotation="expand"):
+    # yields (name, (point, diff, image, angle, params)) top to bottom, in the order the fragments are completed.
+    # Erosion depends on the smallest fragment of the image, that's why the cells are sized in a first pass;
+    # every fragment has its own random stream, the result is the same as generate_fragments with fragment_workers
+    fragmentation_erosion.check_rotation(rotation)
+    if monitor is None:
+        monitor = instrumentation.RunMonitor(hooks=[])
+    scratch = tempfile.mkdtemp(prefix="dafne-", dir=scratch_directory)
+    source = None
+    try:
+        with monitor.stage("source"):
+            source = open_source(url, scratch)
+        height, width = source.shape[:2]
+        monitor.info.update(width=width, height=height)
+
+        with monitor.stage("points"):
+            points = fragmentation_erosion.generate_random_points(min_distance, seed, num_fragments, width, height, sampler)
+            num_combined_fragment = random.randint(1,int(math.sqrt(len(points))))
+        monitor.count("points", len(points))
+
+        with monitor.stage("cells"):
+            neighbours = {} if merge_chain is not None else None
+            bounding_boxes = tiled_bounding_boxes(points, width, height, tile_size, monitor.progress, neighbours)
+            cells = fragmentation_erosion.cell_descriptors(points, bounding_boxes)
+            monitor.count("fragments", len(cells))
+            cells = fragmentation_erosion.combine_cells(cells, num_combined_fragment, merge_chain, neighbours)
+            monitor.count("combined", num_combined_fragment)
+        min_size = fragmentation_erosion.smallest_cell_size(cells)
+        seeds = fragmentation_erosion.fragment_seeds(seed, len(cells))
+        names = io_tools.fragment_names(len(cells))
+
+        min_x, min_y, max_x, max_y = bounding_boxes
+        order = sorted(range(len(cells)), key=lambda index: (max(int(max_y[label]) for label in cells[index][3]), index))
+
+        # the stage includes the time the consumer spends on every fragment, e.g. writing it
+        with monitor.stage("fragments"):
+            for done, index in enumerate(order, 1):
+                point, diff, size, labels = cells[index]
+                x0 = min(int(min_x[label]) for label in labels)
+                y0 = min(int(min_y[label]) for label in labels)
+                x1 = max(int(max_x[label]) for label in labels) + 1
+                y1 = max(int(max_y[label]) for label in labels) + 1
+
+                label_map = fragmentation_erosion.voronoi_region(points, x0, y0, x1, y1)
+                pixels = region_rgba(source, x0, y0, x1, y1)
+                image = fragmentation_erosion.render_fragment(cells[index], pixels, label_map, bounding_boxes, (x0, y0))
+                yield names[index], fragmentation_erosion.erode_and_rotate((point, diff, image), min_distance, erosion_probability,
+                                                                           erosion_percentage, min_size, seeds[index], rotation)
+                monitor.progress(done, len(order))
+    finally:
+        source = None
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def generate_fragments_tiled(url, output_directory, num_fragments, min_distance, seed, erosion_probability, erosion_percentage, sampler="rejection",
+                             tile_size=1024, scratch_directory=None, fragment_format="png", compress_level=None, writer_workers=4,
+                             storage="folder", shard_size=fragment_io.DEFAULT_SHARD_SIZE, monitor=None, merge_chain=None, rotation="expand",
+                             folder_suffix=None):
+    if monitor is None:
+        monitor = instrumentation.RunMonitor()
+    name = io_tools.image_name(url)
+    path, resources_path, fragment_path = io_tools.create_folder(name, output_directory, folder_suffix)
+
+    fragmentation_erosion.generate_info(resources_path, seed, num_fragments, min_distance, erosion_probability, erosion_percentage, sampler,
+                                        merge_chain, rotation)
+    parameters = {"seed": seed, "num_fragments": num_fragments, "min_distance": min_distance, "erosion_probability": erosion_probability,
+                  "erosion_percentage": erosion_percentage, "sampler": sampler}
+    if merge_chain is not None:
+        parameters["merge_chain"] = merge_chain
+    if rotation != "expand":
+        parameters["rotation"] = rotation
+    monitor.info.update(image=url, path=path, parameters=parameters, tile_size=tile_size)
+
+    records = []
+    sink = fragment_io.fragment_sink(path, storage, shard_size)
+    with fragment_io.FragmentWriter(sink, fragment_format, compress_level, writer_workers) as writer:
+        fragments = iter_fragments_tiled(url, num_fragments, min_distance, seed, erosion_probability, erosion_percentage, sampler,
+                                         tile_size, scratch_directory, monitor, merge_chain, rotation)
+        for fragment_name, fragment in fragments:
+            writer.write(fragment_name, fragment[2])
+            records.append(fragmentation_erosion.fragment_record(fragment_name, fragment))
+
+    with monitor.stage("info"):
+        records.sort(key=lambda record: record["name"])
+        fragmentation_erosion.write_info(records, resources_path, parameters)
+    fragmentation_erosion.count_records(monitor, records)
+    monitor.finish(resources_path)
+
+    return path
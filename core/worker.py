@@ -0,0 +1,158 @@
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import argparse
+import importlib
+import threading
+import traceback
+import socketserver
+from contextlib import redirect_stdout
+from . import lazy
+
+
+# A long lived process that runs the command line tools of the package job after job, paying for the interpreter,
+# the imports of NumPy, OpenCV and Pillow and the import of the package once. A job is a JSON line such as
+#   {"id": "a", "command": "DAFNE", "args": ["images/", "--output_directory", "out/"]}
+# read from stdin or from a Unix socket, and runs the main of core.<command> with args as its command line. Every
+# job gets a JSON line back with its id, its status (ok, failed or error), its exit code, the error if any and how
+# long it took. Jobs run one at a time, the tools draw from the global random stream, and what the tools print goes
+# to stderr so that stdout only carries the replies.
+
+
+COMMANDS = ("DAFNE", "remove_fragments", "spurius_pool", "sweep", "benchmark")
+
+# one job at a time, whatever the number of connections
+JOB_LOCK = threading.Lock()
+
+
+def read_job(line):
+    # the job of a JSON line, ValueError when it isn't one
+    try:
+        job = json.loads(line)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"not a JSON job: {e}")
+    if not isinstance(job, dict):
+        raise ValueError("a job is a JSON object")
+    if job.get("command") not in COMMANDS:
+        raise ValueError(f"unknown command '{job.get('command')}', expected one of {', '.join(COMMANDS)}")
+    args = job.get("args", [])
+    if not isinstance(args, list) or not all(isinstance(arg, str) for arg in args):
+        raise ValueError("args is a list of strings")
+    return job
+
+
+def run_job(job):
+    # runs the main of the command of job as `python -m core.<command> <args>` would; returns the reply
+    module = importlib.import_module(f".{job['command']}", __package__)
+    argv = [f"{__package__}.{job['command']}"] + job.get("args", [])
+    exit_code, error = 0, None
+    with JOB_LOCK:
+        saved_argv = sys.argv
+        sys.argv = argv
+        start = time.perf_counter()
+        try:
+            with redirect_stdout(sys.stderr):
+                module.main()
+        except SystemExit as e:
+            # argparse errors, -h and the tools that exit with a status
+            if isinstance(e.code, int):
+                exit_code = e.code
+            elif e.code is not None:
+                exit_code, error = 1, str(e.code)
+        except Exception as e:
+            traceback.print_exc()
+            exit_code, error = 1, f"{type(e).__name__}: {e}"
+        finally:
+            sys.argv = saved_argv
+            seconds = time.perf_counter() - start
+        sys.stderr.flush()
+
+    status = "ok" if exit_code == 0 else ("error" if error is not None else "failed")
+    return {"id": job.get("id"), "status": status, "exit_code": exit_code, "error": error, "seconds": round(seconds, 3)}
+
+
+def handle_line(line):
+    # the reply to one line, None for blank lines
+    if not line.strip():
+        return None
+    try:
+        job = read_job(line)
+    except ValueError as e:
+        return {"id": None, "status": "error", "exit_code": None, "error": str(e), "seconds": 0.0}
+    return run_job(job)
+
+
+def serve_stream(input_stream, output_stream):
+    # one reply line for every job line, until the end of input_stream
+    for line in input_stream:
+        reply = handle_line(line)
+        if reply is not None:
+            output_stream.write(json.dumps(reply) + "\n")
+            output_stream.flush()
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            reply = handle_line(line.decode("utf-8"))
+            if reply is not None:
+                self.wfile.write((json.dumps(reply) + "\n").encode("utf-8"))
+                self.wfile.flush()
+
+
+class JobServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve_socket(path):
+    # serves the jobs sent to the Unix socket at path until interrupted; a socket left behind by a worker that died is
+    # replaced, one another worker is still serving is not
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            os.remove(path)
+        else:
+            sys.stderr.write(f'\r\na worker is already serving {path}\n')
+            sys.exit(1)
+        finally:
+            probe.close()
+
+    # stopping the worker with SIGTERM removes the socket as Ctrl+C does
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    with JobServer(path, JobHandler) as server:
+        sys.stderr.write(f'\r\nworker serving {path}\n')
+        sys.stderr.flush()
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs DAFNE, remove_fragments, spurius_pool, sweep and benchmark jobs, one JSON line each, in a single long lived process')
+    parser.add_argument('--socket', type=str, help='Path of a Unix socket to serve the jobs on, instead of reading them from stdin', required= False)
+    parser.add_argument('--lazy', action='store_true', help='Import NumPy, OpenCV and Pillow with the first job that needs them instead of at start', required= False)
+
+    args = parser.parse_args()
+
+    for command in COMMANDS:
+        importlib.import_module(f".{command}", __package__)
+    if not args.lazy:
+        lazy.preload()
+
+    if args.socket is not None:
+        serve_socket(args.socket)
+    else:
+        serve_stream(sys.stdin, sys.stdout)
+
+
+if __name__ == "__main__":
+    main()
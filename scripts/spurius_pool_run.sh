@@ -0,0 +1,3 @@
+#!/usr/bin/env bash
+# Thin shell wrapper to run the spurious pool CLI
+python -m core.spurius_pool "$@"
@@ -0,0 +1,3 @@
+#!/usr/bin/env bash
+# Thin shell wrapper to run the parameter sweep CLI
+python -m core.sweep "$@"
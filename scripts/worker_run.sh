@@ -0,0 +1,3 @@
+#!/usr/bin/env bash
+# Thin shell wrapper to run the long lived worker that takes jobs from stdin or a socket
+python -m core.worker "$@"
@@ -0,0 +1,40 @@
+import os
+import pytest
+from core import benchmark
+
+
+# Regression tests for the equivalences the optimised code paths rely on: each rewrite is checked against a slow
+# reference or against the path it replaced, on small synthetic images so that the suite runs in seconds.
+
+
+@pytest.fixture(scope="session")
+def image_path(tmp_path_factory):
+    # a 160x120 RGB image with gradients and noise, see benchmark.synthetic_image
+    path = tmp_path_factory.mktemp("images") / "synthetic.png"
+    benchmark.synthetic_image(160, 120, seed=3).save(path)
+    return str(path)
+
+
+@pytest.fixture(scope="session")
+def rgba_image_path(tmp_path_factory):
+    # the same image with a transparent corner, fragments with transparent pixels go through every path
+    image = benchmark.synthetic_image(160, 120, seed=5).convert("RGBA")
+    alpha = image.getchannel("A")
+    alpha.paste(0, (0, 0, 40, 30))
+    image.putalpha(alpha)
+    path = tmp_path_factory.mktemp("images") / "transparent.png"
+    image.save(path)
+    return str(path)
+
+
+def read_dataset(path):
+    # relative path -> bytes of every file of a dataset folder, but the run report with its timings
+    files = {}
+    for folder, _, file_names in os.walk(path):
+        for file_name in file_names:
+            if file_name == "run_report.json":
+                continue
+            file_path = os.path.join(folder, file_name)
+            with open(file_path, "rb") as dataset_file:
+                files[os.path.relpath(file_path, path)] = dataset_file.read()
+    return files
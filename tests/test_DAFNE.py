@@ -0,0 +1,38 @@
+import json
+import os
+from core import DAFNE
+from core import fragment_io
+from core import fragmentation_erosion
+from core import instrumentation
+from core import spurius_pool
+
+
+def test_resumed_views_read_their_spurious_fragments(tmp_path, image_path, rgba_image_path):
+    spurius_path = fragmentation_erosion.generate_fragments(rgba_image_path, str(tmp_path / "spurius"), 30, 4, 1, 0.5, 20,
+                                                            monitor=instrumentation.RunMonitor(hooks=[]))
+    parameters = dict(DAFNE.DEFAULT_PARAMETERS, num_fragments=30, min_distance=4, removal_percentage=30, num_spurius=3,
+                      removal_mode="manifest", resume=True)
+    output_directory = str(tmp_path / "output")
+    os.makedirs(output_directory)
+    path = DAFNE.process_image(image_path, output_directory, parameters, spurius_path)
+    assert not [name for name in os.listdir(output_directory) if name.startswith(".staging")]
+
+    marker_name = [name for name in os.listdir(output_directory) if name.endswith(DAFNE.COMPLETION_MARKER)][0]
+    with open(os.path.join(output_directory, marker_name), "r") as marker_file:
+        removal_path = os.path.join(output_directory, json.load(marker_file)["removal_path"])
+    view = fragment_io.open_fragment_store(removal_path)
+    spurius = view.manifest["spurius"]
+    assert spurius
+    dataset = fragment_io.open_fragment_store(path)
+    source = fragment_io.open_fragment_store(spurius_path)
+    for name in view.names():
+        dataset_path, source_name = view.source(name)
+        expected = source if name in spurius else dataset
+        assert os.path.samefile(dataset_path, expected.dataset_path)
+        assert view.read(name) == expected.read(source_name)
+    for store in (view, dataset, source):
+        store.close()
+
+    pool_path = str(tmp_path / "pool.json")
+    spurius_pool.build_pool([removal_path], pool_path)
+    assert len(spurius_pool.SpuriusPool(pool_path).names) == len(view.names())
@@ -0,0 +1,38 @@
+import pytest
+from PIL import Image
+from core import fragment_io
+
+
+class FailingSink:
+    storage = "folder"
+
+    def write(self, sequence, name, extension, data):
+        raise OSError("disk full")
+
+    def close(self):
+        pass
+
+
+def test_writer_needs_a_worker(tmp_path):
+    with pytest.raises(ValueError):
+        fragment_io.FragmentWriter(str(tmp_path / "fragments"), workers=0)
+
+
+def test_write_errors_are_raised_on_close():
+    with pytest.raises(OSError, match="fragment_0"):
+        with fragment_io.FragmentWriter(FailingSink(), workers=1) as writer:
+            writer.write("fragment_0", Image.new("RGBA", (4, 4)))
+
+
+def test_with_body_exception_wins_over_write_errors():
+    with pytest.raises(KeyError):
+        with fragment_io.FragmentWriter(FailingSink(), workers=1) as writer:
+            writer.write("fragment_0", Image.new("RGBA", (4, 4)))
+            raise KeyError("body")
+
+
+def test_folder_store_needs_its_fragments_folder(tmp_path):
+    # a dataset folder without fragments/ is a wrong path, not an empty dataset
+    (tmp_path / "resources").mkdir()
+    with pytest.raises(FileNotFoundError):
+        fragment_io.open_fragment_store(str(tmp_path))
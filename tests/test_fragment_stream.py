@@ -0,0 +1,24 @@
+import random
+from core import fragmenter
+from core import fragment_stream
+
+
+def test_stream_leaves_the_global_random_module_alone(image_path, rgba_image_path):
+    random.seed(123)
+    expected = [random.random() for _ in range(3)]
+
+    random.seed(123)
+    stream = fragment_stream.FragmentStream([image_path, rgba_image_path], fragmenter.Fragmenter(num_fragments=30, min_distance=4),
+                                            seed=0, workers=2, epochs=2, reuse_layout=False)
+    items = list(stream)
+    assert len(items) == 4
+    assert [random.random() for _ in range(3)] == expected
+
+
+def test_stream_is_the_same_for_any_number_of_workers(image_path, rgba_image_path):
+    def stream_items(workers):
+        stream = fragment_stream.FragmentStream([image_path, rgba_image_path], fragmenter.Fragmenter(num_fragments=30, min_distance=4),
+                                                seed=7, workers=workers, epochs=2)
+        return [(metadata, {name: (fragment[0], fragment[1], fragment[2].tobytes(), fragment[3]) for name, fragment in fragments.items()})
+                for fragments, metadata in stream]
+    assert stream_items(1) == stream_items(3)
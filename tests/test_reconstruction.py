@@ -0,0 +1,55 @@
+import os
+import numpy as np
+import pytest
+from core import fragmentation_erosion
+from core import instrumentation
+from core import riconstruct_image
+
+
+def paste_pixel_by_pixel(canvas, fragment_array, position):
+    # the per-pixel compositing the masked writes replaced: every non transparent pixel inside the canvas
+    x, y = position
+    for fy in range(fragment_array.shape[0]):
+        for fx in range(fragment_array.shape[1]):
+            if fragment_array[fy, fx, 3] != 0 and 0 <= x + fx < canvas.shape[1] and 0 <= y + fy < canvas.shape[0]:
+                canvas[y + fy, x + fx] = fragment_array[fy, fx]
+
+
+@pytest.mark.parametrize("position", [(5, 4), (-6, -3), (20, 13), (-30, 0), (40, 40)])
+def test_paste_fragment_matches_pixel_by_pixel(position):
+    rng = np.random.default_rng(0)
+    fragment_array = rng.integers(0, 256, (12, 15, 4), dtype=np.uint8)
+    fragment_array[rng.random((12, 15)) < 0.4, 3] = 0
+    canvas = rng.integers(0, 256, (20, 25, 4), dtype=np.uint8)
+    expected = canvas.copy()
+    paste_pixel_by_pixel(expected, fragment_array, position)
+    riconstruct_image.paste_fragment(canvas, fragment_array, position)
+    np.testing.assert_array_equal(canvas, expected)
+
+
+def test_paste_fragment_limited_to_where():
+    rng = np.random.default_rng(1)
+    fragment_array = rng.integers(1, 256, (10, 10, 4), dtype=np.uint8)
+    canvas = np.zeros((16, 16, 4), dtype=np.uint8)
+    where = np.zeros((16, 16), dtype=bool)
+    where[:8] = True
+    riconstruct_image.paste_fragment(canvas, fragment_array, (3, 3), where)
+    np.testing.assert_array_equal(canvas[3:8, 3:13], fragment_array[:5])
+    assert not canvas[8:].any()
+
+
+@pytest.mark.parametrize("rotation", ["expand", "tight"])
+@pytest.mark.parametrize("image_fixture", ["image_path", "rgba_image_path"])
+def test_reconstruction_from_memory_and_from_disk_match(request, tmp_path, image_fixture, rotation):
+    image_path = request.getfixturevalue(image_fixture)
+    path, fragments = fragmentation_erosion.generate_fragments(image_path, str(tmp_path), 40, 4, 11, 0.8, 30, return_fragments=True,
+                                                               monitor=instrumentation.RunMonitor(hooks=[]), rotation=rotation)
+    ricostruction_path = os.path.join(path, "ricostructed_image.png")
+
+    riconstruct_image.image_ricostruction(image_path, path, fragments)
+    with open(ricostruction_path, "rb") as image_file:
+        from_memory = image_file.read()
+    os.remove(ricostruction_path)
+    riconstruct_image.image_ricostruction(image_path, path)
+    with open(ricostruction_path, "rb") as image_file:
+        assert image_file.read() == from_memory
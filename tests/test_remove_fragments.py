@@ -0,0 +1,65 @@
+import os
+import pytest
+from core import fragment_io
+from core import fragmentation_erosion
+from core import instrumentation
+from core import remove_fragments
+from core import riconstruct_image
+
+
+def generate_dataset(image_path, output_directory, rotation="expand", storage="folder"):
+    path, fragments = fragmentation_erosion.generate_fragments(image_path, output_directory, 40, 4, 21, 0.8, 30, return_fragments=True,
+                                                               monitor=instrumentation.RunMonitor(hooks=[]), rotation=rotation, storage=storage)
+    riconstruct_image.image_ricostruction(image_path, path, fragments)
+    return path, fragments
+
+
+def rebuilt_ricostruction(image_path, path):
+    # the reconstruction of the removal dataset computed from scratch, from its fragments on disk
+    ricostruction_path = os.path.join(path, "ricostructed_image.png")
+    with open(ricostruction_path, "rb") as image_file:
+        subtracted = image_file.read()
+    os.remove(ricostruction_path)
+    riconstruct_image.image_ricostruction(image_path, path)
+    with open(ricostruction_path, "rb") as image_file:
+        return subtracted, image_file.read()
+
+
+@pytest.mark.parametrize("mode", remove_fragments.REMOVAL_MODES)
+@pytest.mark.parametrize("rotation", ["expand", "tight"])
+@pytest.mark.parametrize("in_memory", [True, False])
+def test_subtraction_matches_a_full_reconstruction(tmp_path, rgba_image_path, mode, rotation, in_memory):
+    path, fragments = generate_dataset(rgba_image_path, str(tmp_path), rotation)
+    removal_path, _ = remove_fragments.random_fragments_removal(21, path, str(tmp_path), 30, rgba_image_path,
+                                                                fragments if in_memory else None, mode)
+    subtracted, rebuilt = rebuilt_ricostruction(rgba_image_path, removal_path)
+    assert subtracted == rebuilt
+
+
+@pytest.mark.parametrize("mode", remove_fragments.REMOVAL_MODES)
+def test_subtraction_matches_on_shards(tmp_path, image_path, mode):
+    path, _ = generate_dataset(image_path, str(tmp_path), storage="shards")
+    removal_path, _ = remove_fragments.random_fragments_removal(5, path, str(tmp_path), 50, image_path, mode=mode)
+    assert not os.path.exists(os.path.join(removal_path, "shards", "index.json.tmp"))
+    subtracted, rebuilt = rebuilt_ricostruction(image_path, removal_path)
+    assert subtracted == rebuilt
+
+
+@pytest.mark.parametrize("mode", remove_fragments.REMOVAL_MODES)
+def test_removal_from_a_view(tmp_path, image_path, mode):
+    path, _ = generate_dataset(image_path, str(tmp_path / "datasets"))
+    view_path, _ = remove_fragments.random_fragments_removal(5, path, str(tmp_path / "views"), 20, image_path, mode="manifest")
+    view = fragment_io.open_fragment_store(view_path)
+    view_fragments = {name: view.read(name) for name in view.names()}
+    view.close()
+
+    removal_path, _ = remove_fragments.random_fragments_removal(6, view_path, str(tmp_path / "removals"), 30, image_path, mode=mode)
+    assert os.listdir(tmp_path / "removals") == [os.path.basename(removal_path)]
+    store = fragment_io.open_fragment_store(removal_path)
+    assert store.storage == ("manifest" if mode != "copy" else "folder")
+    names = store.names()
+    assert 0 < len(names) < len(view_fragments)
+    assert all(store.read(name) == view_fragments[name] for name in names)
+    store.close()
+    subtracted, rebuilt = rebuilt_ricostruction(image_path, removal_path)
+    assert subtracted == rebuilt
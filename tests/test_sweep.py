@@ -0,0 +1,49 @@
+import json
+import os
+import pytest
+from conftest import read_dataset
+from core import DAFNE
+from core import fragmentation_erosion
+from core import instrumentation
+from core import sweep
+
+
+SWEEP = """seed: 3, 4
+num_fragments: 30
+min_distance: 4
+erosion_probability: 0.5, 0.9
+removal_percentage: 0, 30
+num_spurius: 0, 3
+"""
+
+
+@pytest.fixture(scope="module")
+def spurius_directory(tmp_path_factory, rgba_image_path):
+    # a dataset cut from another image to draw the spurious fragments from
+    path = tmp_path_factory.mktemp("spurius")
+    return fragmentation_erosion.generate_fragments(rgba_image_path, str(path), 30, 4, 1, 0.5, 20, monitor=instrumentation.RunMonitor(hooks=[]))
+
+
+@pytest.mark.parametrize("workers", [None, 2])
+def test_sweep_variants_match_separate_runs(tmp_path, image_path, spurius_directory, workers):
+    sweep_path = tmp_path / "sweep.txt"
+    sweep_path.write_text(SWEEP)
+    parameter_sets = sweep.read_sweep(str(sweep_path))
+    assert len(parameter_sets) == 16
+
+    sweep_directory = str(tmp_path / "sweep")
+    os.makedirs(sweep_directory)
+    manifest_path = sweep.run_sweep([image_path], sweep_directory, parameter_sets, spurius_directory, workers)
+    with open(manifest_path, "r") as manifest_file:
+        variants = json.load(manifest_file)["variants"]
+    assert len(variants) == len(parameter_sets)
+
+    for i, variant in enumerate(variants):
+        parameters = dict(DAFNE.DEFAULT_PARAMETERS, **variant["parameters"])
+        run_directory = str(tmp_path / f"run_{i}")
+        path, removal_path = DAFNE.generate_image(image_path, run_directory, parameters, spurius_directory)
+        assert read_dataset(os.path.join(sweep_directory, variant["path"])) == read_dataset(path)
+        if removal_path is None:
+            assert variant["removal_path"] is None
+        else:
+            assert read_dataset(os.path.join(sweep_directory, variant["removal_path"])) == read_dataset(removal_path)
@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+from PIL import Image
+from conftest import read_dataset
+from core import fragmentation_erosion
+from core import instrumentation
+from core import riconstruct_image
+from core import tiled_fragmentation
+
+
+def tiled_dataset(image_path, output_directory, tile_size, **options):
+    return tiled_fragmentation.generate_fragments_tiled(image_path, output_directory, 40, 4, 17, 0.8, 30, tile_size=tile_size,
+                                                        scratch_directory=output_directory, monitor=instrumentation.RunMonitor(hooks=[]),
+                                                        folder_suffix="run", **options)
+
+
+@pytest.mark.parametrize("options", [{}, {"merge_chain": 3}, {"rotation": "tight"}])
+@pytest.mark.parametrize("tile_size", [16, 1024])
+def test_tiled_matches_fragment_workers(tmp_path, rgba_image_path, tile_size, options):
+    workers_path = fragmentation_erosion.generate_fragments(rgba_image_path, str(tmp_path / "workers"), 40, 4, 17, 0.8, 30, fragment_workers=2,
+                                                            monitor=instrumentation.RunMonitor(hooks=[]), folder_suffix="run", **options)
+    tiled_path = tiled_dataset(rgba_image_path, str(tmp_path / "tiled"), tile_size, **options)
+    files = read_dataset(tiled_path)
+    assert any(name.startswith("fragments") for name in files)
+    assert files == read_dataset(workers_path)
+
+
+def test_npy_source_matches_png(tmp_path, image_path):
+    npy_path = str(tmp_path / "synthetic.npy")
+    np.save(npy_path, np.asarray(Image.open(image_path)))
+    from_npy = tiled_dataset(npy_path, str(tmp_path / "npy"), 32)
+    from_png = tiled_dataset(image_path, str(tmp_path / "png"), 32)
+    assert read_dataset(from_npy) == read_dataset(from_png)
+
+    # the reconstruction reads the .npy image through its memory map
+    riconstruct_image.image_ricostruction(npy_path, from_npy)
+    riconstruct_image.image_ricostruction(image_path, from_png)
+    assert read_dataset(from_npy) == read_dataset(from_png)
@@ -0,0 +1,70 @@
+import random
+import numpy as np
+import pytest
+from core import fragmentation_erosion
+
+
+def brute_force_voronoi(width, height, points):
+    # the linear scan the label map replaced: every pixel against every seed, ties to the lowest index
+    ys, xs = np.mgrid[0:height, 0:width]
+    seeds = np.asarray(points, dtype=np.int64)
+    distances = (xs[:, :, None] - seeds[:, 0]) ** 2 + (ys[:, :, None] - seeds[:, 1]) ** 2
+    return np.argmin(distances, axis=2)
+
+
+def random_points(count, width, height, seed):
+    rng = random.Random(seed)
+    return [(rng.randint(0, width), rng.randint(0, height)) for _ in range(count)]
+
+
+@pytest.mark.parametrize("tile_size", [7, 64])
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_label_map_matches_linear_scan(seed, tile_size):
+    points = random_points(40, 97, 61, seed)
+    label_map = fragmentation_erosion.create_voronoi(97, 61, points, tile_size=tile_size)
+    assert label_map.dtype == np.int32
+    np.testing.assert_array_equal(label_map, brute_force_voronoi(97, 61, points))
+
+
+def test_label_map_ties_go_to_the_lowest_index():
+    # a lattice makes many pixels equidistant from two or four seeds, duplicated seeds never own a pixel
+    points = [(x, y) for y in range(0, 50, 10) for x in range(0, 60, 10)]
+    points += points[:5]
+    label_map = fragmentation_erosion.create_voronoi(55, 45, points, tile_size=8)
+    np.testing.assert_array_equal(label_map, brute_force_voronoi(55, 45, points))
+    assert not np.isin(np.arange(len(points) - 5, len(points)), label_map).any()
+
+
+def test_region_matches_the_full_map():
+    points = random_points(30, 80, 70, 4)
+    full = fragmentation_erosion.create_voronoi(80, 70, points)
+    region = fragmentation_erosion.voronoi_region(points, 13, 21, 66, 58, tile_size=9)
+    np.testing.assert_array_equal(region, full[21:58, 13:66])
+
+
+def test_bounding_boxes_match_the_pixels_of_each_cell():
+    points = random_points(25, 64, 48, 5)
+    label_map = fragmentation_erosion.create_voronoi(64, 48, points)
+    min_x, min_y, max_x, max_y = fragmentation_erosion.cell_bounding_boxes(label_map, len(points))
+    for label in range(len(points)):
+        ys, xs = np.nonzero(label_map == label)
+        if len(xs) == 0:
+            assert max_x[label] < 0
+            continue
+        assert (min_x[label], min_y[label], max_x[label], max_y[label]) == (xs.min(), ys.min(), xs.max(), ys.max())
+
+
+def test_fragments_hold_exactly_the_pixels_of_their_cell(image_path):
+    from PIL import Image
+    pixels = fragmentation_erosion.image_to_array(Image.open(image_path))
+    height, width = pixels.shape[:2]
+    points = random_points(20, width, height, 6)
+    label_map = fragmentation_erosion.create_voronoi(width, height, points)
+    fragments = fragmentation_erosion.create_fragment_image(label_map, points, pixels)
+
+    for point, (x, y), fragment in fragments:
+        label = points.index(point)
+        expected = np.zeros((fragment.height, fragment.width, 4), dtype=np.uint8)
+        for py, px in zip(*np.nonzero(label_map == label)):
+            expected[py - y, px - x] = pixels[py, px]
+        np.testing.assert_array_equal(np.asarray(fragment), expected)